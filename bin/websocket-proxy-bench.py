@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# Load-generation and latency benchmark for the websocket proxy
+#
+# Opens a number of meetup pairs through the proxy (a "gateway" and a "manager" client per meetup),
+# performs the CONN:HELLO exchange, and then drives REST:REQUEST/REST:RESPONSE and EVENT traffic
+# between them. The results (relay latency percentiles, request round-trip times, throughput,
+# connection-setup rate and the proxy's RSS) are written as JSON, so they can be compared between
+# runs to catch regressions. With --event-loop, the benchmark is run against a proxy started with
+# each of the given event loops in turn, and the results are reported side by side.
+
+import os
+import sys
+import ssl
+import json
+import time
+import math
+import random
+import signal
+import socket
+import asyncio
+import pathlib
+import argparse
+import subprocess
+import websockets
+
+bin_path = pathlib.Path (__file__).parent
+
+arg_parser = argparse.ArgumentParser (description='the micronets websocket proxy benchmark')
+
+arg_parser.add_argument ('--proxy-uri', "-u", required=False, action='store', type=str,
+                         default="wss://localhost:5050/micronets/v1/ws-proxy/",
+                         help="the proxy service URI (the meetup IDs are appended to it)")
+arg_parser.add_argument ('--start-proxy', "-s", required=False, action='store_true',
+                         help="start bin/websocket-proxy.py on a free local port for the run "
+                              "(--proxy-uri is ignored)")
+arg_parser.add_argument ('--proxy-arg', "-A", required=False, action='append', default=[],
+                         help="an argument to pass to the started proxy (e.g. -A=--proxy-worker-count -A=4)")
+arg_parser.add_argument ('--event-loop', "-L", required=False, action='append', choices=["asyncio", "uvloop"],
+                         help="compare event loops: run the benchmark against a proxy started with each given "
+                              "event loop (e.g. -L asyncio -L uvloop) - implies --start-proxy")
+arg_parser.add_argument ('--proxy-pid', required=False, action='store', type=int,
+                         help="the pid of an already-running proxy (to report its RSS)")
+arg_parser.add_argument ('--pairs', "-n", required=False, action='store', type=int, default=100,
+                         help="the number of meetup pairs to open")
+arg_parser.add_argument ('--connect-concurrency', required=False, action='store', type=int, default=50,
+                         help="the maximum number of pairs connecting at once")
+arg_parser.add_argument ('--request-rate', "-r", required=False, action='store', type=float, default=1.0,
+                         help="REST requests per second sent by each manager (0 for none)")
+arg_parser.add_argument ('--event-rate', "-e", required=False, action='store', type=float, default=1.0,
+                         help="EVENT messages per second sent by each gateway (0 for none)")
+arg_parser.add_argument ('--payload-size', "-b", required=False, action='store', type=int, default=256,
+                         help="the size of the message body of each request, response and event")
+arg_parser.add_argument ('--warmup-s', required=False, action='store', type=float, default=2.0,
+                         help="seconds of traffic before measuring")
+arg_parser.add_argument ('--duration-s', "-d", required=False, action='store', type=float, default=10.0,
+                         help="seconds of traffic to measure")
+arg_parser.add_argument ('--compression', required=False, action='store', choices=["deflate", "none"],
+                         default="deflate", help="the websocket compression the clients offer")
+arg_parser.add_argument ('--client-cert', "-cc", required=False, action='store', type=str,
+                         default = str (bin_path.parent.joinpath ('lib/micronets-ws-test-client.pkeycert.pem')),
+                         help="the client cert file")
+arg_parser.add_argument ('--ca-cert', "-ca", required=False, action='store', type=str,
+                         default = str (bin_path.parent.joinpath ('lib/micronets-ws-root.cert.pem')),
+                         help="the CA cert file")
+arg_parser.add_argument ('--output', "-o", required=False, action='store', type=str,
+                         help="the file to write the JSON results to (default: stdout)")
+
+class BenchStats:
+    def __init__ (self):
+        self.measuring = False
+        self.relay_latencies = []
+        self.request_rtts = []
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.setup_times = []
+        self.connect_errors = 0
+        self.errors = 0
+        self.rss_samples = []
+
+    def message_received (self, message, send_time, receive_time):
+        if (not self.measuring):
+            return
+        self.messages_received += 1
+        self.bytes_received += len (message)
+        self.relay_latencies.append (receive_time - send_time)
+
+def percentiles (values, scale=1000.0):
+    '''Return the count, mean and p50/p99/p999/max of the values (in milliseconds by default)'''
+    if (not values):
+        return {'count': 0}
+    values = sorted (values)
+    def percentile (fraction):
+        return values [max (0, math.ceil (fraction * len (values)) - 1)] * scale
+    return {'count': len (values),
+            'mean': sum (values) / len (values) * scale,
+            'p50': percentile (0.5),
+            'p99': percentile (0.99),
+            'p999': percentile (0.999),
+            'max': values [-1] * scale}
+
+def process_rss (pid):
+    '''Return the RSS (in bytes) of the process and all its descendants - or None if it can't be read'''
+    try:
+        with open (f"/proc/{pid}/status") as status_file:
+            rss_kb = next (int (line.split () [1]) for line in status_file if line.startswith ("VmRSS:"))
+        child_pids = []
+        for task in os.listdir (f"/proc/{pid}/task"):
+            with open (f"/proc/{pid}/task/{task}/children") as children_file:
+                child_pids.extend (int (child_pid) for child_pid in children_file.read ().split ())
+    except (OSError, StopIteration, ValueError):
+        return None
+    return rss_kb * 1024 + sum (process_rss (child_pid) or 0 for child_pid in child_pids)
+
+class MeetupPair:
+    '''A gateway and manager client connected to the same meetup'''
+    def __init__ (self, index, meetup_uri, ssl_context, stats):
+        self.index = index
+        self.meetup_uri = meetup_uri
+        self.ssl_context = ssl_context
+        self.stats = stats
+        self.gateway = None
+        self.manager = None
+        self.message_id = 0
+        self.pending_requests = {}
+
+    def next_message_id (self):
+        self.message_id += 1
+        return self.message_id
+
+    def hello_message (self, peer_class):
+        return json.dumps ({'message': {'messageId': self.next_message_id (), 'messageType': 'CONN:HELLO',
+                                        'requiresResponse': False, 'peerClass': peer_class,
+                                        'peerId': f"bench-{self.index}"}})
+
+    async def connect (self):
+        start_time = time.monotonic ()
+        compression = None if args.compression == "none" else args.compression
+        self.gateway = await websockets.connect (self.meetup_uri, ssl=self.ssl_context, compression=compression)
+        await self.gateway.send (self.hello_message ('micronets-bench-gateway'))
+        self.manager = await websockets.connect (self.meetup_uri, ssl=self.ssl_context, compression=compression)
+        await self.manager.send (self.hello_message ('micronets-bench-manager'))
+        # Each side receives the other's HELLO once the proxy has paired them
+        await self.gateway.recv ()
+        await self.manager.recv ()
+        self.stats.setup_times.append (time.monotonic () - start_time)
+
+    async def run (self, end_time):
+        tasks = [asyncio.ensure_future (self.read_messages (self.gateway)),
+                 asyncio.ensure_future (self.read_messages (self.manager))]
+        if (args.request_rate > 0):
+            tasks.append (asyncio.ensure_future (self.send_messages (self.manager, 'REST:REQUEST',
+                                                                     args.request_rate, end_time)))
+        if (args.event_rate > 0):
+            tasks.append (asyncio.ensure_future (self.send_messages (self.gateway, 'EVENT:BENCH',
+                                                                     args.event_rate, end_time)))
+        try:
+            await asyncio.sleep (end_time - time.monotonic ())
+        finally:
+            for task in tasks:
+                task.cancel ()
+            await asyncio.gather (*tasks, return_exceptions=True)
+
+    async def send_messages (self, websocket, message_type, rate, end_time):
+        payload = 'x' * args.payload_size
+        # Start at a random offset, so the pairs don't all send at once
+        await asyncio.sleep (random.random () / rate)
+        next_send_time = time.monotonic ()
+        while next_send_time < end_time:
+            message_id = self.next_message_id ()
+            message = {'messageId': message_id, 'messageType': message_type,
+                       'requiresResponse': message_type == 'REST:REQUEST',
+                       'dataFormat': 'text/plain', 'messageBody': payload, 'benchSendTime': time.monotonic ()}
+            if (message_type == 'REST:REQUEST'):
+                message.update (method='GET', path='/micronets/v1/bench')
+                self.pending_requests [message_id] = message ['benchSendTime']
+            try:
+                await websocket.send (json.dumps ({'message': message}))
+            except websockets.ConnectionClosed:
+                self.stats.errors += 1
+                return
+            next_send_time += random.expovariate (rate)
+            await asyncio.sleep (max (0, next_send_time - time.monotonic ()))
+
+    async def read_messages (self, websocket):
+        while True:
+            try:
+                raw_message = await websocket.recv ()
+            except websockets.ConnectionClosed:
+                self.stats.errors += 1
+                return
+            receive_time = time.monotonic ()
+            message = json.loads (raw_message) ['message']
+            self.stats.message_received (raw_message, message ['benchSendTime'], receive_time)
+            if (message ['messageType'] == 'REST:REQUEST'):
+                response = {'messageId': self.next_message_id (), 'messageType': 'REST:RESPONSE',
+                            'requiresResponse': False, 'inResponseTo': message ['messageId'],
+                            'statusCode': 200, 'reasonPhrase': "OK", 'dataFormat': 'text/plain',
+                            'messageBody': message ['messageBody'], 'benchSendTime': time.monotonic ()}
+                try:
+                    await websocket.send (json.dumps ({'message': response}))
+                except websockets.ConnectionClosed:
+                    self.stats.errors += 1
+                    return
+            elif (message ['messageType'] == 'REST:RESPONSE'):
+                request_send_time = self.pending_requests.pop (message ['inResponseTo'], None)
+                if (request_send_time is not None and self.stats.measuring):
+                    self.stats.request_rtts.append (receive_time - request_send_time)
+
+    async def close (self):
+        for websocket in (self.gateway, self.manager):
+            if (websocket):
+                await websocket.close ()
+
+def start_proxy (extra_args=[]):
+    '''Start the proxy on a free local port, returning the process and its service URI'''
+    with socket.socket () as port_socket:
+        port_socket.bind (('localhost', 0))
+        port = port_socket.getsockname () [1]
+    proxy_command = [sys.executable, str (bin_path.joinpath ('websocket-proxy.py')),
+                     '--proxy-bind-address', 'localhost', '--proxy-port', str (port),
+                     '--log-level', 'WARNING'] + args.proxy_arg + extra_args
+    print (f"websocket-proxy-bench: Starting proxy: {' '.join (proxy_command)}", file=sys.stderr)
+    proxy_process = subprocess.Popen (proxy_command)
+    deadline = time.monotonic () + 15
+    while True:
+        if (proxy_process.poll () is not None):
+            raise Exception (f"The proxy exited with status {proxy_process.returncode}")
+        try:
+            socket.create_connection (('localhost', port), timeout=1).close ()
+            break
+        except OSError:
+            if (time.monotonic () > deadline):
+                raise Exception (f"The proxy didn't start listening on port {port}")
+            time.sleep (0.1)
+    return proxy_process, f"wss://localhost:{port}/micronets/v1/ws-proxy/"
+
+async def sample_rss (proxy_pid, stats):
+    while True:
+        rss = process_rss (proxy_pid)
+        if (rss is not None):
+            stats.rss_samples.append (rss)
+        await asyncio.sleep (1)
+
+async def run_benchmark (proxy_uri, proxy_pid):
+    ssl_context = ssl.SSLContext (ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_cert_chain (args.client_cert)
+    ssl_context.load_verify_locations (cafile = args.ca_cert)
+    ssl_context.check_hostname = False
+
+    stats = BenchStats ()
+    rss_task = asyncio.ensure_future (sample_rss (proxy_pid, stats)) if proxy_pid else None
+    start_rss = process_rss (proxy_pid) if proxy_pid else None
+    run_id = random.getrandbits (32)
+    pairs = [MeetupPair (index, f"{proxy_uri}bench-{run_id:08x}-{index}", ssl_context, stats)
+             for index in range (args.pairs)]
+
+    print (f"websocket-proxy-bench: Connecting {len (pairs)} meetup pairs...", file=sys.stderr)
+    connect_semaphore = asyncio.Semaphore (args.connect_concurrency)
+    async def connect_pair (pair):
+        async with connect_semaphore:
+            try:
+                await pair.connect ()
+                return pair
+            except Exception as ex:
+                stats.connect_errors += 1
+                print (f"websocket-proxy-bench: pair {pair.index} failed to connect: {ex}", file=sys.stderr)
+                await pair.close ()
+                return None
+    connect_start_time = time.monotonic ()
+    connected_pairs = [pair for pair in await asyncio.gather (*[connect_pair (pair) for pair in pairs]) if pair]
+    connect_elapsed_s = time.monotonic () - connect_start_time
+    connected_rss = process_rss (proxy_pid) if proxy_pid else None
+
+    print (f"websocket-proxy-bench: {len (connected_pairs)} pairs connected in {connect_elapsed_s:.2f} seconds "
+           f"- running traffic for {args.warmup_s + args.duration_s} seconds...", file=sys.stderr)
+    start_time = time.monotonic ()
+    measure_start_time = start_time + args.warmup_s
+    end_time = measure_start_time + args.duration_s
+    async def start_measuring ():
+        await asyncio.sleep (args.warmup_s)
+        stats.measuring = True
+    asyncio.ensure_future (start_measuring ())
+    await asyncio.gather (*[pair.run (end_time) for pair in connected_pairs])
+    stats.measuring = False
+    measured_s = time.monotonic () - measure_start_time
+    end_rss = process_rss (proxy_pid) if proxy_pid else None
+
+    await asyncio.gather (*[pair.close () for pair in connected_pairs], return_exceptions=True)
+    if (rss_task):
+        rss_task.cancel ()
+    # The samples are only taken every second - so the readings in between may be higher
+    rss_readings = [rss for rss in stats.rss_samples + [start_rss, connected_rss, end_rss] if rss is not None]
+
+    return {'config': {'pairs': args.pairs, 'request_rate': args.request_rate, 'event_rate': args.event_rate,
+                       'payload_size': args.payload_size, 'warmup_s': args.warmup_s,
+                       'duration_s': args.duration_s, 'compression': args.compression,
+                       'proxy_args': args.proxy_arg if args.start_proxy or args.event_loop else None},
+            'pairs_connected': len (connected_pairs),
+            'connect_errors': stats.connect_errors,
+            'errors': stats.errors,
+            'connection_setup': dict (percentiles (stats.setup_times),
+                                      elapsed_s=connect_elapsed_s,
+                                      pairs_per_s=len (connected_pairs) / connect_elapsed_s if connect_elapsed_s else None),
+            'relay_latency_ms': percentiles (stats.relay_latencies),
+            'request_rtt_ms': percentiles (stats.request_rtts),
+            'throughput': {'messages_per_s': stats.messages_received / measured_s,
+                           'bytes_per_s': stats.bytes_received / measured_s},
+            'proxy_rss_bytes': {'start': start_rss, 'connected': connected_rss, 'end': end_rss,
+                                'peak': max (rss_readings) if rss_readings else None}}
+
+def raise_fd_limit ():
+    try:
+        import resource
+        soft_limit, hard_limit = resource.getrlimit (resource.RLIMIT_NOFILE)
+        resource.setrlimit (resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    except (ImportError, ValueError, OSError) as ex:
+        print (f"websocket-proxy-bench: Could not raise the open file limit: {ex}", file=sys.stderr)
+
+def run_with_event_loops (event_loops):
+    '''Run the benchmark against a proxy started with each event loop, returning the results of each'''
+    results = {}
+    for event_loop in event_loops:
+        proxy_process, proxy_uri = start_proxy (['--event-loop', event_loop])
+        try:
+            results [event_loop] = asyncio.get_event_loop ().run_until_complete (run_benchmark (proxy_uri,
+                                                                                               proxy_process.pid))
+        finally:
+            proxy_process.send_signal (signal.SIGTERM)
+            proxy_process.wait ()
+    print (f"{'event loop':<12} {'messages/s':>12} {'relay p50 ms':>13} {'relay p99 ms':>13} "
+           f"{'request p99 ms':>15} {'pairs/s':>9} {'peak RSS MB':>12}", file=sys.stderr)
+    for event_loop, loop_results in results.items ():
+        peak_rss = loop_results ['proxy_rss_bytes'] ['peak']
+        print (f"{event_loop:<12} {loop_results ['throughput'] ['messages_per_s']:>12.1f} "
+               f"{loop_results ['relay_latency_ms'].get ('p50', math.nan):>13.3f} "
+               f"{loop_results ['relay_latency_ms'].get ('p99', math.nan):>13.3f} "
+               f"{loop_results ['request_rtt_ms'].get ('p99', math.nan):>15.3f} "
+               f"{loop_results ['connection_setup'] ['pairs_per_s'] or math.nan:>9.1f} "
+               f"{peak_rss / 2 ** 20 if peak_rss else math.nan:>12.1f}", file=sys.stderr)
+    return {'event_loops': results}
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args ()
+    # Each pair uses 2 sockets here (and 2 in the proxy, if it's started here)
+    raise_fd_limit ()
+    proxy_process = None
+    proxy_uri = args.proxy_uri
+    proxy_pid = args.proxy_pid
+    try:
+        if (args.event_loop):
+            results = run_with_event_loops (args.event_loop)
+        else:
+            if (args.start_proxy):
+                proxy_process, proxy_uri = start_proxy ()
+                proxy_pid = proxy_process.pid
+            results = asyncio.get_event_loop ().run_until_complete (run_benchmark (proxy_uri, proxy_pid))
+    finally:
+        if (proxy_process):
+            proxy_process.send_signal (signal.SIGTERM)
+            proxy_process.wait ()
+    results_json = json.dumps (results, indent=2)
+    if (args.output):
+        with open (args.output, 'w') as output_file:
+            output_file.write (results_json + "\n")
+    else:
+        print (results_json)
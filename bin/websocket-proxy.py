@@ -2,30 +2,1070 @@
 
 # WS proxy server
 
+import os
+import re
+import argparse
+import json
+import importlib
+import atexit
+import math
+import random
+import signal
+import struct
+import time
+import queue
 import logging
+import logging.handlers
 import asyncio
+import bisect
+import tempfile
+import multiprocessing
+import zlib
+import codecs
+import collections
+import functools
+import itertools
+import contextlib
+import fcntl
+import concurrent.futures
+import urllib.parse
 import websockets
 import pathlib
+import socket
+import subprocess
+import sys
+import threading
+import traceback
 import ssl
 
-from quart import json
+from http import HTTPStatus
+from websockets.framing import Frame, OP_CONT, OP_TEXT, OP_BINARY, OP_PING, CTRL_OPCODES
+from websockets.protocol import State
+from websockets.exceptions import WebSocketProtocolError, PayloadTooBig
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory, PerMessageDeflate
+try:
+    from websockets.speedups import apply_mask
+except ImportError:
+    from websockets.utils import apply_mask
 
 bin_path = pathlib.Path (__file__).parent
 
-# Change these if/when necessary (TODO: integrate argparse support)
+# Change these if/when necessary - or override them with a (JSON) config file, MICRONETS_WS_* environment
+# variables or command line options (see --help and config_settings below)
 
 proxy_bind_address = "0.0.0.0" # Use "localhost" when testing...
 proxy_port = 5050
 proxy_service_prefix = "/micronets/v1/ws-proxy/"
+meetup_id_pattern = r"[A-Za-z0-9._~:@%/-]{1,256}" # meetup IDs (the path after proxy_service_prefix) have to match this
 proxy_cert_path = bin_path.parent.joinpath ('lib/micronets-ws-proxy.pkeycert.pem')
 root_cert_path = bin_path.parent.joinpath ('lib/micronets-ws-root.cert.pem')
+tls_session_tickets = True # allow clients to resume TLS sessions with session tickets (session IDs are always cached)
+tls_reload_check_interval_s = 0 # seconds between checks for changed cert/CA files, 0 to only reload on SIGHUP
 report_interval_s = 0 # seconds, 0 to disable
+proxy_worker_count = 0 # worker processes sharing proxy_port via SO_REUSEPORT, 0 to run in a single process
+listen_backlog = 100 # the listen() backlog for the proxy port
+max_meetups = 0 # meetups (per process) before new meetups are refused, 0 for no limit
+max_connections = 0 # websocket connections (per process) before new connections are refused, 0 for no limit
+max_connections_per_address = 0 # websocket connections (per process) from one IP address, 0 for no limit
+meetup_half_open_ttl_s = 0 # seconds a client can wait for a peer to join its meetup, 0 for no limit
+hello_max_size = 4096 # the maximum size of a client's HELLO message (its first message), 0 for ws_max_size
+hello_timeout_s = 10 # seconds a client has to send its HELLO message after connecting, 0 for no limit
+router_path = "" # the path router clients connect to (see README), "" to disable routing mode
+event_path = "" # the path event subscribers connect to (see README), "" to disable event fan-out
+event_queue_max_messages = 256 # events queued per event subscriber before the oldest are dropped
+event_queue_max_bytes = 2 ** 20 # bytes of events queued per event subscriber before the oldest are dropped
+session_resume_grace_s = 0 # seconds a client is held for its peer to reconnect (see README), 0 to close it straight away
+session_resume_max_messages = 64 # unanswered requests and held messages replayed to a reconnecting peer
+cluster_directory = "" # "local", "file:<path>" or "<module>:<class>" to run as a cluster node (see README), "" to disable
+cluster_link_bind_address = "0.0.0.0" # the address to accept links from other cluster nodes on
+cluster_link_port = 5051 # the port to accept links from other cluster nodes on
+cluster_link_address = "" # the host:port other nodes connect to (the node's ID), "" for <host name>:<cluster_link_port>
+cluster_link_tls = True # use TLS (with the proxy certificate) for the links between cluster nodes
+link_channel_queue_max_bytes = 2 ** 22 # bytes received over a worker/cluster link queued for one client before it's closed, 0 for no limit
+drain_window_s = 30 # seconds over which clients are closed when the proxy drains (on SIGTERM/SIGINT/SIGUSR2)
+drain_report_interval_s = 5 # seconds between drain progress log messages
+json_backend = "auto" # "json", "orjson", "ujson" or "auto" (orjson or ujson if installed, otherwise json)
+event_loop = "auto" # "asyncio", "uvloop" or "auto" (uvloop if installed, otherwise the asyncio event loop)
+ws_max_size = 2 ** 20 # the maximum size of a received websocket message, 0 for no limit
+ws_max_queue = 32 # received messages buffered per client (when not relaying raw frames), 0 for no limit
+ws_read_limit = 2 ** 16 # the high-water mark of each connection's read buffer
+ws_write_limit = 2 ** 16 # the high-water mark of each connection's write buffer
+ws_compression = "deflate" # "deflate" to offer permessage-deflate to clients, "none" to disable compression
+ws_compression_window_bits = 15 # the LZ77 window (9-15) the proxy compresses with - lower uses less memory
+ws_compression_client_window_bits = 15 # the LZ77 window clients are asked to compress with (if it's below 15)
+ws_compression_mem_level = 8 # the zlib memLevel (1-9) - lower uses less memory, but compresses less
+ws_compression_level = 6 # the zlib compression level (0-9)
+ws_compression_no_context_takeover = False # compress messages independently (see README)
+ws_compression_min_size = 0 # messages smaller than this (in bytes) are sent uncompressed
+ws_close_timeout_s = 10 # seconds to wait for the closing handshake
+ping_interval_s = 10 # seconds a client can be idle before it's sent a keepalive ping, 0 to disable pings
+ping_timeout_s = 10 # seconds to wait for a pong before a client is disconnected
+relay_raw_frames = False # forward websocket frames between peers without decoding them into messages
+relay_max_buffered_size = 2 ** 16 # bytes of a larger frame read before they're relayed (as a fragment) when relaying raw frames, 0 to buffer whole frames
+relay_queue_max_messages = 32 # messages queued for a client before relay_queue_policy applies, 0 to send inline
+relay_queue_max_bytes = 2 ** 20 # bytes (characters for text) queued for a client before relay_queue_policy applies
+relay_queue_policy = "block" # "block", "drop-oldest-event" or "close"
+relay_queue_close_code = 1008 # the close code used for the "close" policy
+rate_limit_messages_per_s = 0 # messages per second a client can send (0 for no limit)
+rate_limit_bytes_per_s = 0 # bytes per second a client can send (0 for no limit)
+rate_limit_burst_s = 1 # seconds of traffic (at the rate limits) a client can send in a burst
+rate_limit_action = "delay" # "delay", "drop" or "close" - what to do when a client exceeds its rate limits
+keepalive_tick_s = 1.0 # resolution of the keepalive (ping) timer shared by all clients
+metrics_bind_address = "localhost" # address for the HTTP metrics endpoint
+metrics_port = 0 # port for the HTTP metrics endpoint (offset by the worker index for pool workers), 0 to disable
+admin_socket_path = "" # unix socket for the admin API (suffixed with ".<index>" for pool workers), "" to disable
+loop_lag_check_interval_s = 0.25 # seconds between event loop lag measurements, 0 to disable
+slow_callback_threshold_s = 0.5 # seconds the event loop can be blocked before the blocking stack is logged, 0 to disable
+profile_duration_s = 10 # seconds the sampling profiler runs for (on SIGUSR1 or /profile)
+profile_sample_interval_s = 0.005 # seconds between the profiler's stack samples
+profile_dump_dir = "" # directory for profiles taken on SIGUSR1 (default: the temp directory)
+log_level = "INFO"
+log_format = "text" # "text" or "json" (one JSON object per line, including any meetupId/clientId/size fields)
+log_queue_handler = True # write log records from a separate thread, so log I/O never blocks the event loop
+relay_log_sample_rate = 0 # log (at DEBUG) 1 in every N messages relayed to a peer, 0 to not log relayed messages
+log_rate_limit_interval_s = 10 # seconds between repeats of warnings which can be logged per-message
 
-meetup_table = {}
+worker_links = None # The WorkerLinkManager for this process when running as a pool worker (or ClusterLinkManager)
 
-logging.basicConfig (level='INFO',format='%(asctime)s %(name)s: %(levelname)s %(message)s')
+text_log_format = '%(asctime)s %(name)s: %(levelname)s %(message)s'
+
+logging.basicConfig (level=log_level, format=text_log_format)
 logger = logging.getLogger ('micronets-ws-proxy')
+log_listener = None # The QueueListener writing log records for this process (when log_queue_handler is set)
+
+class JSONLogFormatter (logging.Formatter):
+    '''Formats log records as single-line JSON objects'''
+    # Fields passed via "extra" which are included in the JSON object (when present)
+    extra_fields = ('meetupId', 'clientId', 'peerClientId', 'size')
+
+    def format (self, record):
+        log_record = {'time': self.formatTime (record), 'logger': record.name,
+                      'level': record.levelname, 'message': record.getMessage ()}
+        for field in self.extra_fields:
+            if hasattr (record, field):
+                log_record [field] = getattr (record, field)
+        if record.exc_info:
+            log_record ['exception'] = self.formatException (record.exc_info)
+        return json.dumps (log_record)
+
+def setup_logging ():
+    '''(Re)configure the root log handler per log_format/log_queue_handler
+
+       Needs to be called in each process (the log listener thread doesn't survive a fork).'''
+    global log_listener
+    root_logger = logging.getLogger ()
+    for handler in list (root_logger.handlers):
+        root_logger.removeHandler (handler)
+    handler = logging.StreamHandler ()
+    handler.setFormatter (JSONLogFormatter () if log_format == "json" else logging.Formatter (text_log_format))
+    if log_queue_handler:
+        log_queue = queue.Queue ()
+        log_listener = logging.handlers.QueueListener (log_queue, handler)
+        log_listener.start ()
+        atexit.register (log_listener.stop)
+        handler = logging.handlers.QueueHandler (log_queue)
+    root_logger.addHandler (handler)
+    root_logger.setLevel (log_level)
+    # The websockets module logs every frame at DEBUG - which is only worth the cost when debugging it
+    logging.getLogger ('websockets').setLevel (logging.INFO)
+
+rate_limited_logs = {} # message format -> [the time it was last logged, the number of repeats suppressed]
+
+def log_rate_limited (level, msg, *args, **kwargs):
+    '''Log a message which can repeat per-message (e.g. "... - DROPPING") at most every log_rate_limit_interval_s'''
+    now = time.monotonic ()
+    log_state = rate_limited_logs.get (msg)
+    if log_state and now - log_state [0] < log_rate_limit_interval_s:
+        log_state [1] += 1
+        return
+    rate_limited_logs [msg] = [now, 0]
+    if log_state and log_state [1]:
+        msg = f"{msg} ({log_state [1]} repeats suppressed)"
+    logger.log (level, msg, *args, **kwargs)
+
+#
+# Metrics
+#
+# All metric updates are constant-time (histograms do a bisect over a fixed bucket list). The
+# metrics are rendered in the Prometheus text exposition format when the /metrics endpoint on
+# metrics_port is scraped - nothing is formatted per-event.
+#
+
+class MetricValue:
+    def __init__ (self):
+        self.value = 0
+
+    def inc (self, amount=1):
+        self.value += amount
+
+    def dec (self, amount=1):
+        self.value -= amount
+
+    def set (self, value):
+        self.value = value
+
+    def render (self, name, labels):
+        label_str = "{" + ",".join (labels) + "}" if labels else ""
+        yield f"{name}{label_str} {self.value}"
+
+class HistogramValue:
+    def __init__ (self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len (buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe (self, value):
+        # Bucket bounds are inclusive ("le")
+        self.bucket_counts [bisect.bisect_left (self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render (self, name, labels):
+        cumulative_count = 0
+        for bound, bucket_count in zip (self.buckets + [math.inf], self.bucket_counts):
+            cumulative_count += bucket_count
+            le = "+Inf" if bound == math.inf else repr (float (bound))
+            bucket_labels = ",".join (labels + ['le="{}"'.format (le)])
+            yield f"{name}_bucket{{{bucket_labels}}} {cumulative_count}"
+        label_str = "{" + ",".join (labels) + "}" if labels else ""
+        yield f"{name}_sum{label_str} {self.sum}"
+        yield f"{name}_count{label_str} {self.count}"
+
+class MetricFamily:
+    '''A counter, gauge or histogram - optionally split by the values of one label
+
+       The number of distinct label values is capped (values past the cap are counted as "other")
+       since some label values come from the clients.'''
+    def __init__ (self, name, help_text, metric_type, label_name=None, buckets=None, max_label_values=32):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_name = label_name
+        self.buckets = buckets
+        self.max_label_values = max_label_values
+        self.values = {}
+
+    def labels (self, label_value=None):
+        value = self.values.get (label_value)
+        if value is None:
+            if self.label_name and len (self.values) >= self.max_label_values:
+                label_value = "other"
+                value = self.values.get (label_value)
+            if value is None:
+                value = HistogramValue (self.buckets) if self.metric_type == "histogram" else MetricValue ()
+                self.values [label_value] = value
+        return value
+
+    # Shortcuts for unlabeled metrics
+    def inc (self, amount=1):
+        self.labels ().inc (amount)
+
+    def dec (self, amount=1):
+        self.labels ().dec (amount)
+
+    def observe (self, value):
+        self.labels ().observe (value)
+
+    def render (self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        if not self.label_name and not self.values:
+            self.labels ()
+        for label_value, value in self.values.items ():
+            labels = []
+            if self.label_name:
+                escaped = str (label_value).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n')
+                labels.append (f'{self.label_name}="{escaped}"')
+            yield from value.render (self.name, labels)
+
+latency_buckets_s = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+# Waiting for a peer can take much longer
+stage_buckets_s = latency_buckets_s + [10.0, 30.0, 60.0, 300.0, 1800.0]
+
+class ProxyMetrics:
+    def __init__ (self):
+        prefix = "micronets_ws_proxy_"
+        self.clients_connected = MetricFamily (prefix + "clients_connected",
+                                               "Websocket clients currently connected", "gauge")
+        self.meetups_active = MetricFamily (prefix + "meetups_active",
+                                            "Meetups with both clients connected", "gauge")
+        self.meetups_half_open = MetricFamily (prefix + "meetups_half_open",
+                                               "Meetups with one client waiting for a peer", "gauge")
+        self.meetups_expired = MetricFamily (prefix + "meetups_expired_total",
+                                             "Half-open meetups closed after meetup_half_open_ttl_s", "counter")
+        self.session_holds = MetricFamily (prefix + "session_holds_total",
+                                           "Clients held for a disconnected peer, by outcome (resumed or expired)",
+                                           "counter",
+                                           label_name="outcome")
+        self.connections_rejected = MetricFamily (prefix + "connections_rejected_total",
+                                                  "Websocket connections rejected by the proxy", "counter",
+                                                  label_name="reason")
+        self.connections_closed = MetricFamily (prefix + "connections_closed_total",
+                                                "Websocket client connections closed, by close code", "counter",
+                                                label_name="code")
+        self.messages_relayed = MetricFamily (prefix + "messages_relayed_total",
+                                              "Messages relayed, by the peer classes of the sender and receiver",
+                                              "counter", label_name="direction")
+        self.bytes_relayed = MetricFamily (prefix + "bytes_relayed_total",
+                                           "Bytes relayed (characters for text messages which aren't relayed "
+                                           "as raw frames), by the peer classes of the sender and receiver",
+                                           "counter", label_name="direction")
+        self.relay_queue_dropped = MetricFamily (prefix + "relay_queue_dropped_total",
+                                                 "EVENT messages dropped from full relay queues", "counter")
+        self.events_published = MetricFamily (prefix + "events_published_total",
+                                              "EVENT messages published to event subscribers", "counter")
+        self.events_unchecked = MetricFamily (prefix + "events_unchecked_total",
+                                              "Messages relayed as fragmented raw frames, which aren't checked for "
+                                              "EVENT messages (or published to event subscribers)", "counter")
+        self.rate_limited = MetricFamily (prefix + "rate_limited_total",
+                                          "Messages from clients exceeding their rate limits, by the action taken",
+                                          "counter", label_name="action")
+        self.relay_latency = MetricFamily (prefix + "relay_latency_seconds",
+                                           "Time from a message being handed to a client to it being written "
+                                           "(including time spent in the relay queue)", "histogram",
+                                           buckets=latency_buckets_s)
+        self.ping_rtt = MetricFamily (prefix + "ping_rtt_seconds",
+                                      "Round-trip time of keepalive pings", "histogram",
+                                      buckets=latency_buckets_s)
+        self.connection_stage = MetricFamily (prefix + "connection_stage_seconds",
+                                              "Time spent in each stage of a connection (tls-handshake, upgrade, "
+                                              "hello-wait, peer-wait) and handling each message received from a "
+                                              "client (relay-recv)", "histogram",
+                                              label_name="stage", buckets=stage_buckets_s)
+        self.loop_lag = MetricFamily (prefix + "event_loop_lag_seconds",
+                                      "How late the event loop ran a timer (see loop_lag_check_interval_s)",
+                                      "histogram", buckets=latency_buckets_s)
+        self.slow_callbacks = MetricFamily (prefix + "slow_callbacks_total",
+                                            "Times the event loop was blocked for over slow_callback_threshold_s",
+                                            "counter")
+        self.compressed_messages_relayed = MetricFamily (prefix + "compressed_messages_relayed_total",
+                                                         "Compressed messages relayed without decompressing them "
+                                                         "(passed-through) or decompressed for a peer which "
+                                                         "couldn't accept them (inflated)", "counter",
+                                                         label_name="handling")
+        self.tls_handshakes = MetricFamily (prefix + "tls_handshakes_total",
+                                            "Completed TLS handshakes, by whether the session was resumed",
+                                            "counter", label_name="session")
+        self.tls_session_stats = MetricFamily (prefix + "tls_session_stats",
+                                               "OpenSSL server session statistics (see SSL_CTX_sess_number(3))",
+                                               "counter", label_name="stat")
+        self.tls_session_cache_size = MetricFamily (prefix + "tls_session_cache_size",
+                                                    "Sessions in OpenSSL's server session cache", "gauge")
+        self.tls_reloads = MetricFamily (prefix + "tls_reloads_total",
+                                         "Reloads of the proxy certificate and CA store, by result", "counter",
+                                         label_name="result")
+        self.frames_streamed = MetricFamily (prefix + "frames_streamed_total",
+                                             "Received frames over relay_max_buffered_size relayed as they arrived "
+                                             "(as fragments)", "counter")
+        self.draining = MetricFamily (prefix + "draining", "1 while the proxy is draining (see drain_window_s)", "gauge")
+        self.tls_reload_time = MetricFamily (prefix + "tls_reload_timestamp_seconds",
+                                             "Time of the last successful certificate reload (0 if never reloaded)",
+                                             "gauge")
+        self.families = [self.clients_connected, self.meetups_active, self.meetups_half_open,
+                         self.meetups_expired, self.session_holds, self.connections_rejected, self.connections_closed,
+                         self.messages_relayed, self.bytes_relayed, self.relay_queue_dropped, self.events_published,
+                         self.events_unchecked, self.rate_limited, self.relay_latency, self.ping_rtt,
+                         self.connection_stage, self.loop_lag, self.slow_callbacks, self.compressed_messages_relayed,
+                         self.frames_streamed, self.tls_handshakes, self.tls_session_stats, self.tls_session_cache_size,
+                         self.tls_reloads, self.tls_reload_time, self.draining]
+        # Functions called to update metrics which are sampled (rather than counted) before rendering
+        self.collectors = []
+
+    def render (self):
+        for collector in self.collectors:
+            collector ()
+        lines = []
+        for family in self.families:
+            lines.extend (family.render ())
+        return "\n".join (lines) + "\n"
+
+metrics = ProxyMetrics ()
+
+#
+# Compression
+#
+# permessage-deflate is negotiated with the ws_compression_* settings. Messages smaller than
+# ws_compression_min_size are sent uncompressed. When relaying raw frames, a compressed message from
+# a client which compresses every message independently (client_no_context_takeover) is relayed
+# still compressed to a peer whose messages are also compressed independently
+# (server_no_context_takeover) - so it isn't decompressed and recompressed by the proxy. If the
+# peer can't accept it (e.g. it didn't negotiate compression), the message is decompressed for it.
+#
+
+empty_deflate_block = b'\x00\x00\xff\xff'
+
+class CompressedFrame (Frame):
+    '''A data frame of a message which is still compressed with permessage-deflate
+
+       RSV1 is only set when the frame is written (since Frame.check() rejects frames with it set).'''
+    __slots__ = ()
+
+class ProxyPerMessageDeflate (PerMessageDeflate):
+    '''permessage-deflate with a minimum compressed message size and compressed frame pass-through
+
+       When pass_through_compressed is set, compressed messages are read as CompressedFrames (rather
+       than being decompressed). CompressedFrames are always written as-is.'''
+    def __init__ (self, *args, min_size=0, **kwargs):
+        super ().__init__ (*args, **kwargs)
+        self.min_size = min_size
+        self.pass_through_compressed = False
+        self.decode_passing_through = False
+        self.encode_message = False
+
+    def decode (self, frame, *, max_size=None):
+        if (frame.opcode in CTRL_OPCODES):
+            return frame
+        if (frame.opcode == OP_CONT):
+            if (self.decode_passing_through):
+                self.decode_passing_through = not frame.fin
+                return CompressedFrame (frame.fin, frame.opcode, frame.data)
+        elif (frame.rsv1 and self.pass_through_compressed):
+            self.decode_passing_through = not frame.fin
+            return CompressedFrame (frame.fin, frame.opcode, frame.data)
+        return super ().decode (frame, max_size=max_size)
+
+    def encode (self, frame):
+        if (frame.opcode in CTRL_OPCODES):
+            return frame
+        if (isinstance (frame, CompressedFrame)):
+            return frame._replace (rsv1=(frame.opcode != OP_CONT))
+        if (frame.opcode != OP_CONT):
+            # Fragmented messages are always compressed (since their size isn't known up front)
+            self.encode_message = not frame.fin or len (frame.data) >= self.min_size
+        if (not self.encode_message):
+            return frame
+        encoded_frame = super ().encode (frame)
+        # Only the first frame of a message has RSV1 set
+        return encoded_frame if frame.opcode != OP_CONT else encoded_frame._replace (rsv1=False)
+
+class ProxyPerMessageDeflateFactory (ServerPerMessageDeflateFactory):
+    def __init__ (self, *args, min_size=0, **kwargs):
+        super ().__init__ (*args, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params (self, params, accepted_extensions):
+        response_params, extension = super ().process_request_params (params, accepted_extensions)
+        return response_params, ProxyPerMessageDeflate (extension.remote_no_context_takeover,
+                                                        extension.local_no_context_takeover,
+                                                        extension.remote_max_window_bits,
+                                                        extension.local_max_window_bits,
+                                                        extension.compress_settings,
+                                                        min_size=self.min_size)
+
+def get_extension_factories ():
+    '''Return the websocket extensions to offer clients'''
+    if (ws_compression == "none"):
+        return []
+    return [ProxyPerMessageDeflateFactory (
+                server_no_context_takeover=ws_compression_no_context_takeover,
+                client_no_context_takeover=ws_compression_no_context_takeover,
+                server_max_window_bits=ws_compression_window_bits if ws_compression_window_bits < 15 else None,
+                client_max_window_bits=ws_compression_client_window_bits if ws_compression_client_window_bits < 15 else None,
+                compress_settings={'level': ws_compression_level, 'memLevel': ws_compression_mem_level},
+                min_size=ws_compression_min_size)]
+
+
+class RelayServerProtocol (websockets.WebSocketServerProtocol):
+    '''A websocket server protocol which can hand incoming data frames directly to a peer
+
+       Once relay_peer is set, data frames (including the fragments of fragmented messages) are
+       passed to relay_peer.relay_frame() as they're read - without being re-assembled or decoded
+       into str objects. Control frames are still processed by the protocol (pings are answered,
+       pongs complete ping waiters and close frames start the closing handshake).
+
+       Frames with payloads over relay_max_buffered_size are read in pieces of that size, each
+       passed on as a fragment - so a large message is streamed to the peer as it arrives, rather
+       than being buffered whole. (Pieces read before the relay is started are re-assembled.)'''
+    def __init__ (self, *args, **kwargs):
+        super ().__init__ (*args, **kwargs)
+        self.relay_peer = None
+        # The WSClient whose traffic is accounted for (once it's created)
+        self.traffic_client = None
+        # Note: The protocol is created when the TCP connection is accepted (before the TLS handshake)
+        self.accepted_time = self.loop.time ()
+        self.connected_time = None
+        self.last_frame_time = self.loop.time ()
+        self.relay_inflater = None
+        self.relay_inflate_remaining = None
+        # The first message (the HELLO) has its own size limit
+        self.first_message_max_size = hello_max_size or None
+        # The header fields, mask and unread payload length of a frame being read in pieces
+        self.piece_frame_header = None
+        self.piece_mask_bits = None
+        self.piece_remaining = 0
+
+    def get_deflate_extension (self):
+        for extension in self.extensions or ():
+            if isinstance (extension, ProxyPerMessageDeflate):
+                return extension
+        return None
+
+    def start_relay (self, relay_peer):
+        '''Start handing data frames to relay_peer'''
+        deflate = self.get_deflate_extension ()
+        if (deflate and deflate.remote_no_context_takeover
+              and deflate.remote_max_window_bits <= ws_compression_window_bits):
+            # Every message from the client can be decompressed on its own - so peers can be sent it as-is
+            deflate.pass_through_compressed = True
+        self.relay_peer = relay_peer
+
+    def accepts_compressed_frames (self):
+        '''Return True if CompressedFrames (from start_relay() peers) can be written as-is'''
+        deflate = self.get_deflate_extension ()
+        return bool (deflate and deflate.local_no_context_takeover
+                     and deflate.local_max_window_bits >= ws_compression_window_bits)
+
+    def inflate_frame (self, frame):
+        '''Decompress a CompressedFrame for a client which can't be sent it as-is'''
+        if (frame.opcode != OP_CONT):
+            self.relay_inflater = zlib.decompressobj (wbits=-15)
+            self.relay_inflate_remaining = self.max_size
+        data = frame.data + empty_deflate_block if frame.fin else frame.data
+        if (self.relay_inflate_remaining is None):
+            data = self.relay_inflater.decompress (data)
+        else:
+            data = self.relay_inflater.decompress (data, self.relay_inflate_remaining + 1)
+            self.relay_inflate_remaining -= len (data)
+            if (self.relay_inflate_remaining < 0):
+                raise PayloadTooBig (f"Uncompressed payload length exceeds size limit ({self.max_size} bytes)")
+        if (frame.fin):
+            self.relay_inflater = None
+        return Frame (frame.fin, frame.opcode, data)
+
+    def connection_made (self, transport):
+        # Note: For TLS connections this is called once the TLS handshake has completed
+        self.connected_time = self.loop.time ()
+        ssl_object = transport.get_extra_info ('ssl_object')
+        if ssl_object:
+            metrics.tls_handshakes.labels ("resumed" if ssl_object.session_reused else "full").inc ()
+            metrics.connection_stage.labels ("tls-handshake").observe (self.connected_time - self.accepted_time)
+        super ().connection_made (transport)
+
+    async def process_request (self, path, request_headers):
+        # Called with the HTTP upgrade request. Refusing the upgrade here (with an HTTP error) is
+        # much cheaper than accepting the websocket and creating a WSClient just to close it.
+        rejection = check_upgrade_request (path, self.remote_address)
+        if (not rejection):
+            return None
+        status, reason, description = rejection
+        log_rate_limited (logging.WARNING, f"process_request: %s - REFUSING upgrade from %s ({reason})",
+                          description, self.remote_address)
+        metrics.connections_rejected.labels (reason).inc ()
+        return (status, [], (description + "\n").encode ('utf-8'))
+
+    async def read_frame (self, max_size):
+        if (relay_raw_frames and relay_max_buffered_size):
+            frame = await self.read_frame_piece (max_size)
+        else:
+            frame = await super ().read_frame (max_size)
+        # Any frame received shows the client is alive (so a keepalive ping isn't needed)
+        self.last_frame_time = self.loop.time ()
+        return frame
+
+    async def read_data_frame (self, max_size):
+        while True:
+            frame = await super ().read_data_frame (max_size)
+            if (frame is None or self.traffic_client is None or await self.traffic_client.account_frame (frame)):
+                return frame
+
+    async def read_frame_piece (self, max_size):
+        '''Read a frame - or the next piece of a frame with a payload over relay_max_buffered_size
+
+           Each piece is returned as a fragment: the first has the frame's opcode (and RSV bits), and
+           only the last has the frame's FIN bit. (See Frame.read())'''
+        first_piece = not self.piece_remaining
+        if (first_piece):
+            head1, head2 = struct.unpack ('!BB', await self.reader.readexactly (2))
+            if (not head2 & 0x80):
+                raise WebSocketProtocolError ("Incorrect masking")
+            length = head2 & 0x7f
+            if (length == 126):
+                length, = struct.unpack ('!H', await self.reader.readexactly (2))
+            elif (length == 127):
+                length, = struct.unpack ('!Q', await self.reader.readexactly (8))
+            if (max_size is not None and length > max_size):
+                raise PayloadTooBig (f"Payload length exceeds size limit ({length} > {max_size} bytes)")
+            self.piece_mask_bits = await self.reader.readexactly (4)
+            self.piece_frame_header = (bool (head1 & 0x80), head1 & 0x0f,
+                                       bool (head1 & 0x40), bool (head1 & 0x20), bool (head1 & 0x10))
+            self.piece_remaining = length
+            if (length > relay_max_buffered_size and head1 & 0x0f not in CTRL_OPCODES):
+                metrics.frames_streamed.inc ()
+        fin, opcode, rsv1, rsv2, rsv3 = self.piece_frame_header
+        # Note: Control frames can't be fragmented (and have at most 125 bytes of payload)
+        size = self.piece_remaining if opcode in CTRL_OPCODES else min (self.piece_remaining, relay_max_buffered_size)
+        data = apply_mask (await self.reader.readexactly (size), self.piece_mask_bits)
+        self.piece_remaining -= size
+        if (self.piece_remaining):
+            # The next piece starts part way through the 4-byte mask
+            offset = size % 4
+            self.piece_mask_bits = self.piece_mask_bits [offset:] + self.piece_mask_bits [:offset]
+            fin = False
+        if (first_piece):
+            frame = Frame (fin, opcode, data, rsv1, rsv2, rsv3)
+        else:
+            frame = Frame (fin, OP_CONT, data)
+        for extension in reversed (self.extensions):
+            frame = extension.decode (frame, max_size=max_size)
+        frame.check ()
+        return frame
+
+    def send_ping (self):
+        '''Send a ping without waiting for the write buffer to drain, returning the pong waiter
+
+           Returns None if the connection isn't open.'''
+        if self.state is not State.OPEN:
+            return None
+        data = struct.pack ('!I', random.getrandbits (32))
+        while data in self.pings:
+            data = struct.pack ('!I', random.getrandbits (32))
+        pong_waiter = asyncio.Future (loop=self.loop)
+        self.pings [data] = pong_waiter
+        Frame (True, OP_PING, data).write (self.writer.write, mask=self.is_client, extensions=self.extensions)
+        return pong_waiter
+
+    async def read_message (self):
+        while True:
+            max_size = self.max_size
+            if (self.first_message_max_size):
+                max_size = min (self.first_message_max_size, max_size or self.first_message_max_size)
+                self.first_message_max_size = None
+            frame = await self.read_data_frame (max_size=max_size)
+            # A close frame was received.
+            if frame is None:
+                return None
+            if frame.opcode != OP_TEXT and frame.opcode != OP_BINARY:
+                raise WebSocketProtocolError ("Unexpected opcode")
+            if self.relay_peer:
+                await self.relay_frames (frame)
+                continue
+            message = await self.assemble_message (frame, max_size)
+            if self.relay_peer:
+                # The relay was started while the message was being assembled
+                try:
+                    await self.relay_peer.send_message (message)
+                except websockets.ConnectionClosed:
+                    logger.debug ("read_message: the peer of %s closed - DROPPING message", self.remote_address)
+                continue
+            return message
+
+    async def relay_frames (self, frame):
+        relay_peer = self.relay_peer
+        max_size = self.max_size
+        while True:
+            try:
+                await relay_peer.relay_frame (frame)
+            except websockets.ConnectionClosed:
+                # The peer will close this side once it's done cleaning up
+                logger.debug ("relay_frames: the peer of %s closed - DROPPING frame", self.remote_address)
+            if frame.fin:
+                return
+            if max_size is not None:
+                max_size -= len (frame.data)
+            frame = await self.read_data_frame (max_size=max_size)
+            if frame is None:
+                raise WebSocketProtocolError ("Incomplete fragmented message")
+            if frame.opcode != OP_CONT:
+                raise WebSocketProtocolError ("Unexpected opcode")
 
+    async def assemble_message (self, frame, max_size):
+        text = (frame.opcode == OP_TEXT)
+        # Shortcut for the common case - no fragmentation
+        if frame.fin:
+            return frame.data.decode ('utf-8') if text else frame.data
+        decoder = codecs.getincrementaldecoder ('utf-8') (errors='strict') if text else None
+        chunks = []
+        while True:
+            chunks.append (decoder.decode (frame.data, frame.fin) if text else frame.data)
+            if frame.fin:
+                return ('' if text else b'').join (chunks)
+            if max_size is not None:
+                max_size -= len (frame.data)
+            frame = await self.read_data_frame (max_size=max_size)
+            if frame is None:
+                raise WebSocketProtocolError ("Incomplete fragmented message")
+            if frame.opcode != OP_CONT:
+                raise WebSocketProtocolError ("Unexpected opcode")
+
+    async def write_data_frame (self, frame):
+        '''Write a data frame as-is (preserving the FIN bit and opcode of fragments)'''
+        await self.ensure_open ()
+        frame.write (self.writer.write, mask=self.is_client, extensions=self.extensions)
+        try:
+            # See WebSocketCommonProtocol.write_frame()
+            async with self._drain_lock:
+                await self.writer.drain ()
+        except ConnectionError:
+            self.fail_connection ()
+            await self.ensure_open ()
+
+event_message_re = re.compile (r'"messageType"\s*:\s*"EVENT:')
+event_message_bytes_re = re.compile (event_message_re.pattern.encode ())
+
+def is_event_message (item):
+    '''Determine if a relayed message or (unfragmented) frame contains an EVENT message - without parsing it'''
+    if isinstance (item, str):
+        return event_message_re.search (item) is not None
+    if isinstance (item, Frame):
+        return item.fin and item.opcode == OP_TEXT and event_message_bytes_re.search (item.data) is not None
+    return False
+
+class RelayQueueOverflow (Exception):
+    pass
+
+class RelayQueue:
+    '''A bounded queue of messages (or raw frames) waiting to be written to a client
+
+       When adding a message would exceed the message or byte limit, the policy determines what
+       happens: "block" waits until the writer catches up, "drop-oldest-event" discards the oldest
+       queued EVENT messages (blocking if there are none) and "close" raises RelayQueueOverflow.'''
+    def __init__ (self, max_messages, max_bytes, policy):
+        self.items = collections.deque ()
+        self.byte_count = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped_count = 0
+        self.not_empty = asyncio.Event ()
+        self.not_full = asyncio.Event ()
+        self.not_full.set ()
+        self.closed_exception = None
+
+    def __len__ (self):
+        return len (self.items)
+
+    def __str__ (self):
+        return f"{len (self.items)} messages/{self.byte_count} bytes queued, {self.dropped_count} dropped"
+
+    def would_overflow (self, size):
+        # A message is always accepted by an empty queue (even if it's larger than max_bytes)
+        if not self.items:
+            return False
+        return (len (self.items) >= self.max_messages
+                or (self.max_bytes and self.byte_count + size > self.max_bytes))
+
+    async def put (self, item):
+        size = len (item.data) if isinstance (item, Frame) else len (item)
+        while self.would_overflow (size):
+            if self.closed_exception:
+                raise self.closed_exception
+            if self.policy == "drop-oldest-event" and self.drop_oldest_event ():
+                continue
+            if self.policy == "close":
+                raise RelayQueueOverflow (f"relay queue overflow ({self})")
+            self.not_full.clear ()
+            await self.not_full.wait ()
+        if self.closed_exception:
+            raise self.closed_exception
+        self.items.append ((item, size, asyncio.get_event_loop ().time ()))
+        self.byte_count += size
+        self.not_empty.set ()
+
+    def put_nowait (self, item):
+        '''Add the item without waiting, dropping the oldest EVENT messages to make room
+
+           Returns False if there wasn't room for the item.'''
+        size = len (item.data) if isinstance (item, Frame) else len (item)
+        while self.would_overflow (size):
+            if not self.drop_oldest_event ():
+                return False
+        if self.closed_exception:
+            return False
+        self.items.append ((item, size, asyncio.get_event_loop ().time ()))
+        self.byte_count += size
+        self.not_empty.set ()
+        return True
+
+    def drop_oldest_event (self):
+        for index, (item, size, queued_time) in enumerate (self.items):
+            if is_event_message (item):
+                del self.items [index]
+                self.byte_count -= size
+                self.dropped_count += 1
+                metrics.relay_queue_dropped.inc ()
+                return True
+        return False
+
+    async def get (self):
+        '''Return the next item and the (event loop) time it was queued'''
+        while not self.items:
+            self.not_empty.clear ()
+            await self.not_empty.wait ()
+        item, size, queued_time = self.items.popleft ()
+        self.byte_count -= size
+        self.not_full.set ()
+        return item, queued_time
+
+    def close (self, exception):
+        self.closed_exception = exception
+        self.items.clear ()
+        self.byte_count = 0
+        # Wake up anyone blocked on the queue
+        self.not_full.set ()
+
+class KeepaliveScheduler:
+    '''Sends keepalive pings and tracks pong deadlines for all clients from a single timer
+
+       Clients are kept in a timer wheel with slots keepalive_tick_s wide. When a client's slot
+       comes up it's either pinged (and rescheduled for its pong deadline), checked for a pong
+       (and timed out if there wasn't one) or - if a frame was received from the client within
+       its ping interval - just rescheduled. The timer only runs while clients are scheduled.'''
+    def __init__ (self, tick_s, wheel_size=64):
+        self.tick_s = tick_s
+        self.wheel = [set () for i in range (wheel_size)]
+        self.cursor = 0
+        self.client_count = 0
+        self.next_tick_time = None
+        self.timer = None
+
+    def add (self, client):
+        self.remove (client)
+        client.pong_waiter = None
+        self.schedule (client, client.ping_interval_s)
+
+    def remove (self, client):
+        slot = getattr (client, 'keepalive_slot', None)
+        if slot is not None:
+            self.wheel [slot].discard (client)
+            client.keepalive_slot = None
+            self.client_count -= 1
+        # Note: Pong waiters are owned by the websocket protocol, so they're dropped - not cancelled
+        client.pong_waiter = None
+
+    def schedule (self, client, delay_s):
+        loop = asyncio.get_event_loop ()
+        if not self.timer:
+            self.next_tick_time = loop.time () + self.tick_s
+            self.timer = loop.call_at (self.next_tick_time, self.run_ticks)
+        # Note: The slot at the cursor is the one serviced at next_tick_time
+        ticks = max (0, math.ceil ((loop.time () + delay_s - self.next_tick_time) / self.tick_s))
+        client.keepalive_slot = (self.cursor + ticks) % len (self.wheel)
+        client.keepalive_rounds = ticks // len (self.wheel)
+        self.wheel [client.keepalive_slot].add (client)
+        self.client_count += 1
+
+    def run_ticks (self):
+        loop = asyncio.get_event_loop ()
+        now = loop.time ()
+        # Catch up on any ticks missed while the event loop was busy
+        while self.next_tick_time <= now:
+            slot = self.wheel [self.cursor]
+            due_clients = []
+            for client in slot:
+                if client.keepalive_rounds > 0:
+                    client.keepalive_rounds -= 1
+                else:
+                    due_clients.append (client)
+            for client in due_clients:
+                slot.discard (client)
+                client.keepalive_slot = None
+                self.client_count -= 1
+            self.cursor = (self.cursor + 1) % len (self.wheel)
+            self.next_tick_time += self.tick_s
+            for client in due_clients:
+                self.service (client, now)
+        if self.client_count > 0:
+            self.timer = loop.call_at (self.next_tick_time, self.run_ticks)
+        else:
+            self.timer = None
+
+    def service (self, client, now):
+        pong_waiter = client.pong_waiter
+        if pong_waiter:
+            if not pong_waiter.done ():
+                deadline = client.ping_send_time + client.ping_timeout_s
+                if now < deadline:
+                    self.schedule (client, deadline - now)
+                else:
+                    client.pong_waiter = None
+                    client.keepalive_timed_out ()
+                return
+            client.pong_waiter = None
+            next_ping_time = client.ping_send_time + client.ping_interval_s
+            if next_ping_time > now:
+                self.schedule (client, next_ping_time - now)
+                return
+        idle_time = now - client.websocket.last_frame_time
+        if idle_time < client.ping_interval_s:
+            # The client has sent something recently - no need to ping it
+            self.schedule (client, client.ping_interval_s - idle_time)
+            return
+        pong_waiter = client.websocket.send_ping ()
+        if not pong_waiter:
+            return
+        logger.debug ("ws_client %s: keepalive: Sent ping", id (client))
+        client.pong_waiter = pong_waiter
+        client.ping_send_time = now
+        pong_waiter.add_done_callback (client.pong_received)
+        self.schedule (client, client.ping_timeout_s)
+
+keepalive_scheduler = KeepaliveScheduler (keepalive_tick_s)
+
+#
+# Message parsing and validation
+#
+# Messages the proxy has to understand (currently just the CONN:HELLO message) are validated against
+# a MessageSchema, which is compiled once into per-field type checks. They're parsed with json_loads,
+# which is set from json_backend when the configuration is loaded (orjson and ujson are optional).
+#
+
+json_loads = json.loads
+
+def get_json_loads (backend):
+    '''Return the loads function of the JSON backend (raising ImportError if it isn't installed)'''
+    if (backend == "auto"):
+        for module_name in ("orjson", "ujson"):
+            try:
+                return get_json_loads (module_name)
+            except ImportError:
+                pass
+        return json.loads
+    if (backend == "json"):
+        return json.loads
+    return importlib.import_module (backend).loads
+
+#
+# Event loop
+#
+# The proxy runs on the asyncio event loop or on uvloop (which is optional), which cuts the
+# per-connection and per-message overhead of the loop and its transports. The event loop is
+# selected by event_loop when the configuration is loaded (before the loop is created).
+#
+
+event_loop_in_use = "asyncio"
+
+def install_event_loop (backend):
+    '''Install the event loop policy for the backend, returning the backend used (raising ImportError
+       if it isn't installed)'''
+    if (backend == "asyncio"):
+        return backend
+    try:
+        uvloop = importlib.import_module ("uvloop")
+    except ImportError:
+        if (backend == "auto"):
+            return "asyncio"
+        raise
+    asyncio.set_event_loop_policy (uvloop.EventLoopPolicy ())
+    return "uvloop"
+
+class MessageValidationError (Exception):
+    pass
+
+class MessageSchema:
+    '''The required/optional fields of the object in the "message" field of a message, and their types
+
+       fields is a dict of field name: (type, required) - where the type can also be a list of the
+       allowed (str) values of the field.'''
+    def __init__ (self, message_type, fields):
+        self.message_type = message_type
+        self.required_fields = frozenset (name for name, (field_type, required) in fields.items () if required)
+        self.field_checks = []
+        for name, (field_type, required) in fields.items ():
+            if isinstance (field_type, list):
+                self.field_checks.append ((name, str, frozenset (field_type)))
+            else:
+                self.field_checks.append ((name, field_type, None))
+
+    def parse (self, raw_message):
+        '''Parse and validate the raw message, returning the parsed message'''
+        try:
+            message = json_loads (raw_message)
+        except ValueError as ve:
+            raise MessageValidationError (f"{self.message_type} message is not valid JSON ({ve})")
+        if (not isinstance (message, dict) or not isinstance (message.get ('message'), dict)):
+            raise MessageValidationError (f"{self.message_type} message doesn't contain a 'message' object")
+        self.validate (message ['message'])
+        return message
+
+    def validate (self, message_fields):
+        missing_fields = self.required_fields.difference (message_fields)
+        if (missing_fields):
+            raise MessageValidationError (f"{self.message_type} message doesn't contain the field(s) "
+                                          f"{', '.join (sorted (missing_fields))}")
+        for name, field_type, allowed_values in self.field_checks:
+            if (name not in message_fields):
+                continue
+            value = message_fields [name]
+            # Note: bool is a subclass of int - but true/false isn't a valid messageId
+            if (not isinstance (value, field_type) or (field_type is int and isinstance (value, bool))):
+                raise MessageValidationError (f"{self.message_type} message field '{name}' "
+                                              f"isn't of type {field_type.__name__}")
+            if (allowed_values is not None and value not in allowed_values):
+                raise MessageValidationError (f"{self.message_type} message field '{name}' "
+                                              f"is not one of {', '.join (sorted (allowed_values))}")
+
+hello_schema = MessageSchema ("CONN:HELLO", {
+    'messageId': (int, True),
+    'messageType': (["CONN:HELLO"], True),
+    'requiresResponse': (bool, True),
+    'peerClass': (str, False),
+    'peerId': (str, False)
+})
+
+#
+# Traffic accounting
+#
+# The data frames received from each client are counted (messages, bytes, the largest frame and
+# the time of the last frame) - for the client and for its meetup. When rate_limit_messages_per_s
+# and/or rate_limit_bytes_per_s are set, each client's traffic is limited by token buckets (which
+# allow bursts of rate_limit_burst_s worth of traffic). What happens to a client exceeding its
+# limits is set by rate_limit_action: "delay" stops reading from the client until it's back within
+# its limits (so TCP flow control pushes back on the client), "drop" drops its messages and "close"
+# closes its websocket (with close code 1008). Router clients aren't rate limited.
+#
+
+class TrafficAccount:
+    '''The traffic received from a client (or from the clients of a meetup)'''
+    __slots__ = ('messages', 'bytes', 'max_frame_size', 'last_activity_time')
+
+    def __init__ (self):
+        self.messages = 0
+        self.bytes = 0
+        self.max_frame_size = 0
+        self.last_activity_time = None
+
+    def __str__ (self):
+        if (self.last_activity_time is None):
+            activity = "no activity"
+        else:
+            activity = f"last active {asyncio.get_event_loop ().time () - self.last_activity_time:.1f} seconds ago"
+        return f"{self.messages} messages, {self.bytes} bytes (largest frame: {self.max_frame_size} bytes), {activity}"
+
+    def record (self, size, message_complete, now):
+        if (message_complete):
+            self.messages += 1
+        self.bytes += size
+        if (size > self.max_frame_size):
+            self.max_frame_size = size
+        self.last_activity_time = now
+
+class TokenBucket:
+    '''A token bucket refilled with rate tokens per second, holding up to burst tokens'''
+    __slots__ = ('rate', 'burst', 'tokens', 'update_time')
+
+    def __init__ (self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.update_time = now
+
+    def take (self, amount, now):
+        '''Take the tokens, returning the seconds until the bucket is out of debt (0 if there were enough)'''
+        self.tokens = min (self.burst, self.tokens + (now - self.update_time) * self.rate)
+        self.update_time = now
+        self.tokens -= amount
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def give_back (self, amount):
+        self.tokens += amount
+
+def create_token_bucket (rate, now):
+    '''Return a bucket for the rate limit (None if the rate isn't limited)'''
+    if (not rate):
+        return None
+    # A burst has to allow at least one message/byte through
+    return TokenBucket (rate, max (rate * rate_limit_burst_s, 1), now)
 
 class WSClient:
     def __init__ (self, meetup_id, websocket, hello_message=None, peer_client=None, 
@@ -34,40 +1074,68 @@ class WSClient:
         self.websocket = websocket
         self.peer_arrival_future = asyncio.Future ()
         self.ping_timeout_future = asyncio.Future ()
-        self.ping_task = None
         self.ping_interval_s = ping_interval_s
         self.ping_timeout_s = ping_timeout_s
+        self.keepalive_slot = None
+        self.pong_waiter = None
+        self.ping_send_time = None
+        self.ping_rtt_s = None
         self.hello_message = hello_message
+        self.hello_raw = None
         self.peer_client = peer_client
+        self.relay_queue = None
+        self.relay_queue_task = None
+        self.relay_direction = None
+        self.relayed_message_count = 0
+        # Requests relayed to the peer which haven't been answered (only tracked when resuming sessions)
+        self.unanswered_requests = collections.OrderedDict ()
+        # Messages for the peer while it's disconnected (not None while the client's session is held)
+        self.resume_buffer = None
+        self.resume_handle = None
+        self.log_fields = {'meetupId': meetup_id, 'clientId': id (self)}
+        self.traffic = TrafficAccount ()
+        self.meetup_traffic = None
+        now = asyncio.get_event_loop ().time ()
+        self.message_bucket = create_token_bucket (rate_limit_messages_per_s, now)
+        self.byte_bucket = create_token_bucket (rate_limit_bytes_per_s, now)
+        self.dropping_message = False
+        self.rate_limit_closing = False
+        if relay_queue_max_messages:
+            self.relay_queue = RelayQueue (relay_queue_max_messages, relay_queue_max_bytes, relay_queue_policy)
+        metrics.clients_connected.inc ()
+        websocket.traffic_client = self
+        websocket.connection_lost_waiter.add_done_callback (self.connection_lost)
         self.start_pings ()
 
     def __str__ (self):
         if self.hello_message and 'message' in self.hello_message and 'peerId' in self.hello_message['message']:
-            # TODO: REMOVE ME
-            logger.info (f"message: {self.hello_message}")
             peer_id = self.hello_message ['message']['peerId']
         else:
             peer_id = "none"
         return f"Client {id (self)} (peer: {peer_id}) @ {self.websocket.remote_address})"
 
     async def recv_hello_message (self):
-        raw_message = await self.websocket.recv ()
-        message = json.loads (raw_message)
-        if (not message):
-            raise Exception (f"message does not appear to be json")
-        hello_message = check_json_field (message, 'message', dict, True)
-        message_id = check_json_field (hello_message, 'messageId', int, True)
-        message_type = hello_message ['messageType']
-        requires_response = check_json_field (hello_message, 'requiresResponse', bool, True)
-        if (not message_type == "CONN:HELLO"):
-            raise Exception (f"message does not appear to be a CONN:HELLO message (found {message_type})")
-        self.hello_message = message
+        start_time = asyncio.get_event_loop ().time ()
+        try:
+            raw_message = await asyncio.wait_for (self.websocket.recv (), hello_timeout_s or None)
+        except asyncio.TimeoutError:
+            metrics.connections_rejected.labels ("hello-timeout").inc ()
+            raise Exception (f"no HELLO message was received within {hello_timeout_s} seconds")
+        try:
+            self.hello_message = hello_schema.parse (raw_message)
+        except MessageValidationError:
+            metrics.connections_rejected.labels ("invalid-hello").inc ()
+            raise
+        # The HELLO is relayed to the peer as it was received
+        self.hello_raw = raw_message
+        metrics.connection_stage.labels ("hello-wait").observe (asyncio.get_event_loop ().time () - start_time)
         return self.hello_message
 
     async def get_hello_message (self):
         return self.hello_message
     
     async def wait_for_peer (self):
+        start_time = asyncio.get_event_loop ().time ()
         recv_task = asyncio.get_event_loop ().create_task (self.websocket.recv ())
         logger.info (f"ws_client {id (self)}: wait_for_peer: waiting for peer on {self.meetup_id}...")
         # We need to have a call to recv() in order to know if the socket closes while we're waiting
@@ -84,47 +1152,47 @@ class WSClient:
             raise Exception (f"Client {id (self)} failed/recv-ed data before a peer could attach to {self.meetup_id}")
         self.peer_client = self.peer_arrival_future.result ()
         self.peer_arrival_future = None
+        metrics.connection_stage.labels ("peer-wait").observe (asyncio.get_event_loop ().time () - start_time)
         return self.peer_client
 
     def set_peer (self, peer):
         if (self.peer_arrival_future):
             self.peer_arrival_future.set_result (peer)
         self.peer_client = peer
+        if (self.resume_handle):
+            # The peer reconnected within the grace period
+            self.resume_handle.cancel ()
+            self.resume_handle = None
+            metrics.session_holds.labels ("resumed").inc ()
+            asyncio.ensure_future (self.resume_session (peer))
 
     def start_pings (self):
+        if (not self.ping_interval_s or self.ping_interval_s <= 0):
+            return
         logger.debug (f"ws_client {id (self)}: Starting pings every {self.ping_interval_s} seconds ({self.ping_timeout_s} timout)")
-        self.stop_pings ()
-        self.ping_task = asyncio.get_event_loop ().create_task (self.ping_peer ())
+        keepalive_scheduler.add (self)
 
     def stop_pings (self):
-        if (self.ping_task):
+        if (self.keepalive_slot is not None):
             logger.debug (f"ws_client {id (self)}: Stopping pings")
-            self.ping_task.cancel ()
-            self.ping_task = None
-
-    async def ping_peer (self):
-        while (self.ping_interval_s and self.ping_interval_s > 0):
-            ping_send_time = asyncio.get_event_loop ().time ()
-            logger.debug (f"ws_client {id (self)}: ping_peer: Sending ping...")
-            pong_waiter = await (self.websocket.ping ())
-            logger.debug (f"ws_client {id (self)}: ping_peer: Waiting for pong...")
-            done, pending = await asyncio.wait ([pong_waiter], timeout=self.ping_timeout_s)
-            if (not pong_waiter in done):
-                logger.warning (f"ws_client {id (self)}: ping_peer: ping timeout - DISCONNECTING")
-                pong_waiter.cancel ()
-                close_reason = f"Ping timed out ({self.ping_timeout_s} seconds)"
-                if self.ping_timeout_future:
-                    self.ping_timeout_future.set_result (close_reason)
-                await self.close_websocket (1002, close_reason)
-                return
-            pong_received_time = asyncio.get_event_loop ().time ()
-            logger.debug (f"ws_client {id (self)}: ping_peer: pong received after {pong_received_time-ping_send_time}")
-            wait_time = ping_send_time + self.ping_interval_s - pong_received_time
-            logger.debug (f"ws_client {id (self)}: ping_peer: Sending next ping in {wait_time} seconds...")
-            await asyncio.sleep (wait_time)
+        keepalive_scheduler.remove (self)
+
+    def pong_received (self, pong_waiter):
+        if (pong_waiter.cancelled () or pong_waiter is not self.pong_waiter):
+            return
+        self.ping_rtt_s = asyncio.get_event_loop ().time () - self.ping_send_time
+        metrics.ping_rtt.observe (self.ping_rtt_s)
+        logger.debug ("ws_client %s: pong_received: pong received after %s", id (self), self.ping_rtt_s)
+
+    def keepalive_timed_out (self):
+        logger.warning (f"ws_client {id (self)}: keepalive_timed_out: ping timeout - DISCONNECTING")
+        close_reason = f"Ping timed out ({self.ping_timeout_s} seconds)"
+        if self.ping_timeout_future and not self.ping_timeout_future.done ():
+            self.ping_timeout_future.set_result (close_reason)
+        asyncio.ensure_future (self.close_websocket (1002, close_reason))
 
     async def communicate_with_peer (self):
-        relay_task = self.relay_messages_to_peer ()
+        relay_task = asyncio.ensure_future (self.relay_messages_to_peer ())
         done, pending = await asyncio.wait ([self.ping_timeout_future, relay_task],
                                             return_when=asyncio.FIRST_COMPLETED)
         if relay_task in done:
@@ -147,20 +1215,239 @@ class WSClient:
 
     async def relay_messages_to_peer (self):
         try:
-            logger.debug (f"ws_client {id (self)}: relay_messages_to_peer: sending cached hello to client {id (self.peer_client)}")
-            logger.debug ("        %s", self.hello_message)
-            await self.peer_client.send_message (json.dumps (self.hello_message))
+            logger.debug ("ws_client %s: relay_messages_to_peer: sending cached hello to client %s: %s",
+                          id (self), id (self.peer_client), self.hello_message, extra=self.log_fields)
+            await self.peer_client.send_message (self.hello_raw)
             logger.info (f"ws_client {id (self)}: relay_messages_to_peer: Routing all messages to {id (self.peer_client)}")
+            # Messages to a router client are routed individually, so they can't be relayed as frames
+            if relay_raw_frames and not isinstance (self.peer_client, RouterChannel):
+                await self.start_frame_relay ()
+            loop = asyncio.get_event_loop ()
+            relay_recv_metric = metrics.connection_stage.labels ("relay-recv")
             while True:
+                # Note: When relaying raw frames this only returns when the connection closes
                 message = await self.websocket.recv ()
-                logger.info (f"ws_client {id (self)}: relay_messages_to_peer: Copying message to client {id (self.peer_client)}")
-                logger.debug (message)
-                await self.peer_client.send_message (message)
+                start_time = loop.time ()
+                if relay_log_sample_rate:
+                    self.log_relayed_message (message)
+                if event_broker.subscription_count:
+                    event_broker.publish (self, message)
+                if session_resume_grace_s:
+                    self.track_request (message)
+                await self.relay_to_peer (message)
+                relay_recv_metric.observe (loop.time () - start_time)
         finally:
             logger.info(f"ws_client {id (self)}: relay_messages_to_peer: terminating")
 
+    async def relay_to_peer (self, message):
+        if (self.resume_buffer is None):
+            try:
+                await self.peer_client.send_message (message)
+                return
+            except websockets.ConnectionClosed:
+                # The peer may have disconnected (and this client been held) while the message was queued
+                if (self.resume_buffer is None):
+                    raise
+        self.resume_buffer.append (message)
+
+    def track_request (self, message):
+        '''Track the requests relayed to the peer until they're answered (so they can be replayed to a reconnecting peer)'''
+        try:
+            message_fields = json_loads (message) ['message']
+            message_id = message_fields.get ('messageId')
+            in_response_to = message_fields.get ('inResponseTo')
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return
+        if (message_fields.get ('requiresResponse') is True and isinstance (message_id, (str, int))):
+            self.unanswered_requests [message_id] = message
+            if (len (self.unanswered_requests) > session_resume_max_messages):
+                self.unanswered_requests.popitem (last=False)
+        if (isinstance (in_response_to, (str, int))):
+            peer_requests = getattr (self.peer_client, 'unanswered_requests', None)
+            if (peer_requests):
+                peer_requests.pop (in_response_to, None)
+
+    def can_hold_for (self, peer):
+        '''Determine if the client can be held (rather than closed) until the peer reconnects'''
+        if (not session_resume_grace_s or not isinstance (peer, WSClient) or not self.websocket.open):
+            return False
+        if (peer.websocket.close_code == 1000):
+            # The peer closed its websocket normally - so it's not expected to reconnect
+            return False
+        meetup = meetup_registry.get (self.meetup_id)
+        return meetup is not None and meetup.first_client is self and meetup.second_client is None
+
+    def hold_for_peer (self, peer):
+        # Messages still queued for the peer were never delivered. (The peer's queue writer has been
+        # cancelled - but the queue is only cleared once the cancellation is processed.)
+        undelivered = [item for item, size, queued_time in (peer.relay_queue.items if peer.relay_queue else ())
+                       if item is not self.hello_raw]
+        undelivered_ids = {id (item) for item in undelivered}
+        unanswered = [message for message in self.unanswered_requests.values () if id (message) not in undelivered_ids]
+        self.resume_buffer = collections.deque (unanswered + undelivered + list (self.resume_buffer or ()),
+                                                maxlen=session_resume_max_messages)
+        if (self.resume_handle):
+            self.resume_handle.cancel ()
+        self.resume_handle = asyncio.get_event_loop ().call_later (session_resume_grace_s, self.resume_expired)
+        logger.info (f"ws_client {id (self)}: hold_for_peer: peer {id (peer)} disconnected - holding for "
+                     f"{session_resume_grace_s} seconds ({len (self.resume_buffer)} messages to replay)")
+
+    def resume_expired (self):
+        self.resume_handle = None
+        metrics.session_holds.labels ("expired").inc ()
+        close_reason = f"the peer websocket didn't reconnect within {session_resume_grace_s} seconds"
+        logger.info (f"ws_client {id (self)}: resume_expired: {close_reason} - CLOSING")
+        asyncio.ensure_future (self.close_websocket (1002, close_reason))
+
+    async def resume_session (self, peer):
+        '''Send the reconnected peer this client's HELLO and the messages held for it'''
+        logger.info (f"ws_client {id (self)}: resume_session: replaying {len (self.resume_buffer)} messages "
+                     f"to client {id (peer)}")
+        try:
+            await peer.send_message (self.hello_raw)
+            # Messages relayed while replaying are appended to the buffer - so they're sent in order
+            while self.resume_buffer and peer is self.peer_client:
+                await peer.send_message (self.resume_buffer [0])
+                self.resume_buffer.popleft ()
+            if (peer is self.peer_client):
+                self.resume_buffer = None
+        except websockets.ConnectionClosed:
+            # The buffer is kept if the peer is held again
+            logger.info (f"ws_client {id (self)}: resume_session: client {id (peer)} disconnected")
+
+    def log_relayed_message (self, message):
+        self.relayed_message_count += 1
+        if (self.relayed_message_count % relay_log_sample_rate == 0 and logger.isEnabledFor (logging.DEBUG)):
+            log_fields = dict (self.log_fields, peerClientId=id (self.peer_client), size=len (message))
+            logger.debug ("ws_client %s: relay_messages_to_peer: Copied message %s to client %s: %.200r",
+                          id (self), self.relayed_message_count, id (self.peer_client), message, extra=log_fields)
+
+    async def start_frame_relay (self):
+        # Messages which were queued before the relay was started need to be sent first
+        while True:
+            try:
+                message = self.websocket.messages.get_nowait ()
+            except asyncio.QueueEmpty:
+                break
+            await self.peer_client.send_message (message)
+        # Nothing can be queued between the check above and here (there's no await)
+        logger.info (f"ws_client {id (self)}: start_frame_relay: Relaying frames to {id (self.peer_client)}")
+        self.websocket.start_relay (self.peer_client)
+
+    def connection_lost (self, connection_lost_waiter):
+        metrics.clients_connected.dec ()
+        metrics.connections_closed.labels (str (self.websocket.close_code)).inc ()
+
+    async def account_frame (self, frame):
+        '''Count a data frame received from the client and apply its rate limits, returning False if the
+           frame has to be dropped'''
+        if (self.rate_limit_closing):
+            return False
+        now = asyncio.get_event_loop ().time ()
+        size = len (frame.data)
+        self.traffic.record (size, frame.fin, now)
+        if (self.meetup_traffic):
+            self.meetup_traffic.record (size, frame.fin, now)
+        if (frame.opcode == OP_CONT and self.dropping_message):
+            self.dropping_message = not frame.fin
+            return False
+        wait_s = 0
+        if (self.message_bucket and frame.opcode != OP_CONT):
+            wait_s = self.message_bucket.take (1, now)
+        if (self.byte_bucket):
+            wait_s = max (wait_s, self.byte_bucket.take (size, now))
+        if (not wait_s):
+            return True
+        # Note: The rest of a message that was let through is only ever delayed (when relaying raw
+        #       frames, its first fragments have already been relayed)
+        if (rate_limit_action == "delay" or frame.opcode == OP_CONT):
+            if (frame.opcode != OP_CONT):
+                metrics.rate_limited.labels ("delayed").inc ()
+            await asyncio.sleep (wait_s)
+            return True
+        # Dropped messages don't use up the client's tokens
+        if (self.message_bucket):
+            self.message_bucket.give_back (1)
+        if (self.byte_bucket):
+            self.byte_bucket.give_back (size)
+        self.dropping_message = not frame.fin
+        if (rate_limit_action == "drop"):
+            metrics.rate_limited.labels ("dropped").inc ()
+            log_rate_limited (logging.WARNING, "ws_client %s: account_frame: Client exceeded its rate limits - "
+                              "DROPPING message", id (self))
+            return False
+        metrics.rate_limited.labels ("closed").inc ()
+        logger.warning (f"ws_client {id (self)}: account_frame: Client exceeded its rate limits - CLOSING")
+        self.rate_limit_closing = True
+        # Note: The websocket can't be closed (and wait for the closing handshake) from its reader
+        asyncio.ensure_future (self.close_websocket (1008, "rate limit exceeded"))
+        return False
+
+    def count_relayed (self, size, message_complete):
+        # The direction is fixed once the peer is known, so the label lookup is only done once
+        if (not self.relay_direction):
+            self.relay_direction = f"{get_peer_class (self.peer_client)}-to-{get_peer_class (self)}"
+            self.relayed_messages_metric = metrics.messages_relayed.labels (self.relay_direction)
+            self.relayed_bytes_metric = metrics.bytes_relayed.labels (self.relay_direction)
+        if (message_complete):
+            self.relayed_messages_metric.inc ()
+        self.relayed_bytes_metric.inc (size)
+
+    async def relay_frame (self, frame):
+        self.count_relayed (len (frame.data), frame.fin)
+        if (event_broker.subscription_count):
+            event_broker.publish (self.peer_client, frame)
+        if isinstance (frame, CompressedFrame):
+            accepted = self.websocket.accepts_compressed_frames ()
+            if (frame.opcode != OP_CONT):
+                metrics.compressed_messages_relayed.labels ("passed-through" if accepted else "inflated").inc ()
+            if (not accepted):
+                frame = self.websocket.inflate_frame (frame)
+        if self.relay_queue is not None:
+            await self.queue_for_relay (frame)
+        else:
+            start_time = asyncio.get_event_loop ().time ()
+            await self.websocket.write_data_frame (frame)
+            if (frame.fin):
+                metrics.relay_latency.observe (asyncio.get_event_loop ().time () - start_time)
+
+    async def queue_for_relay (self, item):
+        if (not self.relay_queue_task):
+            self.relay_queue_task = asyncio.get_event_loop ().create_task (self.write_queued_messages ())
+        try:
+            await self.relay_queue.put (item)
+        except RelayQueueOverflow as rqo:
+            logger.warning (f"ws_client {id (self)}: queue_for_relay: {rqo} - CLOSING")
+            close_reason = "relay queue overflow"
+            self.relay_queue.close (websockets.ConnectionClosed (relay_queue_close_code, close_reason))
+            asyncio.ensure_future (self.close_websocket (relay_queue_close_code, close_reason))
+            raise self.relay_queue.closed_exception
+
+    async def write_queued_messages (self):
+        try:
+            while True:
+                item, queued_time = await self.relay_queue.get ()
+                if isinstance (item, Frame):
+                    await self.websocket.write_data_frame (item)
+                    if (not item.fin):
+                        continue
+                else:
+                    await self.websocket.send (item)
+                metrics.relay_latency.observe (asyncio.get_event_loop ().time () - queued_time)
+        except websockets.ConnectionClosed as cce:
+            self.relay_queue.close (cce)
+        except asyncio.CancelledError:
+            self.relay_queue.close (websockets.ConnectionClosed (1001, "the relay queue was shut down"))
+            raise
+
     def cleanup_before_close (self):
         self.stop_pings ()
+        if (self.resume_handle):
+            self.resume_handle.cancel ()
+            self.resume_handle = None
+        if (self.relay_queue_task):
+            self.relay_queue_task.cancel ()
+            self.relay_queue_task = None
 
     async def close_websocket (self, reasonCode, reasonPhrase):
         try:
@@ -171,55 +1458,119 @@ class WSClient:
             logger.debug (f"ws_client {id (self)}: close_websocket: Exception on closing connection: {ex}")
 
     async def send_message (self, message):
-        return await self.websocket.send (message)
+        self.count_relayed (len (message), True)
+        if self.relay_queue is not None:
+            return await self.queue_for_relay (message)
+        start_time = asyncio.get_event_loop ().time ()
+        await self.websocket.send (message)
+        metrics.relay_latency.observe (asyncio.get_event_loop ().time () - start_time)
 
     async def peer_disconnected (self, peer):
+        if (self.can_hold_for (peer)):
+            self.hold_for_peer (peer)
+            return
         await self.close_websocket (reasonCode=1002, reasonPhrase=f"the peer websocket disconnected")
 
+    def meetup_expired (self, reason):
+        # Closing the websocket ends the wait for the HELLO message or the peer
+        asyncio.ensure_future (self.close_websocket (1001, reason))
+
+# The HTTP status returned for each meetup registry rejection reason
+rejection_http_status = {
+    "too-many-connections": HTTPStatus.SERVICE_UNAVAILABLE,
+    "too-many-connections-from-address": HTTPStatus.TOO_MANY_REQUESTS,
+    "meetup-full": HTTPStatus.CONFLICT,
+    "too-many-meetups": HTTPStatus.SERVICE_UNAVAILABLE
+}
+
+def check_upgrade_request (path, remote_address):
+    '''Return an (HTTP status, reason, description) tuple if the websocket upgrade request has to be refused'''
+    remote_host = remote_address [0] if remote_address else None
+    if ((router_path and path == router_path) or (event_path and path == event_path)):
+        rejection = meetup_registry.check_connection (remote_host)
+    else:
+        if (not path.startswith (proxy_service_prefix)):
+            return (HTTPStatus.NOT_FOUND, "unsupported-path",
+                    f"unsupported path (meetup URIs start with {proxy_service_prefix})")
+        meetup_id = path [len (proxy_service_prefix):]
+        if (not re.fullmatch (meetup_id_pattern, meetup_id)):
+            return (HTTPStatus.BAD_REQUEST, "malformed-meetup-id", "malformed meetup ID")
+        rejection = meetup_registry.check_connection (remote_host)
+        # Whether a meetup is full is only known here if the meetup is homed on this worker
+        if (not rejection and (not worker_links or worker_links.is_home (meetup_id))):
+            rejection = meetup_registry.check_meetup (meetup_id)
+    if (rejection):
+        reason, description = rejection
+        return (rejection_http_status [reason], reason, description)
+    return None
+
 async def ws_connected (websocket, path):
+    metrics.connection_stage.labels ("upgrade").observe (websocket.loop.time () - websocket.connected_time)
+    if (router_path and path == router_path):
+        return await service_client_connected (websocket, RouterClient)
+    if (event_path and path == event_path):
+        return await service_client_connected (websocket, EventSubscriber)
     try:
         new_client = None
         peer_client = None
-        client_list = None
+        home_channel = None
+        meetup = None
+        meetup_id = None
         remote_address = websocket.remote_address
+        remote_host = remote_address [0] if remote_address else None
         logger.info (f"ws_connected: from {remote_address}, {path}")
-        if (not path.startswith (proxy_service_prefix)):
-            logger.warning (f"ws_connected: Unsupported path: {proxy_service_prefix} - CLOSING!")
-            return
+        # Note: The path was checked by process_request() - but the meetup registry has to be
+        #       checked again, since it can change while the websocket handshake completes
         meetup_id = path [len (proxy_service_prefix):]
-        if (not meetup_id in meetup_table):
-            client_list = []
-            meetup_table [meetup_id] = client_list
-        else:
-            client_list = meetup_table [meetup_id]
-        if (len (client_list) >= 2):
-            logger.warning (f"ws_connected: client {id (new_client)}: meetup ID {meetup_id} "
-                            f"already has {len (client_list)} clients - CLOSING connection from {remote_address}.")
+        home_link = None
+        rejection = meetup_registry.check_connection (remote_host)
+        if (not rejection):
+            home_link = await worker_links.get_home_link (meetup_id) if worker_links else None
+            if (not home_link):
+                rejection = meetup_registry.check_meetup (meetup_id)
+        if (rejection):
+            reason, description = rejection
+            logger.warning (f"ws_connected: {description} - CLOSING connection from {remote_address} "
+                            f"for meetup {meetup_id}")
+            metrics.connections_rejected.labels (reason).inc ()
+            if (worker_links and not home_link and not meetup_registry.get (meetup_id)):
+                # The meetup may have been claimed (in the cluster directory) for this client
+                worker_links.meetup_closed (meetup_id)
             return
 
-        new_client = WSClient (meetup_id, websocket)
-        client_list.append (new_client)
-
-        perform_connection_report ()
+        new_client = WSClient (meetup_id, websocket, ping_interval_s=ping_interval_s, ping_timeout_s=ping_timeout_s)
+        meetup_registry.add_connection (new_client, remote_host)
+        if (not home_link):
+            meetup = meetup_registry.add_client (meetup_id, new_client)
 
         logger.debug (f"ws_connected: client {id (new_client)}: (meetup_id: {meetup_id})")
         logger.debug (f"ws_connected: client {id (new_client)}: Waiting for HELLO message...")
         hello_message = await new_client.recv_hello_message ()
-        logger.info (f"ws_connected: client {id (new_client)}: Received HELLO message:")
-        logger.info (json.dumps (hello_message, indent=2))
+        logger.info ("ws_connected: client %s: Received HELLO message (peerClass: %s)",
+                     id (new_client), get_peer_class (new_client), extra=new_client.log_fields)
+        logger.debug ("ws_connected: client %s: HELLO message: %s", id (new_client), hello_message,
+                      extra=new_client.log_fields)
 
         # Here's where we'd add any accept criteria based on the HELLO message
 
-        if (len (client_list) == 1):
-            logger.info (f"ws_connected: client {id (new_client)} is the first connected to {path}")
-            perform_connection_report ()
+        if (home_link):
+            logger.info (f"ws_connected: client {id (new_client)}: meetup {meetup_id} is homed on "
+                         f"worker {home_link.peer_worker_index} - waiting for a peer via the worker link")
+            home_channel = await home_link.open_channel (new_client)
             peer_client = await new_client.wait_for_peer ()
-        else:
+        elif (meetup.first_client is new_client):
+            meetup_registry.index_peer (new_client)
+            if (not message_router.route_meetup (meetup)):
+                logger.info (f"ws_connected: client {id (new_client)} is the first connected to {path}")
+            peer_client = await new_client.wait_for_peer ()
+        elif (meetup.second_client is new_client):
+            meetup_registry.index_peer (new_client)
             logger.info (f"ws_connected: client {id (new_client)} is the second connected to {path}")
-            peer_client = client_list [0]
+            peer_client = meetup.first_client
             new_client.set_peer (peer_client)
             peer_client.set_peer (new_client)
-            perform_connection_report ()
+        else:
+            raise Exception (f"meetup {meetup_id} was closed before the HELLO message was received")
 
         # Will just relay data between the clients until someone disconnects...
         await new_client.communicate_with_peer ()
@@ -230,39 +1581,685 @@ async def ws_connected (websocket, path):
         logger.info (f"ws_connected: client {id (new_client)}: Caught an exception from ws_reader: {Ex}")
     finally:
         logger.info (f"ws_connected: client {id (new_client)}: Cleaning up...")
-        if (new_client in client_list):
-            client_list.remove (new_client)
-            if len(client_list) == 0:
-                meetup_table.pop (meetup_id)
-            perform_connection_report()
         if (new_client):
+            meetup_registry.remove_client (meetup_id, new_client)
+            meetup_registry.remove_connection (new_client, remote_host)
             new_client.cleanup_before_close ()
+            # The peer may have changed since pairing (if the session was resumed)
+            peer_client = new_client.peer_client or peer_client
         if (peer_client):
             await peer_client.peer_disconnected (new_client)
+        elif (home_channel):
+            await home_channel.peer_disconnected (new_client)
 
     # When this function returns, the websocket is closed
 
-def check_json_field (json_obj, field, field_type, required):
-    '''Thrown an Exception of json_obj doesn't contain field and/or it isn't of type field_type'''
-    if field not in json_obj:
-        if required:
-            raise Exception (f"message doesn't contain a '{field}' field")
+#
+# Meetup registry
+#
+# The registry holds the (up to) two clients of each meetup homed on this process in fixed slots,
+# along with indexes of the clients by the peerId and peerClass of their HELLO messages and by
+# remote address - so admission checks and admin queries never need to scan the meetups. A meetup
+# which is left half-open (with one client waiting for a peer) for meetup_half_open_ttl_s is closed.
+#
+
+class Meetup:
+    '''The clients of a meetup ID (the first client is the one that waits for a peer)'''
+    __slots__ = ('meetup_id', 'first_client', 'second_client', 'created_time', 'expiry_handle', 'traffic')
+
+    def __init__ (self, meetup_id):
+        self.meetup_id = meetup_id
+        self.first_client = None
+        self.second_client = None
+        self.created_time = time.time ()
+        self.expiry_handle = None
+        self.traffic = TrafficAccount ()
+
+    def __len__ (self):
+        return (self.first_client is not None) + (self.second_client is not None)
+
+    def clients (self):
+        return [client for client in (self.first_client, self.second_client) if client is not None]
+
+class MeetupRegistry:
+    def __init__ (self):
+        self.meetups = {}
+        self.connection_count = 0
+        self.by_address = {}
+        self.by_peer_id = {}
+        self.by_peer_class = {}
+
+    def __len__ (self):
+        return len (self.meetups)
+
+    def get (self, meetup_id):
+        return self.meetups.get (meetup_id)
+
+    def check_connection (self, address):
+        '''Return a (reason, description) tuple if a connection from the address has to be refused'''
+        if (max_connections and self.connection_count >= max_connections):
+            return ("too-many-connections", f"the maximum number of connections ({max_connections}) are open")
+        if (max_connections_per_address and address
+              and len (self.by_address.get (address, ())) >= max_connections_per_address):
+            return ("too-many-connections-from-address",
+                    f"the maximum number of connections from {address} ({max_connections_per_address}) are open")
+        return None
+
+    def check_meetup (self, meetup_id):
+        '''Return a (reason, description) tuple if a client can't join the meetup'''
+        meetup = self.meetups.get (meetup_id)
+        if (meetup and meetup.second_client is not None):
+            return ("meetup-full", f"meetup ID {meetup_id} already has 2 clients")
+        if (max_meetups and not meetup and len (self.meetups) >= max_meetups):
+            return ("too-many-meetups", f"the maximum number of meetups ({max_meetups}) are active")
+        return None
+
+    def add_connection (self, client, address):
+        self.connection_count += 1
+        self.add_to_index (self.by_address, address, client)
+
+    def remove_connection (self, client, address):
+        self.connection_count -= 1
+        self.remove_from_index (self.by_address, address, client)
+
+    def add_client (self, meetup_id, client):
+        '''Add the client to the meetup (which has to have passed check_meetup) and return the meetup'''
+        meetup = self.meetups.get (meetup_id)
+        if (not meetup):
+            meetup = Meetup (meetup_id)
+            self.meetups [meetup_id] = meetup
+        if (meetup.first_client is None):
+            meetup.first_client = client
+            metrics.meetups_half_open.inc ()
+            self.start_expiry (meetup)
+        else:
+            meetup.second_client = client
+            self.cancel_expiry (meetup)
+            metrics.meetups_half_open.dec ()
+            metrics.meetups_active.inc ()
+        if (isinstance (client, WSClient)):
+            client.meetup_traffic = meetup.traffic
+        self.index_peer (client)
+        return meetup
+
+    def remove_client (self, meetup_id, client):
+        '''Remove the client from the meetup, returning True if it was found'''
+        meetup = self.meetups.get (meetup_id)
+        if (not meetup):
+            return False
+        if (client is meetup.first_client):
+            meetup.first_client = meetup.second_client
+            meetup.second_client = None
+        elif (client is meetup.second_client):
+            meetup.second_client = None
+        else:
+            return False
+        self.remove_from_index (self.by_peer_id, get_peer_id (client), client)
+        self.remove_from_index (self.by_peer_class, get_peer_class (client), client)
+        if (meetup.first_client is None):
+            self.cancel_expiry (meetup)
+            self.meetups.pop (meetup_id)
+            metrics.meetups_half_open.dec ()
+            if (worker_links):
+                worker_links.meetup_closed (meetup_id)
+        else:
+            metrics.meetups_active.dec ()
+            metrics.meetups_half_open.inc ()
+            self.start_expiry (meetup)
+        return True
+
+    def index_peer (self, client):
+        '''Index the client by its peerId and peerClass (once its HELLO message has been received)'''
+        if (client.hello_message):
+            self.add_to_index (self.by_peer_id, get_peer_id (client), client)
+            self.add_to_index (self.by_peer_class, get_peer_class (client), client)
+
+    def add_to_index (self, index, key, client):
+        if (key is not None):
+            index.setdefault (key, set ()).add (client)
+
+    def remove_from_index (self, index, key, client):
+        clients = index.get (key)
+        if (clients is not None):
+            clients.discard (client)
+            if (not clients):
+                index.pop (key)
+
+    def find (self, meetup_id=None, peer_id=None, peer_class=None, address=None):
+        '''Return the meetups with clients matching all the given criteria (all meetups if none are given)'''
+        meetup_ids = None if meetup_id is None else {meetup_id}
+        for index, key in ((self.by_peer_id, peer_id), (self.by_peer_class, peer_class),
+                           (self.by_address, address)):
+            if (key is not None):
+                matching_ids = {client.meetup_id for client in index.get (key, ())}
+                meetup_ids = matching_ids if meetup_ids is None else meetup_ids & matching_ids
+        if (meetup_ids is None):
+            return list (self.meetups.values ())
+        return [self.meetups [meetup_id] for meetup_id in meetup_ids if meetup_id in self.meetups]
+
+    def start_expiry (self, meetup):
+        if (meetup_half_open_ttl_s):
+            meetup.expiry_handle = asyncio.get_event_loop ().call_later (meetup_half_open_ttl_s,
+                                                                         self.expire_meetup, meetup)
+
+    def cancel_expiry (self, meetup):
+        if (meetup.expiry_handle):
+            meetup.expiry_handle.cancel ()
+            meetup.expiry_handle = None
+
+    def expire_meetup (self, meetup):
+        meetup.expiry_handle = None
+        client = meetup.first_client
+        reason = f"no peer joined meetup {meetup.meetup_id} within {meetup_half_open_ttl_s} seconds"
+        logger.info (f"meetup registry: {reason} - CLOSING client {id (client)}")
+        metrics.meetups_expired.inc ()
+        self.remove_client (meetup.meetup_id, client)
+        client.meetup_expired (reason)
+
+meetup_registry = MeetupRegistry ()
+
+def get_peer_id (client):
+    '''Return the peerId from the client's HELLO message (or None)'''
+    hello_message = getattr (client, 'hello_message', None)
+    if hello_message and isinstance (hello_message.get ('message'), dict):
+        peer_id = hello_message ['message'].get ('peerId')
+        if isinstance (peer_id, str):
+            return peer_id
+    return None
+
+def get_peer_class (client):
+    '''Return the peerClass from the client's HELLO message (or "unknown")'''
+    hello_message = getattr (client, 'hello_message', None)
+    if hello_message and isinstance (hello_message.get ('message'), dict):
+        peer_class = hello_message ['message'].get ('peerClass')
+        if isinstance (peer_class, str):
+            return peer_class
+    return "unknown"
+
+#
+# Routing mode
+#
+# When router_path is set, a client connecting to it (a "router client" - e.g. a manager) can
+# subscribe to any number of meetup IDs and peerClass groups with ROUTER:SUBSCRIBE messages. A
+# client waiting for a peer on a subscribed meetup (or with a subscribed peerClass) is paired with a
+# RouterChannel, which stands in for the router client in the meetup. Messages from the meetup
+# clients are relayed to the router client with a "meetupId" field added. Every message from the
+# router client - responses included - needs a "meetupId" field, and is routed by it (and relayed
+# without it). See section 5.6 of the README.
+#
+
+def wrap_routed_message (meetup_id, raw_message):
+    '''Add the meetupId field to a (JSON object) message, without re-encoding the message'''
+    text = raw_message if isinstance (raw_message, str) else raw_message.decode ('utf-8')
+    start = text.index ('{') + 1
+    return '{"meetupId": ' + json.dumps (meetup_id) + ', ' + text [start:]
+
+def parse_message_fields (raw_message):
+    '''Return the parsed message and its "message" object (raising ValueError if it isn't a message)'''
+    message = json_loads (raw_message)
+    if (not isinstance (message, dict) or not isinstance (message.get ('message'), dict)):
+        raise ValueError ("the message doesn't contain a 'message' object")
+    return message, message ['message']
+
+router_subscription_schema = MessageSchema ("ROUTER:SUBSCRIBE", {
+    'meetupIds': (list, False),
+    'peerClasses': (list, False)
+})
+
+class RouterChannel:
+    '''The stand-in for a router client in a meetup it's routing messages for'''
+    def __init__ (self, router_client, meetup_id):
+        self.router_client = router_client
+        self.meetup_id = meetup_id
+        self.hello_raw = router_client.hello_raw
+        self.hello_message = router_client.hello_message
+        self.peer_client = None
+        self.closed = False
+
+    def __str__ (self):
+        return f"Router channel {id (self)} for meetup {self.meetup_id} @ {self.router_client}"
+
+    def attach (self, client):
+        '''Pair the channel with the client waiting for a peer in the meetup'''
+        self.router_client.channels [self.meetup_id] = self
+        meetup_registry.add_client (self.meetup_id, self)
+        self.peer_client = client
+        client.set_peer (self)
+        logger.info (f"router client {id (self.router_client)}: Routing meetup {self.meetup_id} "
+                     f"(client {id (client)})")
+        # The client is sent the router client's HELLO (as it would be sent its peer's)
+        asyncio.ensure_future (self.send_hello ())
+
+    async def send_hello (self):
+        try:
+            await self.peer_client.send_message (self.hello_raw)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_message (self, message):
+        if (self.closed):
+            raise websockets.ConnectionClosed (1001, f"meetup {self.meetup_id} is no longer routed")
+        await self.router_client.route_from_peer (self, message)
+
+    async def peer_disconnected (self, peer):
+        if (self.closed):
+            return
+        self.detach ()
+        await self.router_client.send_router_message ({'messageType': "ROUTER:DISCONNECTED",
+                                                       'requiresResponse': False}, self.meetup_id)
+
+    def detach (self):
+        self.closed = True
+        if (self.router_client.channels.get (self.meetup_id) is self):
+            self.router_client.channels.pop (self.meetup_id)
+        meetup_registry.remove_client (self.meetup_id, self)
+
+    def meetup_expired (self, reason):
+        # Only reachable if the meetup client left and the channel was left waiting
+        self.detach ()
+
+class RouterClient (WSClient):
+    '''A client which exchanges messages with the meetups it subscribes to over one websocket'''
+    def __init__ (self, websocket, **kwargs):
+        super ().__init__ (None, websocket, **kwargs)
+        self.peer_arrival_future = None
+        self.channels = {}
+        self.subscribed_meetup_ids = set ()
+        self.subscribed_peer_classes = set ()
+        self.next_message_id = 1
+        self.log_fields = {'clientId': id (self)}
+        # The router client carries the traffic of many meetups
+        self.message_bucket = self.byte_bucket = None
+
+    def count_relayed (self, size, message_complete):
+        # Messages are routed to this client from any number of peers
+        if (not self.relay_direction):
+            self.relay_direction = f"routed-to-{get_peer_class (self)}"
+            self.relayed_messages_metric = metrics.messages_relayed.labels (self.relay_direction)
+            self.relayed_bytes_metric = metrics.bytes_relayed.labels (self.relay_direction)
+        super ().count_relayed (size, message_complete)
+
+    async def relay_messages_to_peer (self):
+        try:
+            logger.info (f"router client {id (self)}: relay_messages_to_peer: Routing messages")
+            while True:
+                await self.route_message (await self.websocket.recv ())
+        finally:
+            logger.info (f"router client {id (self)}: relay_messages_to_peer: terminating")
+
+    async def route_message (self, raw_message):
+        '''Route a message received from the router client'''
+        try:
+            message, fields = parse_message_fields (raw_message)
+        except ValueError:
+            log_rate_limited (logging.WARNING, "router client %s: Received a message which isn't a JSON "
+                              "message object - DROPPING", id (self))
+            return
+        message_type = fields.get ('messageType')
+        if (message_type == "ROUTER:SUBSCRIBE" or message_type == "ROUTER:UNSUBSCRIBE"):
+            await self.handle_subscription (fields)
+            return
+        # Note: Every message (including responses) is routed by its meetupId - messageIds are only
+        #       unique per meetup client, so a response can't be routed by its inResponseTo
+        meetup_id = message.pop ('meetupId', None)
+        channel = self.channels.get (meetup_id) if isinstance (meetup_id, str) else None
+        if (not channel):
+            if (meetup_id is None):
+                reason = "the message has no meetupId"
+            else:
+                reason = f"meetup {meetup_id} isn't connected"
+            log_rate_limited (logging.WARNING, "router client %s: Can't route a message: %s - DROPPING",
+                              id (self), reason)
+            await self.send_router_response (fields.get ('messageId'), HTTPStatus.NOT_FOUND, reason)
+            return
+        try:
+            # The meetup client is sent the message (with any other top-level fields) without the routing field
+            await channel.peer_client.send_message (json.dumps (message))
+        except websockets.ConnectionClosed:
+            logger.debug ("router client %s: client %s closed - DROPPING message",
+                          id (self), id (channel.peer_client))
+
+    async def route_from_peer (self, channel, raw_message):
+        '''Relay a message from a meetup client to the router client'''
+        try:
+            # The meetupId is inserted into the message's text - so it has to be a JSON message object
+            parse_message_fields (raw_message)
+        except ValueError:
+            log_rate_limited (logging.WARNING, "router client %s: Received a message from meetup %s which "
+                              "isn't a JSON message object - DROPPING", id (self), channel.meetup_id)
+            return
+        await self.send_message (wrap_routed_message (channel.meetup_id, raw_message))
+
+    async def handle_subscription (self, fields):
+        try:
+            router_subscription_schema.validate (fields)
+            meetup_ids = fields.get ('meetupIds', [])
+            peer_classes = fields.get ('peerClasses', [])
+            if (not all (isinstance (key, str) for key in meetup_ids + peer_classes)):
+                raise MessageValidationError ("meetupIds and peerClasses have to be lists of strings")
+        except MessageValidationError as mve:
+            await self.send_router_response (fields.get ('messageId'), HTTPStatus.BAD_REQUEST, str (mve))
+            return
+        if (fields ['messageType'] == "ROUTER:SUBSCRIBE"):
+            conflicts = message_router.subscribe (self, meetup_ids, peer_classes)
+        else:
+            conflicts = []
+            message_router.unsubscribe (self, meetup_ids, peer_classes)
+        logger.info (f"router client {id (self)}: {fields ['messageType']}: meetup IDs {meetup_ids}, "
+                     f"peer classes {peer_classes}" + (f" (conflicts: {conflicts})" if conflicts else ""))
+        await self.send_router_response (fields.get ('messageId'), HTTPStatus.OK, None, conflicts=conflicts)
+
+    async def send_router_response (self, in_response_to, status, reason, **fields):
+        if (in_response_to is None):
+            return
+        await self.send_router_message (dict (fields, messageType="ROUTER:RESPONSE", requiresResponse=False,
+                                              inResponseTo=in_response_to, statusCode=status.value,
+                                              reasonPhrase=reason or status.phrase))
+
+    async def send_router_message (self, fields, meetup_id=None):
+        '''Send a message generated by the proxy to the router client'''
+        fields ['messageId'] = self.next_message_id
+        self.next_message_id += 1
+        message = {'meetupId': meetup_id, 'message': fields} if meetup_id is not None else {'message': fields}
+        try:
+            await self.send_message (json.dumps (message))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def shutdown (self):
+        message_router.remove_client (self)
+        for channel in list (self.channels.values ()):
+            channel.detach ()
+            await channel.peer_client.peer_disconnected (channel)
+
+class MessageRouter:
+    '''The router clients subscribed to each meetup ID and peerClass'''
+    def __init__ (self):
+        self.meetup_routes = {}
+        self.peer_class_routes = {}
+
+    def subscribe (self, router_client, meetup_ids, peer_classes):
+        '''Route the meetup IDs and peer classes to the router client, returning those already routed elsewhere'''
+        conflicts = []
+        for routes, keys, subscribed in ((self.meetup_routes, meetup_ids, router_client.subscribed_meetup_ids),
+                                         (self.peer_class_routes, peer_classes, router_client.subscribed_peer_classes)):
+            for key in keys:
+                if (routes.get (key, router_client) is not router_client):
+                    conflicts.append (key)
+                    continue
+                routes [key] = router_client
+                subscribed.add (key)
+        # Clients already waiting for a peer are attached straight away
+        for meetup_id in meetup_ids:
+            if (meetup_id not in conflicts):
+                self.attach_waiting (router_client, meetup_registry.get (meetup_id))
+        for peer_class in peer_classes:
+            if (peer_class not in conflicts):
+                for client in list (meetup_registry.by_peer_class.get (peer_class, ())):
+                    self.attach_waiting (router_client, meetup_registry.get (client.meetup_id))
+        return conflicts
+
+    def unsubscribe (self, router_client, meetup_ids, peer_classes):
+        '''Stop routing new meetups (meetups already being routed are unaffected)'''
+        for routes, keys, subscribed in ((self.meetup_routes, meetup_ids, router_client.subscribed_meetup_ids),
+                                         (self.peer_class_routes, peer_classes, router_client.subscribed_peer_classes)):
+            for key in keys:
+                if (routes.get (key) is router_client):
+                    routes.pop (key)
+                    subscribed.discard (key)
+
+    def remove_client (self, router_client):
+        self.unsubscribe (router_client, list (router_client.subscribed_meetup_ids),
+                          list (router_client.subscribed_peer_classes))
+
+    def route_meetup (self, meetup):
+        '''Attach a router client to the (half-open) meetup if one is subscribed to it, returning True if one was'''
+        if (not self.meetup_routes and not self.peer_class_routes):
+            return False
+        router_client = (self.meetup_routes.get (meetup.meetup_id)
+                         or self.peer_class_routes.get (get_peer_class (meetup.first_client)))
+        return router_client is not None and self.attach_waiting (router_client, meetup)
+
+    def attach_waiting (self, router_client, meetup):
+        if (not meetup or meetup.second_client is not None):
+            return False
+        client = meetup.first_client
+        # Only a local client which has sent its HELLO and is waiting for a peer can be attached
+        if (not isinstance (client, WSClient) or not client.hello_message or not client.peer_arrival_future
+              or client.peer_arrival_future.done ()):
+            return False
+        RouterChannel (router_client, meetup.meetup_id).attach (client)
+        return True
+
+message_router = MessageRouter ()
+
+#
+# Event fan-out
+#
+# When event_path is set, clients connecting to it ("event subscribers" - e.g. dashboards or audit
+# consumers) can subscribe to the EVENT messages sent by meetup clients, by meetup ID, by the
+# sender's peerClass or to all events. Each published event is encoded (with the sender's meetupId
+# added) into a single frame, which is shared by the bounded event queues of all the matching
+# subscribers. A subscriber which falls behind has its oldest queued events dropped - publishing
+# never waits for a subscriber.
+#
+
+event_subscription_schema = MessageSchema ("EVENTS:SUBSCRIBE", {
+    'meetupIds': (list, False),
+    'peerClasses': (list, False),
+    'allEvents': (bool, False)
+})
+
+class EventSubscriber (WSClient):
+    '''A client which is sent the EVENT messages it subscribes to'''
+    def __init__ (self, websocket, **kwargs):
+        super ().__init__ (None, websocket, **kwargs)
+        self.peer_arrival_future = None
+        self.relay_queue = RelayQueue (event_queue_max_messages, event_queue_max_bytes, "drop-oldest-event")
+        self.meetup_ids = set ()
+        self.peer_classes = set ()
+        self.all_events = False
+        self.next_message_id = 1
+        self.log_fields = {'clientId': id (self)}
+
+    def count_relayed (self, size, message_complete):
+        if (not self.relay_direction):
+            self.relay_direction = f"proxy-to-{get_peer_class (self)}"
+            self.relayed_messages_metric = metrics.messages_relayed.labels (self.relay_direction)
+            self.relayed_bytes_metric = metrics.bytes_relayed.labels (self.relay_direction)
+        super ().count_relayed (size, message_complete)
+
+    def queue_event (self, frame):
+        '''Queue an (encoded) event without waiting - the oldest queued events are dropped to make room'''
+        if (not self.relay_queue_task):
+            self.relay_queue_task = asyncio.get_event_loop ().create_task (self.write_queued_messages ())
+        if (not self.relay_queue.put_nowait (frame)):
+            metrics.relay_queue_dropped.inc ()
+
+    async def relay_messages_to_peer (self):
+        try:
+            logger.info (f"event subscriber {id (self)}: relay_messages_to_peer: Waiting for subscriptions")
+            while True:
+                await self.handle_message (await self.websocket.recv ())
+        finally:
+            logger.info (f"event subscriber {id (self)}: relay_messages_to_peer: terminating")
+
+    async def handle_message (self, raw_message):
+        try:
+            message, fields = parse_message_fields (raw_message)
+        except ValueError:
+            log_rate_limited (logging.WARNING, "event subscriber %s: Received a message which isn't a JSON "
+                              "message object - DROPPING", id (self))
+            return
+        message_type = fields.get ('messageType')
+        if (message_type != "EVENTS:SUBSCRIBE" and message_type != "EVENTS:UNSUBSCRIBE"):
+            await self.send_response (fields.get ('messageId'), HTTPStatus.BAD_REQUEST,
+                                      f"unsupported message type {message_type!r}")
+            return
+        try:
+            event_subscription_schema.validate (fields)
+            meetup_ids = fields.get ('meetupIds', [])
+            peer_classes = fields.get ('peerClasses', [])
+            if (not all (isinstance (key, str) for key in meetup_ids + peer_classes)):
+                raise MessageValidationError ("meetupIds and peerClasses have to be lists of strings")
+        except MessageValidationError as mve:
+            await self.send_response (fields.get ('messageId'), HTTPStatus.BAD_REQUEST, str (mve))
+            return
+        if (message_type == "EVENTS:SUBSCRIBE"):
+            event_broker.subscribe (self, meetup_ids, peer_classes, fields.get ('allEvents', False))
         else:
+            event_broker.unsubscribe (self, meetup_ids, peer_classes, fields.get ('allEvents', False))
+        logger.info (f"event subscriber {id (self)}: {message_type}: meetup IDs {meetup_ids}, "
+                     f"peer classes {peer_classes}, all events: {fields.get ('allEvents', False)}")
+        await self.send_response (fields.get ('messageId'), HTTPStatus.OK, None)
+
+    async def send_response (self, in_response_to, status, reason):
+        if (in_response_to is None):
+            return
+        message = {'message': {'messageId': self.next_message_id, 'messageType': "EVENTS:RESPONSE",
+                               'requiresResponse': False, 'inResponseTo': in_response_to,
+                               'statusCode': status.value, 'reasonPhrase': reason or status.phrase}}
+        self.next_message_id += 1
+        try:
+            await self.send_message (json.dumps (message))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def shutdown (self):
+        event_broker.remove_subscriber (self)
+
+class EventBroker:
+    '''The event subscribers, indexed by the meetup IDs and peer classes they subscribe to'''
+    def __init__ (self):
+        self.by_meetup_id = {}
+        self.by_peer_class = {}
+        self.all_events = set ()
+        self.subscription_count = 0
+
+    def subscribe (self, subscriber, meetup_ids, peer_classes, all_events):
+        for meetup_id in meetup_ids:
+            meetup_registry.add_to_index (self.by_meetup_id, meetup_id, subscriber)
+        for peer_class in peer_classes:
+            meetup_registry.add_to_index (self.by_peer_class, peer_class, subscriber)
+        subscriber.meetup_ids.update (meetup_ids)
+        subscriber.peer_classes.update (peer_classes)
+        if (all_events):
+            self.all_events.add (subscriber)
+            subscriber.all_events = True
+        self.update_subscription_count ()
+
+    def unsubscribe (self, subscriber, meetup_ids, peer_classes, all_events):
+        for meetup_id in meetup_ids:
+            meetup_registry.remove_from_index (self.by_meetup_id, meetup_id, subscriber)
+        for peer_class in peer_classes:
+            meetup_registry.remove_from_index (self.by_peer_class, peer_class, subscriber)
+        subscriber.meetup_ids.difference_update (meetup_ids)
+        subscriber.peer_classes.difference_update (peer_classes)
+        if (all_events):
+            self.all_events.discard (subscriber)
+            subscriber.all_events = False
+        self.update_subscription_count ()
+
+    def remove_subscriber (self, subscriber):
+        self.unsubscribe (subscriber, list (subscriber.meetup_ids), list (subscriber.peer_classes), True)
+
+    def update_subscription_count (self):
+        # Checked for every relayed message, so publish() is skipped entirely when there are no subscribers
+        self.subscription_count = len (self.by_meetup_id) + len (self.by_peer_class) + len (self.all_events)
+
+    def publish (self, publisher, item):
+        '''Queue the message (or unfragmented frame) for the publisher's subscribers, if it's an EVENT message'''
+        if (isinstance (item, Frame) and not (item.fin and item.opcode == OP_TEXT)):
+            if (item.opcode == OP_TEXT):
+                # The message may be an EVENT, but it's only relayed a piece at a time
+                metrics.events_unchecked.inc ()
+                log_rate_limited (logging.WARNING, "event broker: A message from client %s was relayed as "
+                                  "fragmented frames - not checking it for an EVENT message", id (publisher))
+            return
+        if (isinstance (item, CompressedFrame)):
+            item = self.inflate_frame (publisher, item)
+            if (item is None):
+                return
+        # Most relayed messages aren't events - so that's checked before the subscribers are collected
+        if (not is_event_message (item)):
+            return
+        subscribers = self.all_events.union (self.by_meetup_id.get (publisher.meetup_id, ()),
+                                             self.by_peer_class.get (get_peer_class (publisher), ()))
+        if (not subscribers):
+            return
+        try:
+            text = item if isinstance (item, str) else item.data.decode ('utf-8')
+            # The frame (and its payload) is shared by all the subscribers' queues
+            frame = Frame (True, OP_TEXT, wrap_routed_message (publisher.meetup_id, text).encode ('utf-8'))
+        except ValueError:
+            log_rate_limited (logging.WARNING, "event broker: An EVENT message from client %s isn't a JSON "
+                              "object - not publishing it", id (publisher))
+            return
+        metrics.events_published.inc ()
+        for subscriber in subscribers:
+            subscriber.queue_event (frame)
+
+    def inflate_frame (self, publisher, frame):
+        '''Return the decompressed copy of an (unfragmented) CompressedFrame, or None if it can't be'''
+        inflater = zlib.decompressobj (wbits=-15)
+        limit = ws_max_size or 0
+        try:
+            data = inflater.decompress (frame.data + empty_deflate_block, limit + 1 if limit else 0)
+        except zlib.error as ze:
+            log_rate_limited (logging.WARNING, "event broker: A compressed message from client %s can't be "
+                              "decompressed (%s) - not checking it for an EVENT message", id (publisher), ze)
             return None
-    field_val = json_obj [field]
-    if not isinstance (field_val, field_type):
-        raise Exception (f"Field type for '{field}' field is not a {field_type}")
-    return field_val
+        if (limit and len (data) > limit):
+            return None
+        return Frame (True, OP_TEXT, data)
+
+event_broker = EventBroker ()
+
+async def service_client_connected (websocket, client_class):
+    '''Handle a router client or event subscriber (which doesn't join a meetup) until it disconnects'''
+    client = None
+    remote_address = websocket.remote_address
+    remote_host = remote_address [0] if remote_address else None
+    try:
+        logger.info (f"service_client_connected: {client_class.__name__} from {remote_address}")
+        rejection = meetup_registry.check_connection (remote_host)
+        if (rejection):
+            reason, description = rejection
+            logger.warning (f"service_client_connected: {description} - CLOSING connection from {remote_address}")
+            metrics.connections_rejected.labels (reason).inc ()
+            return
+        client = client_class (websocket, ping_interval_s=ping_interval_s, ping_timeout_s=ping_timeout_s)
+        meetup_registry.add_connection (client, remote_host)
+        await client.recv_hello_message ()
+        logger.info ("service_client_connected: client %s: Received HELLO message (peerClass: %s)",
+                     id (client), get_peer_class (client), extra=client.log_fields)
+        await client.communicate_with_peer ()
+    except websockets.ConnectionClosed:
+        logger.info (f"service_client_connected: client {id (client)} disconnected normally")
+    except Exception as Ex:
+        logger.info (f"service_client_connected: client {id (client)}: Caught an exception: {Ex}")
+    finally:
+        if (client):
+            logger.info (f"service_client_connected: client {id (client)}: Cleaning up...")
+            meetup_registry.remove_connection (client, remote_host)
+            client.cleanup_before_close ()
+            await client.shutdown ()
 
 def start_websocket_reporting (report_interval_s):
     report_task = asyncio.get_event_loop ().create_task (perform_periodic_connection_reports (report_interval_s))
 
-def perform_connection_report ():
+def connection_report (meetups=None):
+        '''Return a text report of the given meetups - or the full meetup table (which is O(N) - so it's
+           only done on demand)'''
+        if (meetups is None):
+            meetups = meetup_registry.meetups.values ()
         report = f"\n---------------------------------------------------------------------------------------\n"
         report += "WEBSOCKET MEETUP TABLE REPORT FOR {}:{}/{}\n"\
                   .format (proxy_bind_address, proxy_port, proxy_service_prefix)
-        for meetup_id, meetup_list in meetup_table.items():
-            report += "\n  MEETUP ID: {}\n".format (meetup_id)
+        report += "  {} meetups, {} connections\n".format (len (meetup_registry), meetup_registry.connection_count)
+        for meetup in meetups:
+            meetup_list = meetup.clients ()
+            report += "\n  MEETUP ID: {}\n".format (meetup.meetup_id)
             if len(meetup_list) > 0:
                 client_1 = str (meetup_list[0])
             else:
@@ -273,8 +2270,17 @@ def perform_connection_report ():
                 client_2 = "Not connected"
             report += "    Client 1: {}\n".format (client_1)
             report += "    Client 2: {}\n".format (client_2)
+            report += "    Traffic: {}\n".format (meetup.traffic)
+            for client in meetup_list:
+                if getattr (client, "relay_queue", None) is not None:
+                    report += "    Client {} relay queue: {}\n".format (id (client), client.relay_queue)
+                if isinstance (client, WSClient):
+                    report += "    Client {} traffic: {}\n".format (id (client), client.traffic)
         report += f"----------------------------------------------------------------------------------------\n"
-        logger.info (report)
+        return report
+
+def perform_connection_report ():
+    logger.info (connection_report ())
 
 async def perform_periodic_connection_reports (report_interval_s):
     logger.info("Performing websocket connection reports every %s seconds", report_interval_s)
@@ -282,23 +2288,1483 @@ async def perform_periodic_connection_reports (report_interval_s):
         await asyncio.sleep (report_interval_s)
         perform_connection_report ()
 
-ssl_context = ssl.SSLContext (ssl.PROTOCOL_TLS_SERVER)
+async def start_metrics_server (bind_address, port, **server_args):
+    logger.info (f"Serving metrics on http://{bind_address}:{port}/metrics (meetup report on /meetups)")
+    return await asyncio.start_server (metrics_request_received, bind_address, port, **server_args)
+
+async def metrics_request_received (reader, writer, admin=False):
+    '''Handle a (minimal) HTTP request for /metrics, /meetups, /profile (or the admin API)'''
+    try:
+        request_line = await asyncio.wait_for (reader.readline (), timeout=10)
+        # The request headers aren't used
+        while True:
+            header_line = await asyncio.wait_for (reader.readline (), timeout=10)
+            if (not header_line or header_line in (b'\r\n', b'\n')):
+                break
+        request_fields = request_line.decode ('latin-1').split ()
+        if (len (request_fields) < 2):
+            return
+        method, path = request_fields [0], request_fields [1].split ('?') [0]
+        query = urllib.parse.parse_qs (urllib.parse.urlsplit (request_fields [1]).query)
+        content_type = "text/plain; charset=utf-8"
+        if (admin and path.startswith ("/admin/")):
+            status, response = handle_admin_request (method, path, query)
+            status, body = f"{status.value} {status.phrase}", json.dumps (response, indent=2) + "\n"
+            content_type = "application/json"
+        elif (method != "GET"):
+            status, body = "405 Method Not Allowed", "Only GET is supported\n"
+        elif (path == "/metrics"):
+            status, body = "200 OK", metrics.render ()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif (path == "/meetups"):
+            # The report can be narrowed down with meetupId, peerId, peerClass and/or address parameters
+            meetups = None
+            if (query):
+                meetups = meetup_registry.find (*(query.get (param, [None]) [0] for param in
+                                                  ("meetupId", "peerId", "peerClass", "address")))
+            status, body = "200 OK", connection_report (meetups)
+        elif (path == "/profile"):
+            # The profile duration can be set with a seconds parameter
+            try:
+                duration_s = min (float (query.get ("seconds", [profile_duration_s]) [0]), 300)
+            except ValueError:
+                duration_s = profile_duration_s
+            body = await profiler.profile (duration_s)
+            status = "200 OK"
+            if (body is None):
+                status, body = "409 Conflict", "A profile is already being taken\n"
+        else:
+            status, body = "404 Not Found", f"{path} not found (try /metrics, /meetups or /profile)\n"
+        body = body.encode ('utf-8')
+        writer.write (f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                      f"Content-Length: {len (body)}\r\nConnection: close\r\n\r\n".encode ('latin-1'))
+        writer.write (body)
+        await writer.drain ()
+    except (asyncio.TimeoutError, ConnectionError) as ex:
+        logger.debug (f"metrics_request_received: Error handling metrics request: {ex}")
+    finally:
+        writer.close ()
+
+#
+# Admin API
+#
+# When admin_socket_path is set, the HTTP endpoint is also served on a unix-domain socket (only
+# accessible to the proxy's user), where the /admin API is available as well as /metrics, /meetups
+# and /profile. The API (which responds with JSON) looks meetups up in the meetup registry's indexes
+# and only formats the meetups it returns:
+#
+#   GET /admin/meetups[?offset=&limit=&meetupId=&peerId=&peerClass=&address=]  list meetups (paginated)
+#   GET /admin/meetups/<meetupId>                                              a meetup and its clients
+#   POST /admin/meetups/<meetupId>/close[?reason=]                             close a meetup's clients
+#   GET /admin/peers/<peerId>                                                  the meetups of a peer
+#   GET /admin/settings                                                        the runtime settings
+#   POST /admin/settings?<name>=<value>...                                     change runtime settings
+#
+# (e.g. "curl --unix-socket <admin_socket_path> http://localhost/admin/meetups?limit=10")
+#
+
+# The settings which can be changed while the proxy is running (the limits only apply to new clients)
+runtime_settings = ["log_level", "relay_log_sample_rate", "max_connections", "max_connections_per_address",
+                    "max_meetups", "hello_timeout_s", "rate_limit_messages_per_s", "rate_limit_bytes_per_s",
+                    "rate_limit_burst_s", "rate_limit_action"]
+
+admin_page_size = 100
+
+def describe_traffic (traffic):
+    last_activity_time = traffic.last_activity_time
+    return {'messages': traffic.messages, 'bytes': traffic.bytes, 'maxFrameSize': traffic.max_frame_size,
+            'idleSeconds': None if last_activity_time is None
+                                else round (asyncio.get_event_loop ().time () - last_activity_time, 3)}
+
+def describe_client (client):
+    if (not isinstance (client, WSClient)):
+        # A stand-in for a remote client (a worker link or router channel)
+        return {'clientType': type (client).__name__, 'description': str (client)}
+    remote_address = client.websocket.remote_address
+    return {'clientId': id (client), 'peerId': get_peer_id (client), 'peerClass': get_peer_class (client),
+            'address': remote_address [0] if remote_address else None,
+            'pingRttSeconds': client.ping_rtt_s,
+            'relayQueueLength': len (client.relay_queue) if client.relay_queue is not None else None,
+            'heldForPeer': client.resume_buffer is not None,
+            'traffic': describe_traffic (client.traffic)}
+
+def describe_meetup (meetup):
+    return {'meetupId': meetup.meetup_id, 'createdTime': meetup.created_time,
+            'state': "paired" if meetup.second_client is not None else "half-open",
+            'traffic': describe_traffic (meetup.traffic),
+            'clients': [describe_client (client) for client in meetup.clients ()]}
+
+def get_query_value (query, name, value_type, default):
+    try:
+        return value_type (query [name] [0]) if name in query else default
+    except ValueError:
+        raise ValueError (f"{name} has to be of type {value_type.__name__}")
+
+def change_runtime_settings (query):
+    '''Apply the settings in the query, returning a list of problems (in which case none are applied)'''
+    unknown_settings = [name for name in query if name not in runtime_settings]
+    if (unknown_settings):
+        return [f"{name} can't be changed at runtime (changeable settings: {', '.join (runtime_settings)})"
+                for name in unknown_settings]
+    problems = []
+    new_values = {}
+    for name, values in query.items ():
+        try:
+            new_values [name] = convert_setting (name, values [-1])
+        except ValueError as ve:
+            problems.append (f"{name}: {ve}")
+    if (problems):
+        return problems
+    old_values = {name: globals () [name] for name in new_values}
+    globals ().update (new_values)
+    problems = check_config ()
+    if (problems):
+        globals ().update (old_values)
+        return problems
+    logging.getLogger ().setLevel (log_level)
+    logger.info (f"change_runtime_settings: Changed settings: {new_values}")
+    return []
+
+def handle_admin_request (method, path, query):
+    '''Return the status and (JSON-serializable) response for an admin API request'''
+    segments = [urllib.parse.unquote (segment) for segment in path.split ('/') [2:]]
+    try:
+        if (method == "GET" and segments == ["meetups"]):
+            offset = get_query_value (query, "offset", int, 0)
+            limit = min (get_query_value (query, "limit", int, admin_page_size), admin_page_size)
+            if (any (param in query for param in ("meetupId", "peerId", "peerClass", "address"))):
+                meetups = meetup_registry.find (*(query.get (param, [None]) [0] for param in
+                                                  ("meetupId", "peerId", "peerClass", "address")))
+                total = len (meetups)
+                page = meetups [offset:offset + limit]
+            else:
+                total = len (meetup_registry)
+                page = itertools.islice (meetup_registry.meetups.values (), offset, offset + limit)
+            return HTTPStatus.OK, {'total': total, 'offset': offset, 'limit': limit,
+                                   'meetups': [describe_meetup (meetup) for meetup in page]}
+        if (method == "GET" and len (segments) == 2 and segments [0] == "meetups"):
+            meetup = meetup_registry.get (segments [1])
+            if (not meetup):
+                return HTTPStatus.NOT_FOUND, {'error': f"meetup {segments [1]} isn't active"}
+            return HTTPStatus.OK, describe_meetup (meetup)
+        if (method == "POST" and len (segments) == 3 and segments [0] == "meetups" and segments [2] == "close"):
+            meetup = meetup_registry.get (segments [1])
+            if (not meetup):
+                return HTTPStatus.NOT_FOUND, {'error': f"meetup {segments [1]} isn't active"}
+            reason = query.get ("reason", ["closed by the proxy administrator"]) [0]
+            clients = meetup.clients ()
+            logger.info (f"handle_admin_request: Closing meetup {meetup.meetup_id} ({reason})")
+            for client in clients:
+                client.meetup_expired (reason)
+            return HTTPStatus.ACCEPTED, {'meetupId': meetup.meetup_id, 'clientsClosed': len (clients)}
+        if (method == "GET" and len (segments) == 2 and segments [0] == "peers"):
+            meetups = meetup_registry.find (peer_id=segments [1])
+            return HTTPStatus.OK, {'peerId': segments [1], 'meetups': [describe_meetup (meetup) for meetup in meetups]}
+        if (segments == ["settings"] and method in ("GET", "POST")):
+            if (method == "POST"):
+                problems = change_runtime_settings (query)
+                if (problems):
+                    return HTTPStatus.BAD_REQUEST, {'error': "; ".join (problems)}
+            return HTTPStatus.OK, {name: globals () [name] for name in runtime_settings}
+    except ValueError as ve:
+        return HTTPStatus.BAD_REQUEST, {'error': str (ve)}
+    return HTTPStatus.NOT_FOUND, {'error': f"{method} {path} isn't supported"}
+
+async def start_admin_server (socket_path):
+    if (os.path.exists (socket_path)):
+        os.unlink (socket_path)
+    logger.info (f"Serving the admin API on {socket_path}")
+    server = await asyncio.start_unix_server (functools.partial (metrics_request_received, admin=True),
+                                              path=socket_path)
+    os.chmod (socket_path, 0o600)
+    return server
+
+#
+# Instrumentation
+#
+# The event loop's lag (how late a timer fires) is measured every loop_lag_check_interval_s. If the
+# loop is blocked for longer than slow_callback_threshold_s, a watchdog thread logs the stack of the
+# loop thread - pointing at the callback which is blocking it - so blocking can be diagnosed with
+# asyncio's (expensive) debug mode turned off. The time spent in each stage of a connection's life
+# (see ws_connected) is recorded in the connection_stage_seconds histogram.
+#
+# The sampling profiler samples the loop thread's stack (from another thread) every
+# profile_sample_interval_s for profile_duration_s when the proxy receives a SIGUSR1 (writing the
+# profile to profile_dump_dir) or /profile is requested from the metrics endpoint. Profiles are in
+# the "collapsed stack" format used by flame graph tools (e.g. flamegraph.pl).
+#
+
+def format_stack_frame (frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename (code.co_filename)}:{code.co_firstlineno})"
+
+class LoopMonitor:
+    '''Measures the event loop lag and watches for callbacks blocking the loop'''
+    def __init__ (self):
+        self.loop_thread_id = None
+        self.heartbeat_time = None
+
+    def start (self, check_interval_s, slow_threshold_s):
+        self.loop_thread_id = threading.get_ident ()
+        self.heartbeat_time = time.monotonic ()
+        asyncio.get_event_loop ().create_task (self.measure_lag (check_interval_s, slow_threshold_s))
+        if (slow_threshold_s):
+            threading.Thread (target=self.watch_loop, args=(check_interval_s, slow_threshold_s),
+                              name="loop-watchdog", daemon=True).start ()
+
+    async def measure_lag (self, check_interval_s, slow_threshold_s):
+        loop = asyncio.get_event_loop ()
+        while True:
+            start_time = loop.time ()
+            await asyncio.sleep (check_interval_s)
+            lag_s = max (0, loop.time () - start_time - check_interval_s)
+            self.heartbeat_time = time.monotonic ()
+            metrics.loop_lag.observe (lag_s)
+            if (slow_threshold_s and lag_s > slow_threshold_s):
+                logger.warning (f"measure_lag: The event loop was blocked for {lag_s:.3f} seconds")
+
+    def watch_loop (self, check_interval_s, slow_threshold_s):
+        '''Log the loop thread's stack when the loop is blocked (run on the watchdog thread)'''
+        reported_heartbeat_time = None
+        while True:
+            time.sleep (slow_threshold_s / 4)
+            heartbeat_time = self.heartbeat_time
+            blocked_s = time.monotonic () - heartbeat_time - check_interval_s
+            if (blocked_s < slow_threshold_s or heartbeat_time == reported_heartbeat_time):
+                continue
+            # Only the first stack of each stall is logged
+            reported_heartbeat_time = heartbeat_time
+            frame = sys._current_frames ().get (self.loop_thread_id)
+            metrics.slow_callbacks.inc ()
+            logger.warning (f"watch_loop: The event loop has been blocked for {blocked_s:.3f} seconds - "
+                            f"loop thread stack:\n{''.join (traceback.format_stack (frame)) if frame else '(none)'}")
+
+class SamplingProfiler:
+    '''Counts the stacks sampled from the event loop thread (one profile is taken at a time)'''
+    def __init__ (self):
+        self.running = False
+
+    def sample (self, thread_id, duration_s, interval_s):
+        '''Sample the thread's stack, returning a dict of stack: count (run on an executor thread)'''
+        stack_counts = collections.Counter ()
+        end_time = time.monotonic () + duration_s
+        while time.monotonic () < end_time:
+            frame = sys._current_frames ().get (thread_id)
+            stack = []
+            while frame:
+                stack.append (format_stack_frame (frame))
+                frame = frame.f_back
+            stack_counts [";".join (reversed (stack))] += 1
+            time.sleep (interval_s)
+        return stack_counts
+
+    async def profile (self, duration_s):
+        '''Profile the event loop thread, returning the profile in collapsed stack format
+
+           Returns None if a profile is already being taken.'''
+        if (self.running):
+            return None
+        self.running = True
+        try:
+            logger.info (f"profile: Sampling the event loop for {duration_s} seconds...")
+            loop = asyncio.get_event_loop ()
+            stack_counts = await loop.run_in_executor (None, self.sample, threading.get_ident (),
+                                                       duration_s, profile_sample_interval_s)
+            return "".join (f"{stack} {count}\n" for stack, count in stack_counts.most_common ())
+        finally:
+            self.running = False
+
+    async def dump_profile (self):
+        profile = await self.profile (profile_duration_s)
+        if (profile is None):
+            logger.warning ("dump_profile: A profile is already being taken - IGNORING signal")
+            return
+        profile_path = pathlib.Path (profile_dump_dir or tempfile.gettempdir (),
+                                     f"micronets-ws-proxy-profile-{os.getpid ()}-"
+                                     f"{time.strftime ('%Y%m%d-%H%M%S')}.txt")
+        try:
+            profile_path.write_text (profile)
+            logger.info (f"dump_profile: Wrote the profile to {profile_path}")
+        except OSError as ose:
+            logger.error (f"dump_profile: Could not write the profile to {profile_path}: {ose}")
+
+    def request_dump (self):
+        asyncio.ensure_future (self.dump_profile ())
+
+loop_monitor = LoopMonitor ()
+profiler = SamplingProfiler ()
+
+#
+# Worker pool support
+#
+# When proxy_worker_count is set, the proxy runs as a pool of worker processes which all listen on
+# proxy_port (using SO_REUSEPORT), leaving it to the kernel to spread connections across workers.
+# Every meetup ID has a "home" worker (derived from a hash of the meetup ID) which holds its
+# meetup registry entry. A client that lands on any other worker is attached to the meetup via a
+# channel on a persistent, multiplexed unix-domain link to the home worker. On the home worker the
+# channel stands in for the remote client - so the meetup pairing and relaying logic is the same
+# whether the peers are local or not.
+#
+
+LINK_ATTACH = 0   # payload: the index of the connecting worker
+LINK_OPEN = 1     # payload: the length (2 bytes) and UTF-8 meetup ID, then the HELLO message of the client attaching
+LINK_PAIRED = 2   # payload: the HELLO message of the peer which arrived for the channel's meetup
+LINK_TEXT = 3     # payload: a UTF-8 text message
+LINK_BINARY = 4   # payload: a binary message
+LINK_CLOSE = 5    # payload: the UTF-8 close reason
+LINK_FRAME = 6    # payload: the data of a websocket frame (the flags carry the FIN bit, RSV1 for compressed frames and opcode)
+
+link_frame_header = struct.Struct ('!BBII') # frame type, flags, channel ID, payload length
+
+def encode_hello (hello_raw):
+    if (isinstance (hello_raw, str)):
+        return hello_raw.encode ('utf-8')
+    return hello_raw or b''
+
+class WorkerLinkChannel:
+    '''A client attached to a meetup through a worker link
+
+       On the home worker, a channel stands in for the client connected to the remote worker. On
+       the remote worker, it stands in for whatever peer the home worker pairs the client with.
+
+       The frames received for a channel are queued, and handled in order by the channel's own task
+       - so a client which is slow to take its messages only holds up its own channel, rather than
+       every meetup on the link. A client whose queue exceeds link_channel_queue_max_bytes is closed.'''
+    def __init__ (self, link, channel_id, meetup_id, hello_raw=None, peer_client=None):
+        self.link = link
+        self.channel_id = channel_id
+        self.meetup_id = meetup_id
+        self.hello_raw = hello_raw
+        self.hello_message = json_loads (hello_raw) if hello_raw else None
+        self.peer_client = peer_client
+        self.paired = False
+        self.closed = False
+        self.received_frames = collections.deque ()
+        self.received_bytes = 0
+        self.frame_received = asyncio.Event ()
+        self.receive_task = None
+
+    def __str__ (self):
+        if self.hello_message and 'message' in self.hello_message and 'peerId' in self.hello_message['message']:
+            peer_id = self.hello_message ['message']['peerId']
+        else:
+            peer_id = "none"
+        return f"Client {id (self)} (peer: {peer_id}) @ worker {self.link.peer_worker_index} channel {self.channel_id})"
+
+    def set_peer (self, peer):
+        # Only called on the home worker - let the remote worker know the meetup is complete
+        self.peer_client = peer
+        self.paired = True
+        self.link.write_frame (LINK_PAIRED, self.channel_id, encode_hello (peer.hello_raw))
+
+    async def send_message (self, message):
+        if (self.closed):
+            raise websockets.ConnectionClosed (1001, f"worker link channel {self.channel_id} is closed")
+        if isinstance (message, str):
+            await self.link.send_frame (LINK_TEXT, self.channel_id, message.encode ('utf-8'))
+        else:
+            await self.link.send_frame (LINK_BINARY, self.channel_id, message)
+
+    async def peer_disconnected (self, peer):
+        await self.close ("the peer websocket disconnected")
+
+    async def close (self, reason):
+        if (self.closed):
+            return
+        self.detach ()
+        try:
+            await self.link.send_frame (LINK_CLOSE, self.channel_id, reason.encode ('utf-8'))
+        except Exception as ex:
+            logger.debug (f"worker link channel {self.channel_id}: close: Exception sending close: {ex}")
+
+    def detach (self):
+        self.closed = True
+        self.link.channels.pop (self.channel_id, None)
+        meetup_registry.remove_client (self.meetup_id, self)
+        # Ends the channel's task (any frames still queued are discarded)
+        self.frame_received.set ()
+
+    def meetup_expired (self, reason):
+        asyncio.ensure_future (self.close (reason))
+
+    async def relay_frame (self, frame):
+        if (self.closed):
+            raise websockets.ConnectionClosed (1001, f"worker link channel {self.channel_id} is closed")
+        flags = (0x80 if frame.fin else 0) | (0x40 if isinstance (frame, CompressedFrame) else 0) | frame.opcode
+        await self.link.send_frame (LINK_FRAME, self.channel_id, frame.data, flags)
+
+    def queue_frame (self, frame_type, payload, flags=0):
+        '''Queue a frame received on the link for the channel's task (without waiting)'''
+        if (link_channel_queue_max_bytes and self.received_frames
+              and self.received_bytes + len (payload) > link_channel_queue_max_bytes):
+            self.queue_overflowed ()
+            return
+        self.received_frames.append ((frame_type, payload, flags))
+        self.received_bytes += len (payload)
+        self.frame_received.set ()
+        if (not self.receive_task):
+            self.receive_task = asyncio.get_event_loop ().create_task (self.handle_frames ())
+
+    def queue_overflowed (self):
+        close_reason = "link channel queue overflow"
+        logger.warning (f"worker link channel {self.channel_id}: {len (self.received_frames)} frames/"
+                        f"{self.received_bytes} bytes queued for client {id (self.peer_client)} - CLOSING")
+        # Detached right away, so the frames still arriving for the channel are ignored
+        self.detach ()
+        asyncio.ensure_future (self.link.send_frame (LINK_CLOSE, self.channel_id, close_reason.encode ('utf-8')))
+        if (self.peer_client):
+            asyncio.ensure_future (self.peer_client.close_websocket (relay_queue_close_code, close_reason))
+
+    async def handle_frames (self):
+        while not self.closed:
+            if (not self.received_frames):
+                self.frame_received.clear ()
+                await self.frame_received.wait ()
+                continue
+            frame_type, payload, flags = self.received_frames.popleft ()
+            self.received_bytes -= len (payload)
+            try:
+                await self.handle_frame (frame_type, payload, flags)
+            except Exception as ex:
+                logger.warning (f"worker link channel {self.channel_id}: Exception handling frame type "
+                                f"{frame_type}: {ex} - CLOSING")
+                await self.close (str (ex))
+                if (self.peer_client):
+                    await self.peer_client.close_websocket (1011, "worker link channel error")
+
+    async def handle_frame (self, frame_type, payload, flags=0):
+        if (frame_type == LINK_OPEN):
+            # Only received on the home worker (as the channel's first frame)
+            await self.link.accept_channel (self)
+        elif (frame_type == LINK_TEXT or frame_type == LINK_BINARY or frame_type == LINK_FRAME):
+            if (not self.paired or not self.peer_client):
+                log_rate_limited (logging.WARNING, "worker link channel %s: Received a message before the meetup "
+                                  "%s was complete - DROPPING", self.channel_id, self.meetup_id)
+                return
+            try:
+                if (frame_type == LINK_FRAME):
+                    frame_class = CompressedFrame if flags & 0x40 else Frame
+                    await self.peer_client.relay_frame (frame_class (bool (flags & 0x80), flags & 0x0f, payload))
+                else:
+                    message = payload.decode ('utf-8') if frame_type == LINK_TEXT else payload
+                    await self.peer_client.send_message (message)
+            except websockets.ConnectionClosed:
+                logger.debug ("worker link channel %s: client %s closed - DROPPING data",
+                              self.channel_id, id (self.peer_client))
+            except PayloadTooBig as ptb:
+                logger.warning (f"worker link channel {self.channel_id}: {ptb} - CLOSING")
+                await self.close (str (ptb))
+                await self.peer_client.close_websocket (1009, str (ptb))
+        elif (frame_type == LINK_PAIRED):
+            # Only received on the remote worker - the (local) client can start relaying
+            self.hello_raw = payload
+            self.hello_message = json_loads (payload) if payload else None
+            self.paired = True
+            self.peer_client.set_peer (self)
+        elif (frame_type == LINK_CLOSE):
+            reason = payload.decode ('utf-8')
+            logger.info (f"worker link channel {self.channel_id}: closed by worker {self.link.peer_worker_index}: {reason}")
+            await self.handle_close (reason)
+        else:
+            logger.warning (f"worker link channel {self.channel_id}: Unexpected frame type {frame_type} - IGNORING")
+
+    async def handle_close (self, reason):
+        if (self.closed):
+            return
+        self.detach ()
+        if (not self.peer_client):
+            return
+        if (self.paired):
+            await self.peer_client.peer_disconnected (self)
+        elif (self.peer_client.peer_arrival_future and not self.peer_client.peer_arrival_future.done ()):
+            self.peer_client.peer_arrival_future.set_exception (Exception (f"meetup {self.meetup_id} "
+                                                                           f"was closed by its home worker: {reason}"))
+
+class WorkerLink:
+    '''A persistent, multiplexed stream connection between two worker processes
+
+       Channels are only ever opened by the worker that initiated the connection - the accepting
+       worker is the home of every meetup referenced on the link.'''
+    def __init__ (self, reader, writer, peer_worker_index=None):
+        self.reader = reader
+        self.writer = writer
+        self.peer_worker_index = peer_worker_index
+        self.channels = {}
+        self.next_channel_id = 1
+        self.drain_lock = asyncio.Lock ()
+        self.closed = False
+
+    def write_frame (self, frame_type, channel_id, payload=b'', flags=0):
+        self.writer.write (link_frame_header.pack (frame_type, flags, channel_id, len (payload)))
+        if payload:
+            self.writer.write (payload)
+
+    async def send_frame (self, frame_type, channel_id, payload=b'', flags=0):
+        if (self.closed):
+            raise ConnectionError (f"the link to worker {self.peer_worker_index} is closed")
+        self.write_frame (frame_type, channel_id, payload, flags)
+        # Concurrent drain() calls aren't safe on older Pythons (see http://bugs.python.org/issue29930)
+        async with self.drain_lock:
+            await self.writer.drain ()
+
+    async def open_channel (self, client):
+        # Note: The channel stands in for the peer - whose HELLO message arrives with LINK_PAIRED
+        channel = WorkerLinkChannel (self, self.next_channel_id, client.meetup_id, peer_client=client)
+        self.next_channel_id += 1
+        self.channels [channel.channel_id] = channel
+        meetup_id = client.meetup_id.encode ('utf-8')
+        payload = struct.pack ('!H', len (meetup_id)) + meetup_id + encode_hello (client.hello_raw)
+        await self.send_frame (LINK_OPEN, channel.channel_id, payload)
+        return channel
+
+    def open_remote_channel (self, channel_id, payload):
+        meetup_id_length, = struct.unpack_from ('!H', payload)
+        meetup_id = payload [2:2 + meetup_id_length].decode ('utf-8')
+        channel = WorkerLinkChannel (self, channel_id, meetup_id, hello_raw=payload [2 + meetup_id_length:])
+        self.channels [channel_id] = channel
+        # The channel joins the meetup on its own task - ahead of any frames received for it
+        channel.queue_frame (LINK_OPEN, b'')
+
+    async def accept_channel (self, channel):
+        channel_id = channel.channel_id
+        meetup_id = channel.meetup_id
+        if (not await worker_links.accept_meetup (meetup_id)):
+            logger.warning (f"worker link channel {channel_id}: meetup {meetup_id} is owned by another node "
+                            f"- CLOSING channel from {self.peer_worker_index}")
+            await channel.close (f"meetup {meetup_id} is owned by another node")
+            return
+        rejection = meetup_registry.check_meetup (meetup_id)
+        if (rejection):
+            reason, description = rejection
+            logger.warning (f"worker link channel {channel_id}: {description} - CLOSING channel "
+                            f"from worker {self.peer_worker_index}.")
+            metrics.connections_rejected.labels (reason).inc ()
+            await channel.close (description)
+            return
+        meetup = meetup_registry.add_client (meetup_id, channel)
+        logger.info (f"worker link channel {channel_id}: client from worker {self.peer_worker_index} "
+                     f"joined meetup {meetup_id}")
+        if (meetup.second_client is channel):
+            peer_client = meetup.first_client
+            channel.set_peer (peer_client)
+            peer_client.set_peer (channel)
+
+    async def process_frames (self):
+        try:
+            while True:
+                header = await self.reader.readexactly (link_frame_header.size)
+                frame_type, flags, channel_id, length = link_frame_header.unpack (header)
+                payload = await self.reader.readexactly (length) if length else b''
+                if (frame_type == LINK_ATTACH):
+                    self.peer_worker_index = payload.decode ('utf-8')
+                    logger.info (f"worker link: worker {self.peer_worker_index} attached")
+                elif (frame_type == LINK_OPEN):
+                    self.open_remote_channel (channel_id, payload)
+                elif (channel_id in self.channels):
+                    # Note: The frame is handled by the channel's task - the link reader never waits on a client
+                    self.channels [channel_id].queue_frame (frame_type, payload, flags)
+                else:
+                    logger.debug ("worker link: Frame type %s for unknown channel %s - IGNORING", frame_type, channel_id)
+        except (asyncio.IncompleteReadError, ConnectionError) as ex:
+            logger.info (f"worker link: link to worker {self.peer_worker_index} closed ({ex})")
+        finally:
+            await self.close ()
+
+    async def close (self):
+        if (self.closed):
+            return
+        self.closed = True
+        self.writer.close ()
+        for channel in list (self.channels.values ()):
+            await channel.handle_close (f"the link to worker {self.peer_worker_index} closed")
+
+class WorkerLinkManager:
+    '''Maintains the links from this worker to the home workers of remote meetups'''
+    def __init__ (self, worker_index, worker_count, socket_dir):
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.socket_dir = socket_dir
+        self.home_links = {}
+        self.pending_links = {}
+        self.link_server = None
+
+    def socket_path (self, worker_index):
+        return os.path.join (self.socket_dir, f"worker-{worker_index}.sock")
+
+    def home_worker (self, meetup_id):
+        return zlib.crc32 (meetup_id.encode ('utf-8')) % self.worker_count
+
+    def is_home (self, meetup_id):
+        return self.home_worker (meetup_id) == self.worker_index
+
+    async def start (self):
+        path = self.socket_path (self.worker_index)
+        if os.path.exists (path):
+            os.unlink (path)
+        # Note: The server has to be referenced (uvloop closes servers which are garbage collected)
+        self.link_server = await asyncio.start_unix_server (self.link_accepted, path=path)
+
+    async def link_accepted (self, reader, writer):
+        await WorkerLink (reader, writer).process_frames ()
+
+    async def get_home_link (self, meetup_id):
+        '''Return the link to the meetup's home worker, or None if this worker is the home'''
+        home_index = self.home_worker (meetup_id)
+        if (home_index == self.worker_index):
+            return None
+        return await self.get_link (home_index)
+
+    async def accept_meetup (self, meetup_id):
+        '''Determine if a channel can be opened for the meetup (every meetup on a link is homed here)'''
+        return True
+
+    def meetup_closed (self, meetup_id):
+        pass
+
+    async def get_link (self, home_index):
+        link = self.home_links.get (home_index)
+        if (link and not link.closed):
+            return link
+        if (not home_index in self.pending_links):
+            self.pending_links [home_index] = asyncio.get_event_loop ().create_task (self.connect (home_index))
+        try:
+            return await asyncio.shield (self.pending_links [home_index])
+        finally:
+            if (home_index in self.pending_links and self.pending_links [home_index].done ()):
+                self.pending_links.pop (home_index)
+
+    async def connect (self, home_index, retries=10, retry_delay_s=0.5):
+        path = self.socket_path (home_index)
+        for attempt in range (retries):
+            try:
+                reader, writer = await asyncio.open_unix_connection (path=path)
+                break
+            except (FileNotFoundError, ConnectionError) as ex:
+                if (attempt == retries - 1):
+                    raise Exception (f"Could not connect to worker {home_index}: {ex}")
+                await asyncio.sleep (retry_delay_s)
+        link = WorkerLink (reader, writer, peer_worker_index=home_index)
+        link.write_frame (LINK_ATTACH, 0, str (self.worker_index).encode ())
+        self.home_links [home_index] = link
+        asyncio.get_event_loop ().create_task (link.process_frames ())
+        logger.info (f"worker link: connected to worker {home_index}")
+        return link
+
+#
+# Cluster support
+#
+# When cluster_directory is set, the proxy runs as one node of a cluster (e.g. behind a load
+# balancer). Each meetup is owned by the node its first client connected to, which is recorded in a
+# MeetupDirectory shared by the nodes. A client that lands on any other node is attached to the
+# meetup via a channel on a persistent, multiplexed (TLS) link to the owning node - using the same
+# link protocol as the worker pool. Nodes are identified by the host:port of their link listener.
+#
+
+class MeetupDirectory:
+    '''Records the node owning each meetup (the methods are coroutines, so a directory can be remote)'''
+    async def claim_meetup (self, meetup_id, node_id, previous_owner=None):
+        '''Make the node the meetup's owner if it has none (or if previous_owner owns it), returning the owner'''
+        raise NotImplementedError
+
+    async def release_meetup (self, meetup_id, node_id):
+        '''Remove the meetup's owner if it's the node'''
+        raise NotImplementedError
+
+    async def release_node (self, node_id):
+        '''Release all the meetups owned by the node (called when a node starts)'''
+        raise NotImplementedError
+
+class LocalMeetupDirectory (MeetupDirectory):
+    '''A directory held in the process (for testing - or a cluster of one node)'''
+    def __init__ (self):
+        self.owners = {}
+
+    async def claim_meetup (self, meetup_id, node_id, previous_owner=None):
+        owner = self.owners.get (meetup_id)
+        if (owner is None or owner == previous_owner):
+            owner = self.owners [meetup_id] = node_id
+        return owner
+
+    async def release_meetup (self, meetup_id, node_id):
+        if (self.owners.get (meetup_id) == node_id):
+            self.owners.pop (meetup_id)
+
+    async def release_node (self, node_id):
+        for meetup_id, owner in list (self.owners.items ()):
+            if (owner == node_id):
+                self.owners.pop (meetup_id)
+
+class FileMeetupDirectory (MeetupDirectory):
+    '''A directory of files shared by the nodes (e.g. on a shared filesystem)
+
+       Each owned meetup has a file containing the owner's node ID. A meetup's file is only read and
+       replaced (or removed) while holding an exclusive flock on the meetup's lock file - so claiming
+       or releasing a meetup is a compare-and-swap, even between nodes taking over the same meetup.
+       The file operations are done (in order) on a separate thread.'''
+    def __init__ (self, path):
+        self.path = pathlib.Path (path)
+        self.path.mkdir (parents=True, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor (max_workers=1)
+
+    def meetup_path (self, meetup_id):
+        return self.path / urllib.parse.quote (meetup_id, safe='')
+
+    def read_owner (self, path):
+        try:
+            return path.read_text ()
+        except FileNotFoundError:
+            return None
+
+    def write_temp_file (self, path, node_id):
+        temp_path = path.with_name (f".{path.name}.{urllib.parse.quote (node_id, safe='')}")
+        temp_path.write_text (node_id)
+        return temp_path
+
+    @contextlib.contextmanager
+    def locked (self, path):
+        '''Hold an exclusive lock on the meetup file's lock file (which is removed with the meetup file)'''
+        lock_path = path.with_name (f".{path.name}.lock")
+        while True:
+            lock_fd = os.open (str (lock_path), os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock (lock_fd, fcntl.LOCK_EX)
+            try:
+                # The lock file may have been removed (by a release) while waiting for the lock
+                if (os.fstat (lock_fd).st_ino == os.stat (str (lock_path)).st_ino):
+                    break
+            except FileNotFoundError:
+                pass
+            os.close (lock_fd)
+        try:
+            yield lock_path
+        finally:
+            os.close (lock_fd)
+
+    def claim (self, meetup_id, node_id, previous_owner):
+        path = self.meetup_path (meetup_id)
+        with self.locked (path):
+            owner = self.read_owner (path)
+            if (owner is None or owner == previous_owner):
+                temp_path = self.write_temp_file (path, node_id)
+                try:
+                    os.replace (str (temp_path), str (path))
+                finally:
+                    if (temp_path.exists ()):
+                        temp_path.unlink ()
+            # Return whoever actually owns the meetup now
+            return self.read_owner (path)
+
+    def release (self, meetup_id, node_id):
+        self.release_path (self.meetup_path (meetup_id), node_id)
+
+    def release_path (self, path, node_id):
+        with self.locked (path) as lock_path:
+            if (self.read_owner (path) == node_id):
+                path.unlink ()
+                # Note: Nodes waiting on the lock notice it was removed (and lock the new lock file)
+                lock_path.unlink ()
+
+    def release_all (self, node_id):
+        for path in list (self.path.iterdir ()):
+            if (not path.name.startswith (".") and self.read_owner (path) == node_id):
+                self.release_path (path, node_id)
+
+    async def run (self, function, *args):
+        return await asyncio.get_event_loop ().run_in_executor (self.executor, function, *args)
+
+    async def claim_meetup (self, meetup_id, node_id, previous_owner=None):
+        return await self.run (self.claim, meetup_id, node_id, previous_owner)
+
+    async def release_meetup (self, meetup_id, node_id):
+        await self.run (self.release, meetup_id, node_id)
+
+    async def release_node (self, node_id):
+        await self.run (self.release_all, node_id)
+
+def get_meetup_directory (spec):
+    '''Return the MeetupDirectory for cluster_directory ("local", "file:<path>" or "<module>:<class>")'''
+    if (spec == "local"):
+        return LocalMeetupDirectory ()
+    kind, location = spec.split (':', 1)
+    if (kind == "file"):
+        return FileMeetupDirectory (location)
+    return getattr (importlib.import_module (kind), location) ()
+
+def create_link_ssl_context ():
+    '''Return the TLS context used to connect to other nodes (which verify it like a client's)'''
+    ssl_context = ssl.SSLContext (ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_cert_chain (proxy_cert_path)
+    ssl_context.load_verify_locations (cafile = root_cert_path)
+    ssl_context.check_hostname = False
+    return ssl_context
+
+class ClusterLinkManager (WorkerLinkManager):
+    '''Claims meetups in the directory and maintains the links to the nodes owning remote meetups'''
+    def __init__ (self, directory, node_id):
+        # Note: The links are keyed by node ID (there's no worker count or socket directory)
+        super ().__init__ (node_id, None, None)
+        self.directory = directory
+        self.node_id = node_id
+        self.owned_meetups = set ()
+        self.link_ssl_context = None
+
+    def is_home (self, meetup_id):
+        # Note: A meetup which isn't owned yet is claimed when the client is accepted
+        return meetup_id in self.owned_meetups
+
+    async def start (self, ssl_context=None):
+        self.link_ssl_context = create_link_ssl_context () if ssl_context else None
+        # Meetups the node owned before it was restarted are gone
+        await self.directory.release_node (self.node_id)
+        self.link_server = await asyncio.start_server (self.link_accepted, cluster_link_bind_address,
+                                                       cluster_link_port, ssl=ssl_context)
+        logger.info (f"cluster: node {self.node_id} accepting links on {cluster_link_bind_address} "
+                     f"port {cluster_link_port}")
+
+    async def get_home_link (self, meetup_id):
+        owner = await self.directory.claim_meetup (meetup_id, self.node_id)
+        while (owner != self.node_id):
+            try:
+                return await self.get_link (owner)
+            except Exception as ex:
+                logger.warning (f"cluster: {ex} - taking over meetup {meetup_id} from node {owner}")
+                owner = await self.directory.claim_meetup (meetup_id, self.node_id, previous_owner=owner)
+        self.owned_meetups.add (meetup_id)
+        return None
+
+    async def accept_meetup (self, meetup_id):
+        if (meetup_id not in self.owned_meetups):
+            # The meetup may have closed (and been released) since the remote node looked up its owner
+            if (await self.directory.claim_meetup (meetup_id, self.node_id) != self.node_id):
+                return False
+            self.owned_meetups.add (meetup_id)
+        return True
+
+    def meetup_closed (self, meetup_id):
+        if (meetup_id in self.owned_meetups):
+            self.owned_meetups.discard (meetup_id)
+            asyncio.ensure_future (self.directory.release_meetup (meetup_id, self.node_id))
+
+    async def connect (self, node_id, timeout_s=10):
+        host, port = node_id.rsplit (':', 1)
+        try:
+            reader, writer = await asyncio.wait_for (asyncio.open_connection (host, int (port),
+                                                                             ssl=self.link_ssl_context),
+                                                     timeout_s)
+        except (OSError, asyncio.TimeoutError) as ex:
+            raise Exception (f"Could not connect to node {node_id}: {ex or 'timed out'}")
+        link = WorkerLink (reader, writer, peer_worker_index=node_id)
+        link.write_frame (LINK_ATTACH, 0, self.node_id.encode ('utf-8'))
+        self.home_links [node_id] = link
+        asyncio.get_event_loop ().create_task (link.process_frames ())
+        logger.info (f"cluster: connected to node {node_id}")
+        return link
+
+#
+# Draining
+#
+# On SIGTERM or SIGINT the proxy drains: it stops accepting connections, and closes the remaining
+# clients with close code 1001 ("going away") at random times spread over drain_window_s (both
+# clients of a meetup at the same time) - so they don't all reconnect at once. Clients which
+# disconnect on their own in the meantime aren't disturbed. The proxy exits once all its clients
+# are closed (or a second signal is received). On SIGUSR2, the proxy first starts a new proxy process
+# with the same command line - handing it the listening socket(s), via MICRONETS_WS_LISTEN_FDS - and
+# then drains.
+#
+
+def start_successor (listen_sockets=()):
+    '''Start a new proxy process with the same command line, which inherits the listening sockets'''
+    listen_fds = [listen_socket.fileno () for listen_socket in listen_sockets]
+    env = dict (os.environ)
+    if (listen_fds):
+        env ['MICRONETS_WS_LISTEN_FDS'] = ",".join (str (fd) for fd in listen_fds)
+    return subprocess.Popen ([sys.executable] + sys.argv, env=env, pass_fds=listen_fds)
+
+def get_inherited_sockets ():
+    '''Return the listening sockets handed over by the process this one is replacing (if any)'''
+    listen_fds = os.environ.pop ('MICRONETS_WS_LISTEN_FDS', None)
+    if (not listen_fds):
+        return []
+    return [socket.socket (fileno=int (fd)) for fd in listen_fds.split (',')]
+
+class ProxyDrainer:
+    '''Stops the proxy accepting connections and closes its clients over the drain window'''
+    def __init__ (self):
+        self.servers = []
+        self.metrics_server = None
+        self.admin_server = None
+        self.draining = False
+        self.scheduled_clients = set ()
+        self.meetup_close_times = {}
+        self.window_end_time = None
+
+    def request_drain (self, reason, handoff=False, start_new=True):
+        '''Start draining - when handing off, start_new determines if the new process is started here
+           (pool workers are handed off by the supervisor, which starts the new pool)'''
+        if (self.draining):
+            if (not handoff):
+                logger.warning (f"Received {reason} while draining - STOPPING")
+                asyncio.get_event_loop ().stop ()
+            return
+        if (handoff and cluster_directory):
+            # The new process couldn't listen for node links until this one exits
+            logger.warning (f"Received {reason} - handing off isn't supported in cluster mode (draining instead)")
+            handoff = False
+        self.draining = True
+        metrics.draining.labels ().set (1)
+        asyncio.ensure_future (self.drain (reason, handoff, start_new))
+
+    async def drain (self, reason, handoff, start_new=True):
+        loop = asyncio.get_event_loop ()
+        logger.info (f"Draining ({reason}) - closing {meetup_registry.connection_count} connections "
+                     f"over {drain_window_s} seconds...")
+        listen_sockets = [listen_socket for server in self.servers for listen_socket in server.sockets or ()]
+        if (handoff):
+            for server in (self.metrics_server, self.admin_server):
+                if (server):
+                    server.close ()
+        if (handoff and start_new):
+            try:
+                successor = start_successor (listen_sockets)
+                logger.info (f"Started the new proxy process (pid {successor.pid})")
+            except OSError as ose:
+                logger.error (f"Could not start a new proxy process: {ose}")
+        # Established connections aren't affected by closing the servers
+        for server in self.servers:
+            server.close ()
+        self.window_end_time = loop.time () + drain_window_s
+        close_reason = "the proxy is restarting" if handoff else "the proxy is shutting down"
+        # Clients that are still completing their handshakes are picked up on the next check
+        deadline = self.window_end_time + ws_close_timeout_s + 1
+        next_report_time = loop.time () + drain_report_interval_s
+        while (meetup_registry.connection_count and loop.time () < deadline):
+            self.schedule_closes (close_reason)
+            await asyncio.sleep (min (1, drain_report_interval_s))
+            if (loop.time () >= next_report_time):
+                logger.info (f"Draining: {meetup_registry.connection_count} connections and "
+                             f"{len (meetup_registry)} meetups remaining")
+                next_report_time += drain_report_interval_s
+        logger.info (f"Drained ({meetup_registry.connection_count} connections remaining) - exiting")
+        loop.stop ()
+
+    def schedule_closes (self, close_reason):
+        loop = asyncio.get_event_loop ()
+        for clients in list (meetup_registry.by_address.values ()):
+            for client in clients:
+                if (client in self.scheduled_clients):
+                    continue
+                # The clients of a meetup are closed together (rather than one being closed as the peer)
+                close_time = self.meetup_close_times.get (client.meetup_id)
+                if (close_time is None):
+                    close_time = random.uniform (loop.time (), max (loop.time (), self.window_end_time))
+                    if (client.meetup_id is not None):
+                        self.meetup_close_times [client.meetup_id] = close_time
+                self.scheduled_clients.add (client)
+                loop.call_at (close_time, self.close_client, client, close_reason)
+
+    def close_client (self, client, close_reason):
+        if (client.websocket.open):
+            asyncio.ensure_future (client.close_websocket (1001, close_reason))
+
+drainer = ProxyDrainer ()
+
+#
+# Configuration
+#
+# Every setting in config_settings can be set (in increasing order of precedence) in a JSON config
+# file (an object with the setting names as keys), via a MICRONETS_WS_<SETTING NAME> environment
+# variable, or via a --<setting-name> command line option. Settings are validated at startup.
+#
+
+def parse_bool (value):
+    if isinstance (value, bool):
+        return value
+    if str (value).lower () in ("true", "yes", "on", "1"):
+        return True
+    if str (value).lower () in ("false", "no", "off", "0"):
+        return False
+    raise ValueError (f"{value!r} is not a boolean (true/false)")
+
+def parse_path (value):
+    return pathlib.Path (value)
+
+# Setting name: (type, allowed values or (min, max), help)
+config_settings = {
+    'proxy_bind_address': (str, None, "the address to listen on"),
+    'proxy_port': (int, (1, 65535), "the port to listen on"),
+    'proxy_service_prefix': (str, None, "the path prefix of websocket (meetup) URIs"),
+    'meetup_id_pattern': (str, None, "the regular expression meetup IDs have to match"),
+    'proxy_cert_path': (parse_path, None, "the proxy's certificate and private key (PEM)"),
+    'root_cert_path': (parse_path, None, "the CA certificate(s) used to verify client certificates (PEM)"),
+    'tls_session_tickets': (parse_bool, None, "allow TLS session resumption via session tickets"),
+    'tls_reload_check_interval_s': (float, (0, None), "seconds between checks for changed cert files (0: SIGHUP only)"),
+    'report_interval_s': (float, (0, None), "seconds between meetup table reports (0 to disable)"),
+    'proxy_worker_count': (int, (0, 1024), "worker processes to run (0 to run in a single process)"),
+    'listen_backlog': (int, (1, None), "the listen() backlog"),
+    'max_meetups': (int, (0, None), "meetups per process before new meetups are refused (0 for no limit)"),
+    'max_connections': (int, (0, None), "connections per process before new connections are refused (0 for no limit)"),
+    'max_connections_per_address': (int, (0, None), "connections per process from one IP address (0 for no limit)"),
+    'meetup_half_open_ttl_s': (float, (0, None), "seconds a client can wait for a peer (0 for no limit)"),
+    'hello_max_size': (int, (0, None), "the maximum size of a HELLO message (0 for ws_max_size)"),
+    'hello_timeout_s': (float, (0, None), "seconds a client has to send its HELLO message (0 for no limit)"),
+    'router_path': (str, None, "the path router clients connect to (\"\" to disable routing mode)"),
+    'event_path': (str, None, "the path event subscribers connect to (\"\" to disable event fan-out)"),
+    'event_queue_max_messages': (int, (1, None), "events queued per event subscriber"),
+    'event_queue_max_bytes': (int, (0, None), "bytes of events queued per event subscriber (0 for no limit)"),
+    'session_resume_grace_s': (float, (0, None), "seconds a client is held for its peer to reconnect (0 to disable)"),
+    'session_resume_max_messages': (int, (1, None), "messages replayed to a reconnecting peer"),
+    'cluster_directory': (str, None, "the cluster meetup directory (\"\" to run standalone)"),
+    'cluster_link_bind_address': (str, None, "the address to accept cluster node links on"),
+    'cluster_link_port': (int, (1, 65535), "the port to accept cluster node links on"),
+    'cluster_link_address': (str, None, "the host:port other cluster nodes connect to"),
+    'cluster_link_tls': (parse_bool, None, "use TLS for the links between cluster nodes"),
+    'link_channel_queue_max_bytes': (int, (0, None), "bytes queued per worker/cluster link channel (0 for no limit)"),
+    'drain_window_s': (float, (0, None), "seconds over which clients are closed when draining"),
+    'drain_report_interval_s': (float, (0.1, None), "seconds between drain progress messages"),
+    'json_backend': (str, ["auto", "json", "orjson", "ujson"], "the JSON parser used for HELLO messages"),
+    'event_loop': (str, ["auto", "asyncio", "uvloop"], "the event loop implementation"),
+    'ws_max_size': (int, (0, None), "the maximum received message size (0 for no limit)"),
+    'ws_max_queue': (int, (0, None), "received messages buffered per client (0 for no limit)"),
+    'ws_read_limit': (int, (1, None), "the read buffer high-water mark"),
+    'ws_write_limit': (int, (1, None), "the write buffer high-water mark"),
+    'ws_compression': (str, ["deflate", "none"], "websocket compression"),
+    'ws_compression_window_bits': (int, (9, 15), "the LZ77 window bits the proxy compresses with"),
+    'ws_compression_client_window_bits': (int, (9, 15), "the LZ77 window bits clients are asked to compress with"),
+    'ws_compression_mem_level': (int, (1, 9), "the zlib memLevel used for compression"),
+    'ws_compression_level': (int, (0, 9), "the zlib compression level"),
+    'ws_compression_no_context_takeover': (parse_bool, None, "compress each message independently"),
+    'ws_compression_min_size': (int, (0, None), "the size below which messages are sent uncompressed"),
+    'ws_close_timeout_s': (float, (0, None), "seconds to wait for the closing handshake"),
+    'ping_interval_s': (float, (0, None), "seconds a client can be idle before it's pinged (0 to disable)"),
+    'ping_timeout_s': (float, (0, None), "seconds to wait for a pong"),
+    'keepalive_tick_s': (float, (0.01, None), "the resolution of the keepalive timer"),
+    'relay_raw_frames': (parse_bool, None, "relay websocket frames without decoding them"),
+    'relay_max_buffered_size': (int, (0, None), "bytes of a frame buffered before they're relayed (0 for whole frames)"),
+    'relay_queue_max_messages': (int, (0, None), "messages queued per client (0 to send inline)"),
+    'relay_queue_max_bytes': (int, (0, None), "bytes queued per client (0 for no limit)"),
+    'relay_queue_policy': (str, ["block", "drop-oldest-event", "close"], "what to do when a relay queue is full"),
+    'relay_queue_close_code': (int, (1000, 4999), "the close code for the \"close\" relay queue policy"),
+    'rate_limit_messages_per_s': (float, (0, None), "messages per second a client can send (0 for no limit)"),
+    'rate_limit_bytes_per_s': (float, (0, None), "bytes per second a client can send (0 for no limit)"),
+    'rate_limit_burst_s': (float, (0, None), "seconds of traffic a client can send in a burst"),
+    'rate_limit_action': (str, ["delay", "drop", "close"], "what to do when a client exceeds its rate limits"),
+    'metrics_bind_address': (str, None, "the address for the HTTP metrics endpoint"),
+    'metrics_port': (int, (0, 65535), "the port for the HTTP metrics endpoint (0 to disable)"),
+    'admin_socket_path': (str, None, "the unix socket for the admin API (\"\" to disable)"),
+    'loop_lag_check_interval_s': (float, (0, None), "seconds between event loop lag measurements (0 to disable)"),
+    'slow_callback_threshold_s': (float, (0, None), "seconds the loop can be blocked before its stack is logged (0 to disable)"),
+    'profile_duration_s': (float, (0.1, 300), "seconds the sampling profiler runs for"),
+    'profile_sample_interval_s': (float, (0.0001, 1), "seconds between profiler samples"),
+    'profile_dump_dir': (str, None, "the directory for profiles taken on SIGUSR1"),
+    'log_level': (str.upper, ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], "the log level"),
+    'log_format': (str, ["text", "json"], "the log format"),
+    'log_queue_handler': (parse_bool, None, "write log records from a separate thread"),
+    'relay_log_sample_rate': (int, (0, None), "log 1 in N relayed messages at DEBUG (0 to disable)"),
+    'log_rate_limit_interval_s': (float, (0, None), "seconds between repeats of per-message warnings"),
+}
+
+def convert_setting (name, value):
+    value_type, allowed, help_text = config_settings [name]
+    if (value_type in (int, float) and isinstance (value, bool)):
+        raise ValueError (f"{value!r} is not a number")
+    try:
+        value = value_type (value)
+    except (TypeError, ValueError):
+        if (value_type is int):
+            raise ValueError (f"{value!r} is not an integer")
+        if (value_type is float):
+            raise ValueError (f"{value!r} is not a number")
+        raise
+    if (isinstance (allowed, list) and value not in allowed):
+        raise ValueError (f"{value!r} is not one of {', '.join (allowed)}")
+    if (isinstance (allowed, tuple)):
+        min_value, max_value = allowed
+        if ((min_value is not None and value < min_value) or (max_value is not None and value > max_value)):
+            raise ValueError (f"{value!r} is out of range ({min_value} to {max_value if max_value is not None else 'unlimited'})")
+    return value
+
+def check_config ():
+    '''Return a list of problems with combinations of settings'''
+    problems = []
+    if (ping_interval_s and not ping_timeout_s):
+        problems.append ("ping_timeout_s must be set when ping_interval_s is set")
+    if (not (1000 <= relay_queue_close_code <= 1003 or 1007 <= relay_queue_close_code <= 1011
+             or 3000 <= relay_queue_close_code <= 4999)):
+        problems.append (f"relay_queue_close_code: {relay_queue_close_code} can't be sent in a close frame")
+    if (metrics_port and proxy_worker_count > 1 and metrics_port + proxy_worker_count - 1 > 65535):
+        problems.append ("metrics_port: the worker metrics ports would exceed 65535")
+    if (not proxy_service_prefix.startswith ("/")):
+        problems.append (f"proxy_service_prefix: {proxy_service_prefix!r} doesn't start with /")
+    if (router_path and not router_path.startswith ("/")):
+        problems.append (f"router_path: {router_path!r} doesn't start with /")
+    # Meetups which aren't homed in this process can't be routed, published or held
+    distributed = proxy_worker_count > 1 or cluster_directory
+    if (router_path and distributed):
+        problems.append ("router_path: routing mode isn't supported with a worker pool or cluster")
+    if (event_path and not event_path.startswith ("/")):
+        problems.append (f"event_path: {event_path!r} doesn't start with /")
+    if (event_path and distributed):
+        problems.append ("event_path: event fan-out isn't supported with a worker pool or cluster")
+    if (event_path and event_path == router_path):
+        problems.append ("event_path: the event_path and router_path have to be different")
+    if (session_resume_grace_s and relay_raw_frames):
+        problems.append ("session_resume_grace_s: sessions can't be resumed when relaying raw frames")
+    if (session_resume_grace_s and distributed):
+        problems.append ("session_resume_grace_s: sessions can't be resumed with a worker pool or cluster")
+    if (cluster_directory and proxy_worker_count > 1):
+        problems.append ("cluster_directory: a cluster node can't run a worker pool (proxy_worker_count)")
+    if (cluster_directory and cluster_directory != "local"
+          and not re.fullmatch (r"file:.+|[\w.]+:\w+", cluster_directory)):
+        problems.append (f"cluster_directory: {cluster_directory!r} isn't \"local\", \"file:<path>\" or "
+                         f"\"<module>:<class>\"")
+    if (cluster_link_address and not re.fullmatch (r".+:\d+", cluster_link_address)):
+        problems.append (f"cluster_link_address: {cluster_link_address!r} isn't a host:port")
+    try:
+        re.compile (meetup_id_pattern)
+    except re.error as ree:
+        problems.append (f"meetup_id_pattern: {meetup_id_pattern!r} isn't a valid regular expression ({ree})")
+    return problems
+
+def load_config (argv=None):
+    '''Apply the config file, environment variables and command line options to the settings'''
+    arg_parser = argparse.ArgumentParser (description="Micronets websocket proxy")
+    arg_parser.add_argument ('--config', metavar="FILE",
+                             help="a JSON config file of settings (or set MICRONETS_WS_CONFIG)")
+    for name, (value_type, allowed, help_text) in config_settings.items ():
+        if (isinstance (allowed, list)):
+            metavar = "{" + ",".join (allowed) + "}"
+        elif (value_type is parse_bool):
+            metavar = "{true,false}"
+        else:
+            metavar = None
+        # Note: argparse %-formats help strings (and defaults like meetup_id_pattern contain '%')
+        help_text = f"{help_text} (default: {globals () [name]})".replace ('%', '%%')
+        arg_parser.add_argument ('--' + name.replace ('_', '-'), dest=name, metavar=metavar, help=help_text)
+    args = arg_parser.parse_args (argv)
+
+    def config_error (message):
+        arg_parser.exit (2, f"{arg_parser.prog}: error: {message}\n")
+
+    settings = {}
+    config_path = args.config or os.environ.get ('MICRONETS_WS_CONFIG')
+    if (config_path):
+        try:
+            with open (config_path) as config_file:
+                config = json.load (config_file)
+        except (OSError, ValueError) as ex:
+            config_error (f"Could not read config file {config_path}: {ex}")
+        if (not isinstance (config, dict)):
+            config_error (f"Config file {config_path} doesn't contain a JSON object")
+        unknown_settings = [name for name in config if name not in config_settings]
+        if (unknown_settings):
+            config_error (f"Unknown setting(s) in {config_path}: {', '.join (unknown_settings)}")
+        settings.update (config)
+    for name in config_settings:
+        env_value = os.environ.get ('MICRONETS_WS_' + name.upper ())
+        if (env_value is not None):
+            settings [name] = env_value
+        if (getattr (args, name) is not None):
+            settings [name] = getattr (args, name)
+
+    problems = []
+    for name, value in settings.items ():
+        try:
+            globals () [name] = convert_setting (name, value)
+        except ValueError as ve:
+            problems.append (f"{name}: {ve}")
+    if (not problems):
+        problems = check_config ()
+    if (problems):
+        config_error ("invalid configuration:\n  " + "\n  ".join (problems))
+    try:
+        globals () ['json_loads'] = get_json_loads (json_backend)
+    except ImportError as ie:
+        config_error (f"json_backend: {json_backend} isn't available ({ie})")
+    try:
+        globals () ['event_loop_in_use'] = install_event_loop (event_loop)
+    except ImportError as ie:
+        config_error (f"event_loop: {event_loop} isn't available ({ie})")
+
+    # The keepalive scheduler is created before the configuration is loaded
+    keepalive_scheduler.tick_s = keepalive_tick_s
+
+def create_ssl_context ():
+    ssl_context = ssl.SSLContext (ssl.PROTOCOL_TLS_SERVER)
+
+    # Setup the proxy's cert
+    logger.info ("Loading proxy certificate from %s", proxy_cert_path)
+    ssl_context.load_cert_chain (proxy_cert_path)
+
+    # Enable client cert verification
+    logger.info ("Loading CA certificate from %s", root_cert_path)
+    ssl_context.load_verify_locations (cafile = root_cert_path)
+    ssl_context.verify_mode = ssl.VerifyMode.CERT_REQUIRED
+    ssl_context.check_hostname = False
+
+    # Resumed sessions skip the certificate exchange and chain verification entirely. Session IDs are
+    # cached by each process, but session tickets are stateless - and since the worker pool is forked
+    # after this context is created, every worker shares the ticket keys and can resume a session
+    # established with any other worker.
+    if (not tls_session_tickets):
+        ssl_context.options |= ssl.OP_NO_TICKET
+    return ssl_context
+
+def collect_tls_session_stats (ssl_context):
+    for stat, value in ssl_context.session_stats ().items ():
+        # The "connect" stats are for client-side sessions, and "number" is the cache size (not a counter)
+        if (stat == "number"):
+            metrics.tls_session_cache_size.labels ().set (value)
+        elif (not stat.startswith ("connect")):
+            metrics.tls_session_stats.labels (stat).set (value)
+
+class TLSContextManager:
+    '''Provides the TLS context for new handshakes - and rebuilds it when the certificates change
+
+       The listening context (the one passed to websockets.serve()) never changes. Its SNI callback,
+       which OpenSSL calls during every handshake (whether or not the client sent SNI), switches the
+       connection to the current context - so a reload only affects new handshakes. Since TLS
+       sessions and ticket keys belong to the listening context, sessions established before a
+       reload can still be resumed after it (on any worker).'''
+    def __init__ (self, ssl_context):
+        self.listen_context = ssl_context
+        self.current_context = ssl_context
+        self.file_mtimes = self.get_file_mtimes ()
+        self.reload_task = None
+        ssl_context.set_servername_callback (self.servername_callback)
+
+    def servername_callback (self, ssl_object, server_name, ssl_context):
+        if (self.current_context is not ssl_context):
+            ssl_object.context = self.current_context
+        return None
+
+    def get_file_mtimes (self):
+        file_mtimes = []
+        for path in (proxy_cert_path, root_cert_path):
+            try:
+                file_mtimes.append (os.stat (path).st_mtime_ns)
+            except OSError:
+                file_mtimes.append (None)
+        return file_mtimes
+
+    def reload_now (self, reason):
+        '''Synchronously rebuild the current context (used by the worker pool supervisor)'''
+        logger.info (f"Reloading TLS certificates ({reason})...")
+        self.file_mtimes = self.get_file_mtimes ()
+        try:
+            self.context_loaded (create_ssl_context ())
+        except Exception as ex:
+            self.reload_failed (ex)
+
+    def request_reload (self, reason):
+        if (self.reload_task and not self.reload_task.done ()):
+            logger.info (f"Not reloading TLS certificates ({reason}) - a reload is already in progress")
+            return
+        self.reload_task = asyncio.ensure_future (self.reload (reason))
+
+    async def reload (self, reason):
+        logger.info (f"Reloading TLS certificates ({reason})...")
+        loop = asyncio.get_event_loop ()
+        start_time = loop.time ()
+        # Note: Updated before loading, so a bad file isn't reloaded over and over (until it changes again)
+        self.file_mtimes = self.get_file_mtimes ()
+        try:
+            ssl_context = await loop.run_in_executor (None, create_ssl_context)
+        except Exception as ex:
+            self.reload_failed (ex)
+            return
+        self.context_loaded (ssl_context)
+        logger.info (f"Reloaded TLS certificates in {loop.time () - start_time:.3f} seconds")
+
+    def context_loaded (self, ssl_context):
+        self.current_context = ssl_context
+        metrics.tls_reloads.labels ("ok").inc ()
+        metrics.tls_reload_time.labels ().set (time.time ())
+
+    def reload_failed (self, exception):
+        logger.error (f"Failed to reload TLS certificates - still using the previous certificates: {exception}")
+        metrics.tls_reloads.labels ("failed").inc ()
+
+    async def watch_files (self, check_interval_s):
+        logger.info (f"Checking for changes to the TLS certificate files every {check_interval_s} seconds")
+        while True:
+            await asyncio.sleep (check_interval_s)
+            if (self.get_file_mtimes () != self.file_mtimes):
+                self.request_reload ("the certificate files changed")
+
+def run_proxy (tls_contexts, worker_index=None, worker_socket_dir=None):
+    global logger, worker_links
+    serve_args = {}
+    if (worker_index is not None):
+        logger = logging.getLogger (f"micronets-ws-proxy-{worker_index}")
+        worker_links = WorkerLinkManager (worker_index, proxy_worker_count, worker_socket_dir)
+        asyncio.get_event_loop ().run_until_complete (worker_links.start ())
+        serve_args ['reuse_port'] = True
+    elif (cluster_directory):
+        node_id = cluster_link_address or f"{socket.gethostname ()}:{cluster_link_port}"
+        worker_links = ClusterLinkManager (get_meetup_directory (cluster_directory), node_id)
+        link_ssl_context = tls_contexts.listen_context if cluster_link_tls else None
+        asyncio.get_event_loop ().run_until_complete (worker_links.start (link_ssl_context))
+
+    ssl_context = tls_contexts.listen_context
+    loop = asyncio.get_event_loop ()
+    loop.add_signal_handler (signal.SIGHUP, tls_contexts.request_reload, "received SIGHUP")
+    loop.add_signal_handler (signal.SIGTERM, drainer.request_drain, "SIGTERM")
+    loop.add_signal_handler (signal.SIGUSR1, profiler.request_dump)
+    if (loop_lag_check_interval_s):
+        loop_monitor.start (loop_lag_check_interval_s, slow_callback_threshold_s)
+    if (worker_index is None):
+        # Pool workers are handed off and stopped by the supervisor
+        loop.add_signal_handler (signal.SIGINT, drainer.request_drain, "SIGINT")
+        loop.add_signal_handler (signal.SIGUSR2, drainer.request_drain, "SIGUSR2", True)
+    else:
+        # The supervisor sends SIGUSR2 once it has started the new pool
+        loop.add_signal_handler (signal.SIGUSR2, drainer.request_drain, "SIGUSR2", True, False)
+    if tls_reload_check_interval_s > 0:
+        loop.create_task (tls_contexts.watch_files (tls_reload_check_interval_s))
+
+    # A process started by start_successor() listens on the sockets of the process it's replacing
+    inherited_sockets = get_inherited_sockets ()
+    if (inherited_sockets):
+        listen_args = [{'sock': inherited_socket} for inherited_socket in inherited_sockets]
+    else:
+        listen_args = [{'host': proxy_bind_address, 'port': proxy_port}]
+    websockets_servers = [websockets.serve (ws_connected, ssl=ssl_context,
+                                            create_protocol=RelayServerProtocol, backlog=listen_backlog,
+                                            max_size=ws_max_size or None, max_queue=ws_max_queue,
+                                            read_limit=ws_read_limit, write_limit=ws_write_limit,
+                                            compression=None, extensions=get_extension_factories (),
+                                            timeout=ws_close_timeout_s, **listen_arg, **serve_args)
+                          for listen_arg in listen_args]
+
+    if report_interval_s > 0:
+        start_websocket_reporting (report_interval_s)
+
+    if metrics_port:
+        metrics.collectors.append (lambda: collect_tls_session_stats (ssl_context))
+        metrics_server_port = metrics_port + (worker_index or 0)
+        # Note: Pool workers share their metrics port with the workers of a new pool while they drain
+        drainer.metrics_server = asyncio.get_event_loop ().run_until_complete (
+                                     start_metrics_server (metrics_bind_address, metrics_server_port, **serve_args))
+
+    if admin_socket_path:
+        admin_server_path = admin_socket_path + (f".{worker_index}" if worker_index is not None else "")
+        drainer.admin_server = asyncio.get_event_loop ().run_until_complete (start_admin_server (admin_server_path))
+
+    logger.info (f"Starting micronets websocket proxy on {proxy_bind_address} port {proxy_port} "
+                 f"(event loop: {event_loop_in_use})"
+                 + (" using the inherited listening socket..." if inherited_sockets else "..."))
+    for websockets_server in websockets_servers:
+        drainer.servers.append (asyncio.get_event_loop ().run_until_complete (websockets_server).server)
+    asyncio.get_event_loop ().run_forever ()
+
+def run_proxy_worker (tls_contexts, worker_index, worker_socket_dir):
+    # The supervisor takes care of shutting the workers down (the supervisor's handlers are inherited)
+    signal.signal (signal.SIGINT, signal.SIG_IGN)
+    signal.signal (signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal (signal.SIGTERM, signal.SIG_DFL) # until run_proxy() installs its (drain) handler
+    signal.signal (signal.SIGHUP, signal.SIG_IGN) # until run_proxy() installs its handler
+    signal.signal (signal.SIGUSR1, signal.SIG_IGN) # ditto
+    # A loop the supervisor created can't be used across the fork (uvloop's in particular)
+    asyncio.set_event_loop (asyncio.new_event_loop ())
+    setup_logging ()
+    run_proxy (tls_contexts, worker_index, worker_socket_dir)
+
+def run_worker_pool (tls_contexts, worker_count):
+    # Note: The workers are forked so they share the SSL context (and the TLS session state it carries)
+    mp_context = multiprocessing.get_context ('fork')
+    worker_socket_dir = tempfile.mkdtemp (prefix="micronets-ws-proxy-")
+    workers = {}
+
+    def start_worker (worker_index):
+        worker = mp_context.Process (target=run_proxy_worker, name=f"ws-proxy-worker-{worker_index}",
+                                     args=(tls_contexts, worker_index, worker_socket_dir))
+        worker.start ()
+        logger.info (f"Started proxy worker {worker_index} (pid {worker.pid})")
+        workers [worker.pid] = worker_index
+
+    # Note: The signal handlers can run in the middle of anything the supervisor is doing - including
+    #       queueing a log record (with the log queue's lock held). So they don't log, reload or start
+    #       processes, they just record the signal (and signal the workers) and leave the rest to the
+    #       wait loop.
+    stop_signals = []
+    reload_signals = []
+    handoff_signals = []
+    successors = []
+
+    def stop_workers (signum, frame):
+        # The workers drain and exit (and aren't restarted) - another signal stops them straight away
+        stop_signals.append (signum)
+        for pid in list (workers):
+            os.kill (pid, signal.SIGTERM)
+
+    def hand_off (signum, frame):
+        handoff_signals.append (signum)
+
+    def hand_off_workers (signum):
+        # The new pool's workers listen alongside the draining workers (using SO_REUSEPORT)
+        handoff_signals.clear ()
+        try:
+            successors.append (start_successor ())
+        except OSError as ose:
+            logger.error (f"Received signal {signum} - could not start a new proxy process: {ose}")
+            return
+        logger.info (f"Received signal {signum} - started the new proxy process (pid {successors [0].pid})")
+        stop_signals.append (signum)
+        for pid in list (workers):
+            os.kill (pid, signal.SIGUSR2)
 
-# Setup the proxy's cert
-logger.info ("Loading proxy certificate from %s", proxy_cert_path)
-ssl_context.load_cert_chain (proxy_cert_path)
+    def reload_certs (signum, frame):
+        # The supervisor reloads too (before it restarts a worker) - so restarted workers start with
+        # the current certificates
+        reload_signals.append (signum)
+        for pid in list (workers):
+            os.kill (pid, signum)
 
-# Enable client cert verification
-logger.info ("Loading CA certificate from %s", root_cert_path)
-ssl_context.load_verify_locations (cafile = root_cert_path)
-ssl_context.verify_mode = ssl.VerifyMode.CERT_REQUIRED
-ssl_context.check_hostname = False
+    def forward_signal (signum, frame):
+        for pid in list (workers):
+            os.kill (pid, signum)
 
-websocket = websockets.serve (ws_connected, proxy_bind_address, proxy_port, ssl=ssl_context)
+    signal.signal (signal.SIGTERM, stop_workers)
+    signal.signal (signal.SIGINT, stop_workers)
+    signal.signal (signal.SIGHUP, reload_certs)
+    signal.signal (signal.SIGUSR2, hand_off)
+    # Each worker writes its own profile
+    signal.signal (signal.SIGUSR1, forward_signal)
 
-if report_interval_s > 0:
-    start_websocket_reporting (report_interval_s)
+    logger.info (f"Starting {worker_count} proxy workers (worker links in {worker_socket_dir})...")
+    for worker_index in range (worker_count):
+        start_worker (worker_index)
+    while workers:
+        if (handoff_signals and not stop_signals):
+            hand_off_workers (handoff_signals [0])
+        # Polled, so a handoff isn't held up until a worker exits (os.wait () resumes after a signal)
+        pid, status = os.waitpid (-1, os.WNOHANG)
+        if (not pid):
+            time.sleep (0.1)
+            continue
+        worker_index = workers.pop (pid, None)
+        if (worker_index is None):
+            continue
+        if (stop_signals):
+            logger.info (f"Proxy worker {worker_index} (pid {pid}) stopped after receiving signal "
+                         f"{stop_signals [0]} ({len (workers)} workers still draining)")
+            continue
+        logger.warning (f"Proxy worker {worker_index} (pid {pid}) exited with status {status} - RESTARTING")
+        if (reload_signals):
+            tls_contexts.reload_now (f"received signal {reload_signals [-1]}")
+            reload_signals.clear ()
+        start_worker (worker_index)
+    if (successors):
+        logger.info (f"Handed off to the new proxy process (pid {successors [0].pid})")
+    logger.info ("Stopped all proxy workers")
 
-logger.info (f"Starting micronets websocket proxy on {proxy_bind_address} port {proxy_port}...")
-asyncio.get_event_loop ().run_until_complete (websocket)
-asyncio.get_event_loop ().run_forever ()
+if __name__ == "__main__":
+    load_config ()
+    setup_logging ()
+    if (event_path and relay_raw_frames):
+        logger.warning ("event_path: EVENT messages relayed as fragmented frames (e.g. ones over "
+                        "relay_max_buffered_size bytes) aren't published when relay_raw_frames is set")
+    tls_contexts = TLSContextManager (create_ssl_context ())
+    if (proxy_worker_count > 1):
+        run_worker_pool (tls_contexts, proxy_worker_count)
+    else:
+        run_proxy (tls_contexts)
@@ -12,7 +12,6 @@ import traceback
 import pathlib
 import ssl
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
 from websockets import ConnectionClosed
 
 bin_path = pathlib.Path (__file__).parent
@@ -31,12 +30,17 @@ arg_parser.add_argument ('--client-cert', "-cc", required=False, action='store',
 arg_parser.add_argument ('--ca-cert', "-ca", required=False, action='store', type=open,
                          default = bin_path.parent.parent.joinpath ('lib/micronets-ws-root.cert.pem'),
                          help="the client cert file")
+arg_parser.add_argument ('--request-timeout', "-t", required=False, action='store', type=float,
+                         default = 30, help="seconds to wait for the response to a relayed HTTP request")
+arg_parser.add_argument ('--body-chunk-size', "-b", required=False, action='store', type=int,
+                         default = 0, help="send request bodies longer than this in REST:CONTINUATION chunks (0 to not chunk)")
 arg_parser.add_argument ("connect_uri", action='store', help="the uri for the server websocket")
 
 args = arg_parser.parse_args ()
 
 websocket = None
-pending_requests = {}
+pending_requests = {} # messageId: the future for the response to a relayed REST request
+chunked_messages = {} # messageId: (the first message of a chunked message, the body chunks received so far)
 
 async def init_connection (ssl_context, dest):
     if (ssl_context):
@@ -64,11 +68,25 @@ async def send_hello_message (websocket):
     print ("ws-test-client: > sending hello message: ", message)
     await websocket.send (message)
 
-async def send_rest_message (websocket, message):
+async def send_rest_message (websocket, message, response_future=None):
+    '''Send the message with the next messageId, returning the messageId
+
+       If response_future is given, it's registered (in pending_requests) for the response before the
+       message is sent - so a fast response can't be missed.'''
     global message_id
+    sent_message_id = message_id
     message_id += 1
-    print ("ws-test-client: > sending REST message: ", message)
-    await websocket.send (message)
+    message ['messageId'] = sent_message_id
+    message_json = json.dumps ({'message': message}, indent=2)
+    if (response_future):
+        pending_requests [sent_message_id] = response_future
+    print ("ws-test-client: > sending REST message: ", message_json)
+    try:
+        await websocket.send (message_json)
+    except ConnectionClosed:
+        pending_requests.pop (sent_message_id, None)
+        raise
+    return sent_message_id
 
 def check_message (message):
     message_body = check_json_field (message, 'message', dict, True)
@@ -97,21 +115,45 @@ async def receive (websocket):
         message = await websocket.recv ()
         print (f"ws-test-client: < received: {message}")
         message_json = json.loads (message) ['message']
+        if (message_json.get ('lastChunk') is False or message_json ['messageType'] == 'REST:CONTINUATION'):
+            message_json = add_body_chunk (message_json)
+            if (not message_json):
+                continue
         if ('inResponseTo' in message_json):
             in_response_to_id = message_json ['inResponseTo']
             print (f"ws-test-client: ws_reader: Message {message_json['messageId']} "
                    f"is a response to {in_response_to_id} - signaling future #{in_response_to_id}")
-            response_cond = pending_requests.pop (in_response_to_id)
-            if (not response_cond or not isinstance (response_cond, threading.Condition)):
-                print (f"ws-test-client: ws_reader: No condition found for message {in_response_to_id}!")
-            else:
-                with response_cond:
-                    pending_requests [in_response_to_id] = message
-                    response_cond.notify_all ()
+            response_future = pending_requests.pop (in_response_to_id, None)
+            if (not response_future):
+                print (f"ws-test-client: ws_reader: No future found for message {in_response_to_id}!")
+            elif (not response_future.done ()):
+                response_future.set_result (message_json)
         if (message_json ['messageType'] == 'REST:REQUEST'):
             print (f"ws-test-client: ws_reader: Found rest {message_json ['method']} request for {message_json ['path']}")
             await handle_rest_request (websocket, message_json)
 
+def add_body_chunk (message):
+    '''Collect the body chunks of a chunked message, returning the message (with the whole body) once
+       the last chunk is received'''
+    if (message ['messageType'] != 'REST:CONTINUATION'):
+        print (f"ws-test-client: add_body_chunk: Message {message ['messageId']} has a chunked body")
+        chunked_messages [message ['messageId']] = (message, [message.get ('messageBody', "")])
+        return None
+    first_message, body_chunks = chunked_messages.get (message ['continues'], (None, None))
+    if (not first_message):
+        print (f"ws-test-client: add_body_chunk: No chunked message {message ['continues']} to continue!")
+        return None
+    body_chunks.append (message ['messageBody'])
+    if (not message ['lastChunk']):
+        return None
+    chunked_messages.pop (message ['continues'])
+    body = "".join (body_chunks)
+    print (f"ws-test-client: add_body_chunk: Received the last of {len (body_chunks)} chunks "
+           f"of message {message ['continues']} ({len (body)} characters)")
+    first_message ['messageBody'] = json.loads (body) if first_message.get ('dataFormat') == "application/json" else body
+    del first_message ['lastChunk']
+    return first_message
+
 def check_json_field (json_obj, field, field_type, required):
     '''Thrown an Exception of json_obj doesn't contain field and/or it isn't of type field_type'''
     if field not in json_obj:
@@ -127,143 +169,197 @@ def check_json_field (json_obj, field, field_type, required):
 def get_websocket ():
     return websocket
 
-class MyHTTPHandler (BaseHTTPRequestHandler):
-    def do_HEAD (self):
-        print ("Got HEAD request for", self.path)
-    def do_GET (self):
-        self.relay_message ()
-    def do_POST (self):
-        self.relay_message ()
-    def do_PUT (self):
-        self.relay_message ()
-    def do_DELETE (self):
-        self.relay_message ()
-
-    def relay_message (self):
-        global message_id
-        websocket = get_websocket ()
-        print (f"Got {self.command} request for {self.path}")
-
-        if (not websocket): # And no HELLOACK received...
-            self.send_error (503, message="The upstream websocket is not open")
-            return
-
-        request_id = message_id
-        message_id += 1
-        message = { 'messageId': request_id, 
-                    'messageType': 'REST:REQUEST',
-                    'requiresResponse': True,
-                    'method': self.command,
-                    'path': self.path}
-
-        content_length_val = self.headers ['Content-Length']
-        if (content_length_val):
-            content_length = int (content_length_val)
-            del self.headers ['Content-Length']
-            if (content_length > 0):
-                if 'Content-Type' in self.headers:
-                    data_format = self.headers ['Content-Type']
-                    del self.headers ['Content-Type']
-                else:
-                    data_format = "application/json"
-                if 'Content-Encoding' in self.headers:
-                    del self.headers ['Content-Encoding']
-                message_payload = self.rfile.read (int (content_length))
-                print (f"  Payload: {message_payload}")
-                message ['dataFormat'] = data_format
-                if (data_format == "application/json"):
-                    encoded_payload = json.loads (message_payload)
-                else:
-                    encoded_payload = message_payload.decode ('utf-8')
-                message ['messageBody'] = encoded_payload
-
-        headers = []
-        for header_name, header_value in self.headers.items ():
-            headers.append ({'name': header_name, 'value': header_value})
-        if (len (headers) > 0):
-            message ['headers'] = headers
-        message_json = json.dumps ({'message': message}, indent=2)
-
-        print (f"ws-test-client: Relaying REST request to peer: {message_json}")
-        request_future = asyncio.run_coroutine_threadsafe (send_rest_message (websocket, message_json), 
-                                                           event_loop)
-        print (f"ws-test-client: Waiting for send to complete...")
-        request_future.result ()
-
-        cond = threading.Condition ()
-        pending_requests [request_id] = cond
-        print (f"ws-test-client: Waiting for response to request #{request_id}...")
-        with cond:
-            cond.wait ()
-        response = pending_requests.pop (request_id)
-        print (f"ws-test-client: Received response to #{request_id}:", response)
-
-        response_json = json.loads (response)
-        response_message = response_json ['message']
-        print (f"ws-test-client: response.json for #{request_id}:", json.dumps (response_message))
-        if (not response_message ['messageType'] == "REST:RESPONSE"):
-            raise Exception ("Response to message #{request_id} is not a REST:RESPONSE")
-        self.send_response (response_message ['statusCode'])
-        found_content_type = False
-        found_content_length = False
-        if ('headers' in response_message):
-            for header in response_message ['headers']:
-                header_name = header ['name']
-                header_val = header ['val']
-                print (f"ws-test-client: header {header_name} has value {header_val}")
-                self.send_header (header_name, header_val)
-                if (header_name == 'Content-Type'):
-                    found_content_type = True
-        message_body = None
-        if ('messageBody' in response_message):
-            data_format = response_message ['dataFormat']
-            if (data_format == 'application/json'):
-                message_body = json.dumps (response_message ['messageBody'], indent=2)
-            else:
-                message_body = response_message ['messageBody']
-            print (f"ws-test-client: Found message body:", message_body)
-            if not found_content_type:
-                self.send_header ('Content-Type', data_format)
-            self.send_header ('Content-Length', len (message_body))
-        self.end_headers ()
-        if (message_body):
-            self.wfile.write (message_body.encode ('utf-8'))
-
-        print (f"Done processing request for {self.path}")
-
-class MyHTTPServerThread (threading.Thread):
-    def __init__ (self):
-        self.lock = threading.Lock ()
-        try:
-            self.lock.acquire ()
-            self.httpd = None
-            self.state = "ready"
-            print ("MyHTTPServerThread.__init__(): state:", self.state)
-            threading.Thread.__init__ (self)
-        finally:
-            self.lock.release ()
-
-    def run (self):
-        try:
-            self.lock.acquire ()
-            if (self.state == "ready"):
-                server_address = (args.http_proxy_address, args.http_proxy_port)
-                self.httpd = HTTPServer (server_address, MyHTTPHandler)
-                self.state = "running"
-                print (f"MyHTTPServerThread: Starting HTTP server on {args.http_proxy_address} port {args.http_proxy_port}...")
-        finally:
-            self.lock.release ()
-        self.httpd.serve_forever ()
-
-    def shutdown (self):
+#
+# The HTTP-to-websocket bridge
+#
+# HTTP requests received on the HTTP proxy port are relayed to the peer as REST:REQUEST messages,
+# and the REST:RESPONSE messages are returned as the HTTP responses. The bridge runs on the event
+# loop of the websocket, so any number of requests can be in flight at once (each waiting on a
+# future in pending_requests, keyed by its messageId). Connections are kept alive (per HTTP/1.1)
+# and request bodies can be sent with chunked transfer encoding.
+#
+
+class HTTPError (Exception):
+    def __init__ (self, status, reason):
+        super ().__init__ (reason)
+        self.status = status
+        self.reason = reason
+
+# Headers which aren't relayed in REST:REQUEST messages (the body is conveyed by dataFormat and messageBody)
+unrelayed_headers = {'content-length', 'content-type', 'content-encoding', 'transfer-encoding', 'connection'}
+
+async def read_http_request (reader):
+    '''Read an HTTP request, returning (method, path, version, headers, body) - or None if the
+       connection was closed. headers is a list of (name, value) tuples.'''
+    request_line = await reader.readline ()
+    if (not request_line.strip ()):
+        return None
+    try:
+        method, path, version = request_line.decode ('latin-1').split ()
+    except ValueError:
+        raise HTTPError (400, "Malformed request line")
+    headers = []
+    while True:
+        header_line = await reader.readline ()
+        if (not header_line):
+            raise HTTPError (400, "Incomplete request headers")
+        if (header_line in (b'\r\n', b'\n')):
+            break
+        name, separator, value = header_line.decode ('latin-1').partition (':')
+        if (not separator):
+            raise HTTPError (400, f"Malformed header line: {header_line!r}")
+        headers.append ((name.strip (), value.strip ()))
+    header_values = {name.lower (): value for name, value in headers}
+    try:
+        if (header_values.get ('transfer-encoding', '').lower () == 'chunked'):
+            body = await read_chunked_body (reader)
+        else:
+            body = await reader.readexactly (int (header_values.get ('content-length', 0)))
+    except ValueError:
+        raise HTTPError (400, "Malformed request body")
+    return method, path, version, headers, body
+
+async def read_chunked_body (reader):
+    chunks = []
+    while True:
+        chunk_size = int ((await reader.readline ()).split (b';') [0], 16)
+        if (chunk_size == 0):
+            break
+        chunks.append (await reader.readexactly (chunk_size))
+        await reader.readline ()
+    # Skip any trailers
+    while (await reader.readline ()) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join (chunks)
+
+async def http_connection_accepted (reader, writer):
+    peer_address = writer.get_extra_info ('peername')
+    try:
+        while True:
+            keep_alive = False
+            try:
+                request = await read_http_request (reader)
+                if (not request):
+                    break
+                method, path, version, headers, body = request
+                connection_header = next ((value.lower () for name, value in headers
+                                           if name.lower () == 'connection'), None)
+                keep_alive = (connection_header == 'keep-alive' if version == "HTTP/1.0"
+                              else connection_header != 'close')
+                print (f"Got {method} request for {path} from {peer_address}")
+                response_message = await relay_http_request (method, path, headers, body)
+                write_http_response (writer, response_message, keep_alive)
+            except HTTPError as he:
+                print (f"ws-test-client: Returning error {he.status} for request from {peer_address}: {he.reason}")
+                write_http_error (writer, he.status, he.reason, keep_alive)
+            await writer.drain ()
+            if (not keep_alive):
+                break
+    except (ConnectionError, asyncio.IncompleteReadError) as ex:
+        print (f"ws-test-client: HTTP connection from {peer_address} closed: {ex}")
+    finally:
+        writer.close ()
+
+async def relay_http_request (method, path, headers, body):
+    '''Relay the HTTP request as a REST:REQUEST message, returning the REST:RESPONSE message'''
+    websocket = get_websocket ()
+    if (not websocket or not websocket.open):
+        raise HTTPError (503, "The upstream websocket is not open")
+
+    message = { 'messageType': 'REST:REQUEST',
+                'requiresResponse': True,
+                'method': method,
+                'path': path}
+    header_values = {name.lower (): value for name, value in headers}
+    body_chunks = []
+    if (body):
+        data_format = header_values.get ('content-type', "application/json")
+        print (f"  Payload: {body}")
+        message ['dataFormat'] = data_format
         try:
-            self.lock.acquire ()
-            if (self.state == "running"):
-                print ("MyHTTPServerThread: Shutting down HTTP server...")
-                self.httpd.shutdown ()
-            self.state = "stopped"
-        finally:
-            self.lock.release ()
+            if (args.body_chunk_size and len (body) > args.body_chunk_size):
+                # The (encoded) body is sent in pieces - see "Chunked message bodies" in the README
+                body_text = body.decode ('utf-8')
+                body_chunks = [body_text [offset:offset + args.body_chunk_size]
+                               for offset in range (0, len (body_text), args.body_chunk_size)]
+                message ['messageBody'] = body_chunks.pop (0)
+                message ['lastChunk'] = False
+            elif (data_format == "application/json"):
+                message ['messageBody'] = json.loads (body)
+            else:
+                message ['messageBody'] = body.decode ('utf-8')
+        except ValueError as ve:
+            raise HTTPError (400, f"Could not decode the request body: {ve}")
+    relayed_headers = [{'name': name, 'value': value} for name, value in headers
+                       if name.lower () not in unrelayed_headers]
+    if (relayed_headers):
+        message ['headers'] = relayed_headers
+
+    response_future = asyncio.get_event_loop ().create_future ()
+    request_id = None
+    try:
+        print (f"ws-test-client: Relaying REST {method} request for {path} to peer")
+        request_id = await send_rest_message (websocket, message, response_future)
+        for chunk_index, body_chunk in enumerate (body_chunks, 1):
+            await send_rest_message (websocket, {'messageType': 'REST:CONTINUATION',
+                                                 'requiresResponse': False,
+                                                 'continues': request_id,
+                                                 'lastChunk': chunk_index == len (body_chunks),
+                                                 'messageBody': body_chunk})
+        print (f"ws-test-client: Waiting for response to request #{request_id}...")
+        response_message = await asyncio.wait_for (response_future, args.request_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPError (504, f"No response to request #{request_id} within {args.request_timeout} seconds")
+    except ConnectionClosed:
+        raise HTTPError (502, "The upstream websocket closed")
+    finally:
+        pending_requests.pop (request_id, None)
+    print (f"ws-test-client: Received response to #{request_id}:", response_message)
+
+    if (not response_message ['messageType'] == "REST:RESPONSE"):
+        raise HTTPError (502, f"Response to message #{request_id} is not a REST:RESPONSE")
+    return response_message
+
+def write_http_response (writer, response_message, keep_alive):
+    status_code = response_message ['statusCode']
+    reason_phrase = response_message.get ('reasonPhrase', "")
+    response_headers = []
+    found_content_type = False
+    for header in response_message.get ('headers', []):
+        header_name = header ['name']
+        header_val = header ['value']
+        if (header_name.lower () in unrelayed_headers):
+            found_content_type = found_content_type or header_name.lower () == 'content-type'
+            if (header_name.lower () != 'content-type'):
+                continue
+        print (f"ws-test-client: header {header_name} has value {header_val}")
+        response_headers.append ((header_name, header_val))
+    message_body = b''
+    if ('messageBody' in response_message):
+        data_format = response_message.get ('dataFormat', "application/json")
+        if (data_format == 'application/json'):
+            message_body = json.dumps (response_message ['messageBody'], indent=2).encode ('utf-8')
+        else:
+            message_body = response_message ['messageBody'].encode ('utf-8')
+        print (f"ws-test-client: Found message body:", message_body)
+        if not found_content_type:
+            response_headers.append (('Content-Type', data_format))
+    write_http_message (writer, status_code, reason_phrase, response_headers, message_body, keep_alive)
+
+def write_http_error (writer, status_code, reason, keep_alive):
+    write_http_message (writer, status_code, reason, [('Content-Type', "text/plain")],
+                        (reason + "\n").encode ('utf-8'), keep_alive)
+
+def write_http_message (writer, status_code, reason_phrase, headers, body, keep_alive):
+    headers = headers + [('Content-Length', str (len (body))),
+                         ('Connection', "keep-alive" if keep_alive else "close")]
+    head = f"HTTP/1.1 {status_code} {reason_phrase}\r\n"
+    head += "".join (f"{name}: {value}\r\n" for name, value in headers)
+    writer.write ((head + "\r\n").encode ('latin-1') + body)
+
+async def start_http_server ():
+    print (f"ws-test-client: Starting HTTP server on {args.http_proxy_address} port {args.http_proxy_port}...")
+    return await asyncio.start_server (http_connection_accepted, args.http_proxy_address, args.http_proxy_port)
 
 class ConsoleThread (threading.Thread):
     def __init__ (self):
@@ -310,13 +406,12 @@ ssl_context.verify_mode = ssl.VerifyMode.CERT_REQUIRED
 ssl_context.check_hostname = False
 
 event_loop = asyncio.get_event_loop ()
-my_http_thread = None
+http_server = None
 console_thread = None
 try:
     websocket = event_loop.run_until_complete (asyncio.ensure_future (init_connection (ssl_context,
                                                                                        args.connect_uri)))
-    my_http_thread = MyHTTPServerThread ()
-    my_http_thread.start ()
+    http_server = event_loop.run_until_complete (start_http_server ())
     console_thread = ConsoleThread ()
     console_thread.start ()
     print (f"ws-test-client: Starting event loop...")
@@ -327,8 +422,9 @@ except Exception as Ex:
     print (f"ws-test-client: Caught an exception on connection to {args.connect_uri}: {Ex}")
     traceback.print_exc (file=sys.stdout)
 finally:
+    if (http_server):
+        print ("ws-test-client: Shutting down HTTP server...")
+        http_server.close ()
     event_loop.close ()
-    if (my_http_thread):
-        my_http_thread.shutdown ()
     if (console_thread):
         console_thread.shutdown ()
@@ -6,7 +6,7 @@ import asyncio
 import websockets
 import threading
 import time
-from quart import json
+import json
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
 async def ws_connected (websocket, path):